@@ -0,0 +1,213 @@
+"""
+A local catalog of every challenge posted to /r/dailyprogrammer.
+
+Posts are parsed once when they are ingested and kept in a sqlite database indexed by level and
+challenge number, so choosing the challenge for a week is a lookup instead of a scrape.
+"""
+
+import sqlite3
+import sys
+import time
+from typing import Any, Iterable, List, Optional, Tuple, cast
+
+from result import Result, Ok, Err
+from scraper import ChallengePost, Reddit, init_reddit, parse_post
+
+
+# Path to the database the catalog is stored in
+PATH = "catalog.db"
+
+# Number of seconds after an ingest before the catalog is refreshed from reddit again
+MAX_AGE = 60 * 60
+
+# Number of posts written to the database at a time while ingesting
+INGEST_BATCH = 100
+
+_COLUMNS = "id, title, number, level, permalink, selftext_html"
+
+
+class Catalog(object):
+    """The challenges that have been posted, and which of them have been sent.
+
+    Attributes:
+        connection: The connection to the database
+    """
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        """Wraps an open database connection, creating the tables if they do not exist.
+
+        Args:
+            connection: The connection to the database
+        """
+        self.connection = connection
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS challenges (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                number INTEGER NOT NULL,
+                level TEXT NOT NULL,
+                permalink TEXT NOT NULL,
+                selftext_html TEXT NOT NULL,
+                sent TEXT
+            );
+            CREATE INDEX IF NOT EXISTS challenges_by_level ON challenges (level, number);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+
+    def _posts(self, where: str, args: Tuple[Any, ...]) -> List[ChallengePost]:
+        """Runs a query for challenges, returning them as posts."""
+        rows = self.connection.execute("SELECT {} FROM challenges {}".format(_COLUMNS, where), args)
+        return [ChallengePost(*row) for row in rows]
+
+    def add(self, posts: Iterable[ChallengePost]) -> int:
+        """Adds posts to the catalog, ignoring any that are already in it.
+
+        Args:
+            posts: The posts to add
+
+        Returns:
+            The number of posts that were new
+        """
+        cursor = self.connection.executemany(
+            "INSERT OR IGNORE INTO challenges ({}) VALUES (?, ?, ?, ?, ?, ?)".format(_COLUMNS),
+            posts)
+        self.connection.commit()
+        return cursor.rowcount
+
+    def __contains__(self, post_id: object) -> bool:
+        row = self.connection.execute("SELECT 1 FROM challenges WHERE id = ?",
+                                      (post_id,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return cast(int, self.connection.execute("SELECT COUNT(*) FROM challenges").fetchone()[0])
+
+    def get(self, post_id: str) -> Optional[ChallengePost]:
+        """Looks up a challenge by the id of its post."""
+        found = self._posts("WHERE id = ?", (post_id,))
+        return found[0] if found else None
+
+    def newest(self, level: str, unsent: bool = False) -> Optional[ChallengePost]:
+        """Finds the highest numbered challenge at a level.
+
+        Args:
+            level: The level of the challenge
+            unsent: Only consider challenges that have not been sent
+
+        Returns:
+            The challenge, or None if there are none at the level
+        """
+        found = self._posts("WHERE level = ? {} ORDER BY number DESC LIMIT 1".format(
+            "AND sent IS NULL" if unsent else ""), (level,))
+        return found[0] if found else None
+
+    def numbered(self, level: str, low: int, high: int) -> List[ChallengePost]:
+        """Lists the challenges at a level numbered from low to high inclusive, lowest first."""
+        return self._posts("WHERE level = ? AND number BETWEEN ? AND ? ORDER BY number",
+                           (level, low, high))
+
+    def unsent(self, level: str) -> List[ChallengePost]:
+        """Lists the challenges at a level that have not been sent, newest first."""
+        return self._posts("WHERE level = ? AND sent IS NULL ORDER BY number DESC", (level,))
+
+    def mark_sent(self, post_id: str, week: str) -> None:
+        """Records that a challenge was sent out during the given week."""
+        self.connection.execute("UPDATE challenges SET sent = ? WHERE id = ?", (week, post_id))
+        self.connection.commit()
+
+    def ingested_at(self) -> float:
+        """Gets the time of the last ingest from reddit, or 0 if there has never been one."""
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'ingested'").fetchone()
+        return 0.0 if row is None else float(row[0])
+
+    def set_ingested_at(self, when: float) -> None:
+        """Records the time of an ingest from reddit."""
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('ingested', ?)",
+                                (repr(when),))
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Closes the database."""
+        self.connection.close()
+
+
+def open_catalog(path: str = PATH) -> Result[str, Catalog]:
+    """Opens the catalog stored at the given path, creating it if it does not exist."""
+    try:
+        return Ok(Catalog(sqlite3.connect(path)))
+    except sqlite3.Error as exn:
+        return Err(str(exn))
+
+
+def ingest(catalog: Catalog, reddit: Reddit) -> Result[str, int]:
+    """Adds the challenges posted since the last ingest to the catalog.
+
+    Posts are read newest first, stopping at the first one already in the catalog. Until the first
+    ingest completes this walks back as far as reddit's listing goes.
+
+    Args:
+        catalog: The catalog to add to
+        reddit: The reddit instance to read posts with
+
+    Returns:
+        The number of challenges added
+    """
+    # until an ingest has finished there may be gaps below the newest post, so read everything
+    stop_at_known = catalog.ingested_at() > 0
+    added = 0
+    batch = [] # type: List[ChallengePost]
+    try:
+        for raw in reddit.subreddit('dailyprogrammer').new(limit=None):
+            if stop_at_known and raw.id in catalog:
+                break
+            post = parse_post(raw)
+            if post is not None:
+                batch.append(post)
+            if len(batch) >= INGEST_BATCH:
+                added += catalog.add(batch)
+                batch = []
+    except Exception as exn: # pylint: disable=broad-except
+        # keep what was read, but make the next ingest read past the gap this leaves
+        added += catalog.add(batch)
+        catalog.set_ingested_at(0.0)
+        return Err("Ingest stopped after {} challenges: {}".format(added, exn))
+    added += catalog.add(batch)
+    catalog.set_ingested_at(time.time())
+    return Ok(added)
+
+
+def refresh(catalog: Catalog,
+            max_age: float = MAX_AGE,
+            offline: bool = False) -> Result[str, Catalog]:
+    """Ingests new challenges if the catalog has not been refreshed recently.
+
+    Args:
+        catalog: The catalog to refresh
+        max_age: The number of seconds since the last ingest before ingesting again
+        offline: Never go to reddit, no matter how old the catalog is
+
+    Returns:
+        The catalog, or an Err if it was stale and could not be refreshed
+    """
+    if offline or time.time() - catalog.ingested_at() < max_age:
+        return Ok(catalog)
+    return init_reddit().bind(lambda reddit: ingest(catalog, reddit)).fmap(lambda _: catalog)
+
+
+def main(path: str) -> int:
+    """Main function to run if this file is run as a script"""
+    def with_catalog(catalog: Catalog) -> Result[str, int]:
+        """Ingests into an open catalog"""
+        try:
+            return init_reddit().bind(lambda reddit: ingest(catalog, reddit))
+        finally:
+            catalog.close()
+
+    result = open_catalog(path).bind(with_catalog)
+    print(result.extract(
+        err_func=lambda err: "Could not ingest: {}".format(err),
+        ok_func=lambda added: "Added {} challenges to {}".format(added, path)
+    ))
+    return 0 if result.is_ok else 1
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1] if len(sys.argv) == 2 else PATH))
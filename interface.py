@@ -1,8 +1,10 @@
 """ The interface to the mailer. """
 
-import email
 from email.mime.text import MIMEText
-from typing import Dict, List, TypeVar, Callable, Any # pylint: disable=unused-import
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, TypeVar, Callable, Any, Deque, Tuple # pylint: disable=unused-import
 import json
 import re
 
@@ -10,18 +12,33 @@ from result import Result, Err, Ok
 import mail
 import weeklysend
 from jsonparse import run_parser, dict_parser, list_parser, str_parser
-from user import User, load_users, save_users
+from user import User
+from userstore import UserStore, open_store
 
 Langs = Dict[str, List[str]] # pylint: disable=invalid-name
-Users = Dict[str, User] # pylint: disable=invalid-name
-Message = email.message.Message # pylint: disable=invalid-name
-Reaction = Callable[[Users, Message], Result[str, MIMEText]] # pylint: disable=invalid-name
+Users = UserStore # pylint: disable=invalid-name
+Message = mail.Incoming # pylint: disable=invalid-name
+Reaction = Callable[[Users, Message], Result[str, mail.Outgoing]] # pylint: disable=invalid-name
+Modifier = Callable[[Users, Message, str], Result[str, mail.Outgoing]] # pylint: disable=invalid-name
 
 A = TypeVar("A")
 B = TypeVar("B")
 
 LEVELS = ["Easy", "Intermediate", "Hard"]
 
+# Number of inbox messages being fetched or answered at once
+CONCURRENCY = 8
+
+# Shortest start of a command name that is accepted in place of the whole name
+MIN_PREFIX = 2
+
+# Shortest command name that is still recognized with a typo in it
+MIN_TYPO_LENGTH = 4
+
+_REPLY_PREFIX = re.compile(r"^\s*(?:(?:re|fwd?)\s*:\s*)*", re.IGNORECASE)
+_TRAILING = ".!"
+_INSULT = re.compile("fu+c?k yo*u+")
+
 
 def parse_langs(raw: str) -> Result[str, Langs]:
     """ Parse some raw json into the language list. """
@@ -57,7 +74,104 @@ def init(langs: Langs) -> Langs:
     return new_langs
 
 
-def react(users: Users, message: Message) -> Result[str, MIMEText]:
+def normalize_subject(subject: str) -> str:
+    """Lowercases a subject and strips any reply or forward markers and extra whitespace.
+
+    Example:
+        >>> normalize_subject("  Re: FWD:  Fuck   This!")
+        'fuck this'
+    """
+    return " ".join(_REPLY_PREFIX.sub("", subject).lower().split()).rstrip(_TRAILING)
+
+
+class CommandTable(object):
+    """Finds the command named by a subject line.
+
+    A subject names a command if it is one of the command's names, if it is the start of only one
+    command's names, or if it is one letter away from only one command's names. Commands that are
+    hard to undo can be added so that only their exact names are accepted. Their shortened and
+    misspelled names then match no command at all, rather than some other command. Every key is
+    computed when a command is added, so a lookup is a few dictionary probes.
+    """
+    def __init__(self) -> None:
+        """Builds an empty table."""
+        self._exact = dict() # type: Dict[str, Reaction]
+        self._prefixes = dict() # type: Dict[str, Optional[Reaction]]
+        self._deletions = dict() # type: Dict[str, Optional[Reaction]]
+
+    def add(self, names: Iterable[str], reaction: Reaction, fuzzy: bool = True) -> None:
+        """Adds a command.
+
+        Args:
+            names: The names and aliases of the command
+            reaction: The handler for the command
+            fuzzy: Accept the start of a name or a name with a typo in it, not just an exact name
+        """
+        claim = _claim if fuzzy else _block
+        for name in (normalize_subject(name) for name in names):
+            self._exact[name] = reaction
+            for end in range(MIN_PREFIX, len(name)):
+                claim(self._prefixes, name[:end], reaction)
+            if len(name) >= MIN_TYPO_LENGTH:
+                for key in _deletions(name):
+                    claim(self._deletions, key, reaction)
+
+    def lookup(self, subject: str) -> Optional[Reaction]:
+        """Finds the command a subject names.
+
+        Example:
+            >>> table = CommandTable()
+            >>> table.add(["subscribe"], help_msg)
+            >>> table.add(["unsubscribe"], unknown, fuzzy=False)
+            >>> [table.lookup(s) is help_msg for s in ["Subscribe", "sub", "subscirbe", "unsub"]]
+            [True, True, True, False]
+            >>> [table.lookup(s) for s in ["s", "unsub", "unsubscribr"]]
+            [None, None, None]
+
+        Args:
+            subject: The subject line of a message
+
+        Returns:
+            The handler for the command, or None if the subject does not name exactly one command
+        """
+        name = normalize_subject(subject)
+        exact = self._exact.get(name)
+        if exact is not None:
+            return exact
+        prefixed = self._prefixes.get(name)
+        if prefixed is not None or len(name) < MIN_TYPO_LENGTH - 1:
+            return prefixed
+        found = set(self._deletions.get(key) for key in _deletions(name) if key in self._deletions)
+        return found.pop() if len(found) == 1 else None
+
+
+def _deletions(name: str) -> Iterator[str]:
+    """Generates a name and each string made by deleting one of its characters.
+
+    Two names are within one insertion, deletion, substitution or swap of each other exactly when
+    these sets overlap.
+    """
+    yield name
+    for index in range(len(name)):
+        yield name[:index] + name[index + 1:]
+
+
+def _claim(keys: Dict[str, Optional[Reaction]], key: str, reaction: Reaction) -> None:
+    """Maps a key to a reaction, or to None if another reaction already has the key."""
+    if keys.setdefault(key, reaction) is not reaction:
+        keys[key] = None
+
+
+def _block(keys: Dict[str, Optional[Reaction]], key: str, _: Reaction) -> None:
+    """Maps a key to None, so that it never names a command."""
+    keys[key] = None
+
+
+# Every command that can be given in a subject line. Commands are added with @command
+COMMANDS = CommandTable()
+
+
+def react(users: Users, message: Message) -> Result[str, mail.Outgoing]:
     """ Uses the subject line of the given message to update the user list and
         build a response.
     """
@@ -65,25 +179,34 @@ def react(users: Users, message: Message) -> Result[str, MIMEText]:
     if subject is None:
         return Err("Message has no subject")
 
-    commands = {"help": help_msg,
-                "?": help_msg,
-                "subscribe": sub,
-                "unsubscribe": modify_user(unsub),
-                "get": modify_user(get_langs),
-                "set": modify_user(set_langs),
-                "add": modify_user(add_langs),
-                "remove": modify_user(remove_langs),
-                "veto": modify_user(veto),
-                "fuck this": modify_user(veto)
-               } # type: Dict[str, Reaction]
-    return commands.get(subject.lower(), unknown)(users, message)
-
-
-def modify_user(modify: Callable[[Users, Message, str], Result[str, MIMEText]]) -> Reaction:
+    return (COMMANDS.lookup(subject) or unknown)(users, message)
+
+
+def command(*names: str, fuzzy: bool = True) -> Callable[[Reaction], Reaction]:
+    """ Registers a function as the handler for the commands with the given names.
+        Pass fuzzy=False for a command that should only be given by its exact name.
+    """
+    def register(reaction: Reaction) -> Reaction:
+        """ Adds the reaction to the command table. """
+        COMMANDS.add(names, reaction, fuzzy)
+        return reaction
+    return register
+
+
+def user_command(*names: str, fuzzy: bool = True) -> Callable[[Modifier], Modifier]:
+    """ Registers a function as the handler for commands that only subscribers can give. """
+    def register(modify: Modifier) -> Modifier:
+        """ Adds the modifier to the command table. """
+        COMMANDS.add(names, modify_user(modify), fuzzy)
+        return modify
+    return register
+
+
+def modify_user(modify: Modifier) -> Reaction:
     """ Build a function that modifies a user's data. """
-    def inner(users: Users, message: Message) -> Result[str, MIMEText]:
+    def inner(users: Users, message: Message) -> Result[str, mail.Outgoing]:
         """ Do checks, then run the modify function. """
-        def check_and_modify(address: str) -> Result[str, MIMEText]:
+        def check_and_modify(address: str) -> Result[str, mail.Outgoing]:
             """Check if a user is in the list before proceeding with the modification"""
             if address not in users:
                 return mail.make_reply(message, "{} is not subscribed.".format(address))
@@ -94,27 +217,29 @@ def modify_user(modify: Callable[[Users, Message, str], Result[str, MIMEText]])
     return inner
 
 
-def help_msg(_: Users, message: Message) -> Result[str, MIMEText]:
+@command("help", "?")
+def help_msg(_: Users, message: Message) -> Result[str, mail.Outgoing]:
     """ Builds an email containing the help information. """
     info = """Available commands are subscribe, unsubscribe, get, set, add, remove, and help."""
     return mail.make_reply(message, info)
 
 
-def unknown(users: Users, message: Message) -> Result[str, MIMEText]:
+def unknown(users: Users, message: Message) -> Result[str, mail.Outgoing]:
     """ Handle a message with an unknown command. """
     subject = message["subject"]
-    if subject is not None and re.match("fu+c?k yo*u+", subject.lower()):
+    if subject is not None and _INSULT.match(subject.lower()):
         return mail.make_reply(message, "Fuck you too bitch, call the cops!")
     else:
         return help_msg(users, message)
 
 
-def sub(users: Users, message: Message) -> Result[str, MIMEText]:
+@command("subscribe")
+def sub(users: Users, message: Message) -> Result[str, mail.Outgoing]:
     """ Subscribes the sender to the list with the contents.
         If the contents fail to parse, the new user gets an empty dict,
         an error message, and the help reply.
     """
-    def with_address(address: str) -> Result[str, MIMEText]: # pylint: disable=missing-docstring
+    def with_address(address: str) -> Result[str, mail.Outgoing]: # pylint: disable=missing-docstring
         if address in users:
             return mail.make_reply(message, "{} is already subscribed.".format(address))
 
@@ -139,22 +264,26 @@ def sub(users: Users, message: Message) -> Result[str, MIMEText]:
     return mail.get_address(message).bind(with_address)
 
 
-def unsub(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("unsubscribe", fuzzy=False)
+def unsub(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """Unsubscribe the sender of the message from the list."""
-    users.pop(address)
+    if users.pop(address).vetoed:
+        users.tally.unvote()
     return mail.make_reply(message, "{} has been unsubscribed.".format(address))
 
 
-def get_langs(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("get")
+def get_langs(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """ Gets the languages listed for the sender. """
     reply = "Languages for {}:\n{}".format(address,
                                            json.dumps(users[address].langs, indent=4))
     return mail.make_reply(message, reply)
 
 
-def set_langs(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("set")
+def set_langs(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """ Set the sender's languages to the ones in the message. """
-    def set_and_reply(langs: Langs) -> Result[str, MIMEText]:
+    def set_and_reply(langs: Langs) -> Result[str, mail.Outgoing]:
         """Set the user's languages and build a reply email"""
         users[address].langs = langs
         reply = "Languages for {} have been set to\n{}".format(address, json.dumps(langs, indent=4))
@@ -167,11 +296,13 @@ def set_langs(users: Users, message: Message, address: str) -> Result[str, MIMET
     )
 
 
-def add_langs(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("add")
+def add_langs(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """ Add languages to the sender's list. """
     result = mail.get_text_content(message)\
                  .bind(parse_langs)\
                  .fmap(lambda langs: add(users[address].langs, langs)) # type: Result[str, None]
+    users[address].touch()
 
     good_text = "Language update successful. Languages are now\n{}".format(
         json.dumps(users[address].langs, indent=4))
@@ -180,11 +311,13 @@ def add_langs(users: Users, message: Message, address: str) -> Result[str, MIMET
     return mail.make_reply(message, reply)
 
 
-def remove_langs(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("remove", fuzzy=False)
+def remove_langs(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """ Remove languages from the sender's list. """
     result = mail.get_text_content(message)\
                  .bind(parse_langs)\
                  .fmap(lambda langs: remove(users[address].langs, langs)) # type: Result[str, None]
+    users[address].touch()
 
     good_text = "Language update successful. Languages are now\n{}".format(
         json.dumps(users[address].langs, indent=4))
@@ -193,7 +326,8 @@ def remove_langs(users: Users, message: Message, address: str) -> Result[str, MI
     return mail.make_reply(message, reply)
 
 
-def veto(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
+@user_command("veto", "fuck this", fuzzy=False)
+def veto(users: Users, message: Message, address: str) -> Result[str, mail.Outgoing]:
     """Veto this week's problem.
 
     If half or more of the users veto the problem then send out a new problem to all users.
@@ -206,58 +340,122 @@ def veto(users: Users, message: Message, address: str) -> Result[str, MIMEText]:
     Returns:
         An error as a string or a reply email
     """
-    users[address].vetoed = True
+    user = users[address]
+    if not user.vetoed:
+        user.vetoed = True
+        users.tally.vote()
     return mail.make_reply(message, "Your voice has been heard.")
 
 
-def respond_to_all(service: Any, users: Users) -> None:
-    """ Responds to all messages in the inbox. """
-    def reply_and_trash(del_id: str, thread_id: str, reply: MIMEText) -> None:
-        """ Send a reply, then trash the original message. """
-        mail.send(service, "me", reply, thread_id)
-        mail.trash(service, "me", del_id)
+def respond_to_all(service: Any,
+                   users: Users,
+                   concurrency: int = CONCURRENCY,
+                   service_factory: Optional[Callable[[], Any]] = None
+                  ) -> None:
+    """Responds to all messages in the inbox.
 
-    # without this definition mypy cannot infer the type of extract
-    def fail_mail(err: str) -> None: # pylint: disable=missing-docstring
-        notify_failure(service, err)
+    The inbox is read page by page, so processing starts with the first page. It is handled in
+    chunks of mail.BATCH_LIMIT messages. Each chunk is fetched with one batch request, and its
+    replies are sent and the originals trashed with one batch request each. Fetching and answering
+    chunks happens on a pool of worker threads so the round trips overlap. Reacting to messages,
+    which is the only step that touches the user state, happens on this thread one message at a
+    time in inbox order.
 
-    for message_data in mail.list_messages(service, "me").get("messages", []):
-        msg_id = message_data["id"]
-        thread = message_data["threadId"]
-        message = mail.get_message(service, "me", msg_id)
-        response = react(users, message) # type: Result[str, MIMEText]
-        response.extract(
-            err_func=fail_mail,
-            ok_func=lambda reply: reply_and_trash(msg_id, thread, reply) # pylint: disable=cell-var-from-loop
-        )
+    A send caused by a veto earlier this week that did not reach everyone is finished first. Until
+    it has, the votes left in the tally belong to the challenge it replaced, so they cannot cause
+    another veto. Neither can votes for a challenge sent in an earlier week.
+
+    Args:
+        service: The mail service used on this thread
+        users: The state of all users
+        concurrency: The number of chunks in flight at once
+        service_factory: Builds a service for each worker thread. If this is not given the workers
+            share service
+    """
+    unfinished_veto = weeklysend.resume_veto(users, service, service_factory)
+    workers = mail.ServicePool(service_factory if service_factory is not None else lambda: service)
+
+    def fetch(msg_ids: List[str]) -> List[Result[str, mail.LazyMessage]]:
+        """ Download a chunk of messages. """
+        return mail.get_messages(workers.get(), "me", msg_ids)
+
+    def answer(replies: List[Tuple[str, str, mail.Outgoing]], failures: List[str]) -> None:
+        """ Send replies and failure notices, then trash the messages that were answered. """
+        worker = workers.get()
+        outgoing = [] # type: List[Tuple[mail.Outgoing, Optional[str]]]
+        outgoing.extend((reply, thread_id) for (_, thread_id, reply) in replies)
+        outgoing.extend((failure_message(err), None) for err in failures)
+        sent = mail.send_all(worker, "me", outgoing)
+        mail.trash_all(worker, "me", [msg_id for ((msg_id, _, _), result) in zip(replies, sent)
+                                      if result.is_ok])
+
+    def react_to(chunk: List[Dict[str, str]],
+                 fetched: List[Result[str, mail.LazyMessage]]) -> None:
+        """ Update the users with a chunk of messages and queue the replies. """
+        replies = [] # type: List[Tuple[str, str, mail.Outgoing]]
+        failures = [] # type: List[str]
+
+        def queue(message_data: Dict[str, str], response: Result[str, mail.Outgoing]) -> None:
+            """ Queue the reply to a message, or the failure to answer it. """
+            response.extract(
+                err_func=failures.append,
+                ok_func=lambda reply: replies.append(
+                    (message_data["id"], message_data["threadId"], reply))
+            )
 
-    vetoes = sum(1 for user in users.values() if user.vetoed)
-    if vetoes >= len(users) / 2:
-        weeklysend.resend_cause_veto(users, service)
+        for message_data, message in zip(chunk, fetched):
+            queue(message_data, message.bind(lambda m: react(users, m)))
+        pending.append(pool.submit(answer, replies, failures))
+
+    messages = mail.iter_messages(service, "me", max_results=mail.BATCH_LIMIT)
+    pending = [] # type: List[Future]
+    fetches = deque() # type: Deque[Tuple[List[Dict[str, str]], Future]]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for chunk in iter(lambda: list(islice(messages, mail.BATCH_LIMIT)), []):
+            fetches.append((chunk, pool.submit(fetch, [data["id"] for data in chunk])))
+            if len(fetches) > concurrency:
+                done_chunk, fetched = fetches.popleft()
+                react_to(done_chunk, fetched.result())
+        while fetches:
+            done_chunk, fetched = fetches.popleft()
+            react_to(done_chunk, fetched.result())
+        for job in pending:
+            job.result()
+
+    votes = users.tally.votes_for(weeklysend.this_week())
+    if not unfinished_veto and votes > 0 and votes >= len(users) / 2:
+        weeklysend.resend_cause_veto(users, service, service_factory)
+
+
+def failure_message(err: str) -> MIMEText:
+    """ Build an email indicating a failure. """
+    return mail.make_message(body=err,
+                             subject="FAILURE",
+                             recipient="tobinyehle@gmail.com")
 
 
 def notify_failure(service: Any, err: str) -> None:
     """ Send an email indicating a failure. """
-    message = mail.make_message(body=err,
-                                subject="FAILURE",
-                                recipient="tobinyehle@gmail.com")
-    mail.send(service, "me", message)
+    mail.send(service, "me", failure_message(err))
 
 
 def main() -> None:
     """ Function to run if this file is run as a script. """
     service = mail.init_service()
 
-    parsed_users = load_users()
+    parsed_users = open_store()
 
     # without this definition mypy cannot infer the type of extract
     def fail_mail(err: str) -> None: # pylint: disable=missing-docstring
         notify_failure(service, err)
 
-    def respond_and_save(users: Users) -> None:
+    def respond_and_save(users: UserStore) -> None:
         """Respond to all messages, then save the user state"""
-        respond_to_all(service, users)
-        save_users(users)
+        try:
+            respond_to_all(service, users, service_factory=mail.init_service)
+            users.save()
+        finally:
+            users.close()
 
     parsed_users.extract(err_func=fail_mail, ok_func=respond_and_save)
 
@@ -1,49 +1,309 @@
 """ Module for loading json in a typesafe way. """
 
+import copy
+import gzip
 import json
+import reprlib
+import sys
 
-from typing import Dict, List, Optional, Callable, TypeVar, Any, Tuple
+from typing import Dict, List, Optional, Callable, TypeVar, Any, Tuple, IO, Iterator, Union, cast
 
-from result import Result, Err, Ok, map_m
+from result import Result, Err, Ok
 
 # pylint: disable=C0103
 
 A = TypeVar("A")
 B = TypeVar("B")
 # Generic type aliases need the new typing module
-Parser = Callable[[Any], Result[str, A]]
+Parser = Callable[[Any], Result["ParseError", A]]
+PathKey = Union[str, int]
+
+# Number of characters read at a time when streaming a file
+CHUNK_SIZE = 64 * 1024
+
+# Maximum number of characters of an offending value shown in an error message
+PREVIEW_LIMIT = 120
+
+
+class ParseError(object):
+    """A failure to parse some json.
+
+    Errors are rendered only when they are converted to a string, so a failure deep inside a large
+    document does not pay to format the values it passes through on the way up.
+
+    Attributes:
+        path: The keys and indices leading from the root of the document to the failure
+    """
+    def __init__(self, value: Any) -> None:
+        """Creates an error at the root of the document.
+
+        Args:
+            value: The value that could not be parsed
+        """
+        self.value = value
+        self.path = () # type: Tuple[PathKey, ...]
+
+    def at(self, key: PathKey) -> "ParseError":
+        """Moves the error one level down into the document.
+
+        Args:
+            key: The key or index of the value that failed within its parent
+
+        Returns:
+            A copy of this error with key prepended to its path
+        """
+        out = copy.copy(self)
+        out.path = (key,) + self.path
+        return out
+
+    def describe(self) -> str:
+        """Describes what went wrong, without the location. Subclasses are more specific."""
+        return "Could not parse value"
+
+    def render_path(self) -> str:
+        """Renders the path in the form $["a@b.com"].langs.Easy[3]."""
+        parts = ["$"]
+        for key in self.path:
+            if isinstance(key, int):
+                parts.append("[{}]".format(key))
+            elif key.isidentifier():
+                parts.append("." + key)
+            else:
+                parts.append("[{}]".format(json.dumps(key)))
+        return "".join(parts)
+
+    def preview(self) -> str:
+        """Renders a bounded preview of the offending value."""
+        text = _PREVIEW.repr(self.value)
+        if len(text) > PREVIEW_LIMIT:
+            return text[:PREVIEW_LIMIT - 3] + "..."
+        return text
+
+    def __str__(self) -> str:
+        return "{} at {} in {}".format(self.describe(), self.render_path(), self.preview())
+
+    def __repr__(self) -> str:
+        return repr(str(self))
+
+
+class TypeMismatch(ParseError):
+    """A value had the wrong json type."""
+    def __init__(self, expected: Any, value: Any) -> None:
+        super().__init__(value)
+        self.expected = expected
+
+    def describe(self) -> str:
+        return "Expecting {}, but got {}".format(self.expected, self.value.__class__)
+
+
+class MissingField(ParseError):
+    """An object was missing a required field."""
+    def __init__(self, name: str, value: Any) -> None:
+        super().__init__(value)
+        self.name = name
+
+    def describe(self) -> str:
+        return "Missing field {}".format(self.name)
+
+
+def _make_preview() -> reprlib.Repr:
+    """Builds the repr used to preview values, which never walks more than a few levels."""
+    out = reprlib.Repr()
+    out.maxlevel = 3
+    out.maxdict = 4
+    out.maxlist = 6
+    out.maxstring = 40
+    out.maxother = 40
+    return out
+
+
+_PREVIEW = _make_preview()
+
+
+def open_text(filename: str) -> IO[str]:
+    """ Open a file for reading text, decompressing it if the name ends in .gz. """
+    if filename.endswith(".gz"):
+        return cast(IO[str], gzip.open(filename, mode="rt"))
+    return open(filename, mode="r")
 
 
 def run_parser_file(filename: str, parser: "Parser[A]") -> Result[str, A]:
-    """ Run a parser on the contents of a file. """
+    """ Run a parser on the contents of a file. Any failure is rendered as a string. """
     try:
-        with open(filename, mode="r") as handle:
+        with open_text(filename) as handle:
             raw = handle.read()
             return run_parser(raw, parser)
     except OSError as exn:
         return Err(str(exn))
 
 
+def run_dict_parser_file(filename: str,
+                         inner: "Parser[A]",
+                         chunk_size: int = CHUNK_SIZE) -> Result[str, Dict[str, A]]:
+    """ Run dict_parser(inner) on the contents of a file without loading the whole file.
+
+    The file is read in chunks and each entry of the top level object is decoded and handed to
+    inner on its own, so only one raw entry is held in memory at a time. Malformed json fails
+    with the same message json.loads gives for the whole file. If the file does not contain an
+    object this falls back to run_parser_file.
+
+    Args:
+        filename: The file to parse
+        inner: The parser to use on each value in the top level object
+        chunk_size: The number of characters to read at a time
+
+    Returns:
+        The parsed dictionary, or the first failure
+    """
+    try:
+        with open_text(filename) as handle:
+            stream = _JsonStream(handle, chunk_size)
+            if stream.peek() == "{":
+                out = dict() # type: Dict[str, A]
+                for key, value in stream.entries():
+                    parsed = inner(value)
+                    if parsed.is_err:
+                        return Err(str(cast(ParseError, parsed._value).at(key))) # pylint: disable=protected-access
+                    out[key] = cast(A, parsed._value) # pylint: disable=protected-access
+                return Ok(out)
+    except OSError as exn:
+        return Err(str(exn))
+    except ValueError as exn:
+        return Err(str(exn))
+    # anything else is not a dictionary, and the whole file is needed to say why
+    return run_parser_file(filename, dict_parser(inner))
+
+
+class _JsonStream(object): # pylint: disable=too-many-instance-attributes
+    """ Incrementally decodes the entries of a json object read from a file handle. """
+    def __init__(self, handle: IO[str], chunk_size: int) -> None:
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        # number of characters and lines dropped from the front of the buffer, and the offset of
+        # the last line that started in them, so errors give positions in the file
+        self._dropped = 0
+        self._dropped_lines = 0
+        self._line_start = 0
+        # position in the buffer that must be kept when it is refilled, if any
+        self._mark = None # type: Optional[int]
+        self._eof = False
+
+    def _fill(self) -> None:
+        """ Read another chunk, dropping the part of the buffer that has been consumed. """
+        chunk = self._handle.read(self._chunk_size)
+        drop = self._pos if self._mark is None else min(self._mark, self._pos)
+        newlines = self._buf.count("\n", 0, drop)
+        if newlines:
+            self._dropped_lines += newlines
+            self._line_start = self._dropped + self._buf.rfind("\n", 0, drop) + 1
+        self._buf = self._buf[drop:] + chunk
+        self._dropped += drop
+        self._pos -= drop
+        if self._mark is not None:
+            self._mark -= drop
+        self._eof = not chunk
+
+    def peek(self) -> str:
+        """ Skip whitespace and return the next character, or "" at the end of the file. """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buf) or self._eof:
+                return self._buf[self._pos:self._pos + 1]
+            self._fill()
+
+    def error(self, msg: str, pos: Optional[int] = None) -> ValueError:
+        """ An error at a position in the buffer, by default the current one, given as json does.
+
+        The message has the same form as a json.JSONDecodeError for the whole file.
+        """
+        pos = self._pos if pos is None else pos
+        line = self._dropped_lines + self._buf.count("\n", 0, pos) + 1
+        last_newline = self._buf.rfind("\n", 0, pos)
+        column = pos - last_newline if last_newline >= 0 else \
+            self._dropped + pos - self._line_start + 1
+        return ValueError("{}: line {} column {} (char {})".format(
+            msg, line, column, self._dropped + pos))
+
+    def expect(self, char: str, msg: str) -> None:
+        """ Consume a character or fail with the message json gives when it is missing. """
+        if self.peek() != char:
+            raise self.error(msg)
+        self._pos += 1
+
+    def value(self) -> Any:
+        """ Decode the next json value. """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a value touching the end of the buffer may have been cut short
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as exn:
+                if self._eof:
+                    raise self.error(exn.msg, exn.pos)
+            self._fill()
+
+    def key(self) -> str:
+        """ Decode the key of the next entry. """
+        if self.peek() != '"':
+            raise self.error("Expecting property name enclosed in double quotes")
+        return cast(str, self.value())
+
+    def entries(self) -> Iterator[Tuple[str, Any]]:
+        """ Iterate over the key value pairs of the object starting at the current position. """
+        self.expect("{", "Expecting value")
+        if self.peek() == "}":
+            self._pos += 1
+        else:
+            while True:
+                key = self.key()
+                self.expect(":", "Expecting ':' delimiter")
+                yield key, self.value()
+                char = self.peek()
+                self._pos += 1
+                if char == "}":
+                    break
+                if char != ",":
+                    raise self.error("Expecting ',' delimiter", self._pos - 1)
+                # json only names a trailing comma from python 3.13
+                if sys.version_info >= (3, 13):
+                    self._mark = self._pos - 1
+                    if self.peek() == "}":
+                        raise self.error("Illegal trailing comma before end of object",
+                                         self._mark)
+                    self._mark = None
+        if self.peek() != "":
+            raise self.error("Extra data")
+
+
 def run_parser(raw: str, parser: "Parser[A]") -> Result[str, A]:
     """ Run a parser on some raw string. """
     try:
         data = json.loads(raw)
-        return parser(data)
     except ValueError as exn:
         return Err(str(exn))
+    return parser(data).map_err(str)
 
 
 def dict_parser(inner: "Parser[A]") -> "Parser[Dict[str, A]]":
     """ Parse a dictionary. """
-    def parse_item(item: Tuple[Any, Any]) -> Result[str, Tuple[str, A]]:
-        """Makes sure the key is a string, then parses the value"""
-        key, value = item
-        return str_parser(key).bind(lambda k: inner(value).fmap(lambda v: (k, v))) # pylint: disable=undefined-variable
-
-    def out(obj: Any) -> Result[str, Dict[str, A]]: # pylint: disable=missing-docstring
+    def out(obj: Any) -> Result[ParseError, Dict[str, A]]: # pylint: disable=missing-docstring
         if isinstance(obj, dict):
-            pairs = map_m(parse_item, obj.items()) # type: Result[str, List[Tuple[str, A]]]
-            return pairs.fmap(lambda ps: {k: v for (k, v) in ps})
+            parsed = dict() # type: Dict[str, A]
+            for key, value in obj.items():
+                if not isinstance(key, str):
+                    return bad_type(str, key)
+                item = inner(value)
+                if item.is_err:
+                    return Err(cast(ParseError, item._value).at(key)) # pylint: disable=protected-access
+                parsed[key] = cast(A, item._value) # pylint: disable=protected-access
+            return Ok(parsed)
         else:
             return bad_type(dict, obj)
 
@@ -52,9 +312,15 @@ def dict_parser(inner: "Parser[A]") -> "Parser[Dict[str, A]]":
 
 def list_parser(inner: "Parser[A]") -> "Parser[List[A]]":
     """ Parse a list. """
-    def out(obj: Any) -> Result[str, List[A]]: # pylint: disable=missing-docstring
+    def out(obj: Any) -> Result[ParseError, List[A]]: # pylint: disable=missing-docstring
         if isinstance(obj, list):
-            return map_m(inner, obj)
+            parsed = [] # type: List[A]
+            for index, value in enumerate(obj):
+                item = inner(value)
+                if item.is_err:
+                    return Err(cast(ParseError, item._value).at(index)) # pylint: disable=protected-access
+                parsed.append(cast(A, item._value)) # pylint: disable=protected-access
+            return Ok(parsed)
         else:
             return bad_type(list, obj)
 
@@ -71,7 +337,7 @@ def optional_parser(inner: "Parser[A]") -> "Parser[Optional[A]]":
         """Pure for option"""
         return obj
 
-    def out(obj: Any) -> Result[str, Optional[A]]:
+    def out(obj: Any) -> Result[ParseError, Optional[A]]:
         """The parser to return"""
         if obj is None:
             return Ok(None)
@@ -102,19 +368,71 @@ def field(name: str, parser: "Parser[A]", other_fields: Callable[[A], "Parser[B]
     Returns:
         An object parser
     """
-    def out(obj: Any) -> Result[str, B]:
+    def out(obj: Any) -> Result[ParseError, B]:
         """The parser to return"""
         if isinstance(obj, dict):
             if name in obj:
-                return parser(obj[name]).bind(lambda parsed: other_fields(parsed)(obj))
+                return parser(obj[name]).map_err(lambda err: err.at(name))\
+                                        .bind(lambda parsed: other_fields(parsed)(obj))
             else:
-                return Err("Missing field {} in {}".format(name, obj))
+                return Err(MissingField(name, obj))
         else:
             return bad_type(dict, obj)
 
     return out
 
 
+def record_parser(fields: Dict[str, "Parser[Any]"],
+                  build: Callable[..., A],
+                  defaults: Optional[Dict[str, Any]] = None) -> "Parser[A]":
+    """Parse an object with a fixed set of fields.
+
+    The field specification is compiled once into a single flat parser, so parsing an object does
+    not allocate a chain of nested parsers the way field and done do. Each parsed field is passed
+    to build as a keyword argument.
+
+    Example:
+        >>> pair_parser = record_parser({"name": str_parser, "number": int_parser},
+        ...                             lambda name, number: (name, number))
+        >>> run_parser('{"name": "Bob", "number": 42}', pair_parser)
+        Ok(('Bob', 42))
+        >>> counted_parser = record_parser({"name": str_parser, "number": int_parser},
+        ...                                lambda name, number: (name, number), {"number": 0})
+        >>> run_parser('{"name": "Bob"}', counted_parser)
+        Ok(('Bob', 0))
+
+    Args:
+        fields: A map from field names to the parsers to use on them
+        build: Constructs the result from the parsed fields
+        defaults: Values to use for fields that may be left out of the object. The same default
+            object is passed to every call of build
+
+    Returns:
+        An object parser
+    """
+    compiled = tuple(fields.items())
+    missing = defaults if defaults is not None else dict() # type: Dict[str, Any]
+
+    def out(obj: Any) -> Result[ParseError, A]:
+        """The parser to return"""
+        if not isinstance(obj, dict):
+            return bad_type(dict, obj)
+        parsed = dict() # type: Dict[str, Any]
+        for name, parser in compiled:
+            if name not in obj:
+                if name in missing:
+                    parsed[name] = missing[name]
+                    continue
+                return Err(MissingField(name, obj))
+            value = parser(obj[name])
+            if value.is_err:
+                return Err(cast(ParseError, value._value).at(name)) # pylint: disable=protected-access
+            parsed[name] = value._value # pylint: disable=protected-access
+        return Ok(build(**parsed))
+
+    return out
+
+
 def done(result: A) -> "Parser[A]":
     """Finish parsing an object.
 
@@ -127,21 +445,21 @@ def done(result: A) -> "Parser[A]":
     Returns:
         A parser that always returns result
     """
-    def parser(_: Any) -> Result[str, A]:
+    def parser(_: Any) -> Result[ParseError, A]:
         """The constant parser"""
         return Ok(result)
 
     return parser
 
 
-def bad_type(expected: Any, result: Any) -> Result[str, A]:
-    """ Fail with a type error message. """
-    return Err("Expecting {}, but got {} in '{}'".format(expected, result.__class__, result))
+def bad_type(expected: Any, result: Any) -> Result[ParseError, A]:
+    """ Fail with a type error. The message is not rendered until it is needed. """
+    return Err(TypeMismatch(expected, result))
 
 
 def leaf_parser(t: type) -> Parser:
     """ Generic parser for json leaves. """
-    def parser(obj: Any) -> Result[str, Any]: # pylint: disable=missing-docstring
+    def parser(obj: Any) -> Result[ParseError, Any]: # pylint: disable=missing-docstring
         if isinstance(obj, t):
             return Ok(obj)
         else:
@@ -156,7 +474,7 @@ float_parser = leaf_parser(float) # type: Parser[float]
 bool_parser = leaf_parser(bool) # type: Parser[bool]
 
 
-def none_parser(obj: Any) -> Result[str, None]:
+def none_parser(obj: Any) -> Result[ParseError, None]:
     """ Parse none. """
     if obj is None:
         return Ok(obj)
@@ -3,16 +3,21 @@
 import os
 import argparse
 import datetime
-from typing import Optional, Union, cast, List, Any, Dict
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional, Union, cast, Callable, Iterator, List, Any, Dict, Tuple
 
 import base64
 import email
+import email.parser
+import email.utils
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import httplib2
-from apiclient import discovery
-from oauth2client import client, tools
-from oauth2client.file import Storage
+from email.header import Header, decode_header
 
 from result import Result, Ok, Err, from_exception
 
@@ -21,75 +26,432 @@ from result import Result, Ok, Err, from_exception
 SCOPES = 'https://www.googleapis.com/auth/gmail.modify'
 CLIENT_SECRET_FILE = 'mail_secret.json'
 APPLICATION_NAME = 'Weekly Programming Problem'
+SENDER = "RoboTobo <tobin.spam@gmail.com>"
+# The most requests gmail accepts in a single http batch request
+BATCH_LIMIT = 100
+# Sending costs 100 of the 250 quota units each user gets per second
+SEND_RATE = 2.5
+SEND_BURST = 5
+# Retries for rate limited sends, and the first delay between them in seconds
+RETRIES = 5
+BACKOFF_START = 1.0
+
+# Where the gmail discovery document is fetched from, the file it is cached
+# in, and how many seconds the cached copy is used for
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest"
+DISCOVERY_CACHE = "gmail-discovery.json"
+DISCOVERY_MAX_AGE = 7 * 24 * 60 * 60
+
+# Access tokens that expire within this long are refreshed before use
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Most lines and characters of a message that are quoted in a reply to it
+QUOTE_LINES = 200
+QUOTE_CHARS = 64 * 1024
 
 Message = email.message.Message
 
-def get_credentials(flags: argparse.Namespace) -> Any:
+
+class RawMessage(object):
+    """ A message that has already been rendered to RFC 822 bytes. """
+    def __init__(self, raw: bytes) -> None:
+        self._raw = raw
+
+    def as_bytes(self) -> bytes:
+        """ The rendered message. """
+        return self._raw
+
+
+Outgoing = Union[MIMEText, Message, RawMessage]
+
+
+class LazyMessage(object):
+    """ A received message whose body is only parsed when it is needed.
+
+        The headers are parsed up front, which is all most commands look at. A single part body
+        is already complete after that, so only multipart messages are ever parsed a second time.
+    """
+    def __init__(self, raw: bytes) -> None:
+        self._raw = raw
+        self._headers = _HEADER_PARSER.parsebytes(raw)
+        self._parsed = None # type: Optional[Message]
+        self._text = None # type: Optional[Result[str, str]]
+
+    def __getitem__(self, name: str) -> Optional[str]:
+        return cast(Optional[str], _header_text(self._headers[name]))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._headers
+
+    def get(self, name: str, failobj: Any = None) -> Any:
+        """ Gets a header, or failobj if the header is missing. """
+        return _header_text(self._headers.get(name, failobj))
+
+    def keys(self) -> List[str]:
+        """ The names of all the headers. """
+        return self._headers.keys()
+
+    def get_content_type(self) -> str:
+        """ The content type of the message as a whole. """
+        return self._headers.get_content_type()
+
+    def message(self) -> Message:
+        """ The fully parsed message. """
+        if self._parsed is None:
+            if self._headers.get_content_maintype() != "multipart":
+                self._parsed = self._headers
+            else:
+                self._parsed = email.message_from_bytes(self._raw)
+        return self._parsed
+
+    def text_content(self) -> Result[str, str]:
+        """ The plain text content of the message, decoded once. """
+        if self._text is None:
+            self._text = _text_content(self.message())
+        return self._text
+
+
+Incoming = Union[Message, LazyMessage]
+
+
+def _header_text(value: Any) -> Any:
+    """ Decodes a header sent as raw utf-8, which the parser leaves as undecoded bytes. """
+    if not isinstance(value, Header):
+        return value
+    return "".join(part.decode("utf-8" if charset in (None, "unknown-8bit") else charset, "replace")
+                   if isinstance(part, bytes) else part
+                   for (part, charset) in decode_header(value))
+
+_HEADER_PARSER = email.parser.BytesHeaderParser()
+
+# Credentials and the discovery document, shared by every service built in this process
+_SERVICE_STATE = dict() # type: Dict[str, Any]
+_SERVICE_LOCK = threading.Lock()
+# The http connection and service of each thread
+_THREAD_STATE = threading.local()
+
+_DATE_PARSER = from_exception(email.utils.parsedate_to_datetime, (TypeError, ValueError), str)
+
+def credential_dir() -> str:
+    """ The directory credentials and the cached discovery document are kept in. """
+    directory = os.path.join(os.path.expanduser('~'), '.credentials')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+def get_credentials() -> Any:
     """Gets valid user credentials from storage.
 
     If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
+    the OAuth2 flow is completed to obtain the new credentials. The command
+    line is only parsed for the flow's flags when the flow has to run.
 
     Returns:
         Credentials, the obtained credential.
     """
-    home_dir = os.path.expanduser('~')
-    credential_dir = os.path.join(home_dir, '.credentials')
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
-    credential_path = os.path.join(credential_dir,
-                                   'gmail-python.json')
+    from oauth2client import client, tools
+    from oauth2client.file import Storage
+
+    credential_path = os.path.join(credential_dir(), 'gmail-python.json')
 
     store = Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid:
+        flags, _ = argparse.ArgumentParser(parents=[tools.argparser]).parse_known_args()
         flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
         flow.user_agent = APPLICATION_NAME
         credentials = tools.run_flow(flow, store, flags)
         print('Storing credentials to ' + credential_path)
     return credentials
 
+def _shared_credentials() -> Any:
+    """ Loads the credentials once per process, refreshing them if they are
+        about to expire so every thread does not refresh them separately.
+    """
+    with _SERVICE_LOCK:
+        if _SERVICE_STATE.get("credentials") is None:
+            _SERVICE_STATE["credentials"] = get_credentials()
+        credentials = _SERVICE_STATE["credentials"]
+        expiry = credentials.token_expiry
+        if expiry is not None and expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+            credentials.refresh(_thread_http())
+        return credentials
+
+def _thread_http() -> Any:
+    """ The unauthorized http connection for this thread, which keeps its
+        connections open between requests. It is used to fetch the discovery
+        document and refresh the credentials, and is never authorized itself,
+        since authorizing an Http wraps its request method in place.
+        An Http must not be shared between threads.
+    """
+    http = getattr(_THREAD_STATE, "http", None)
+    if http is None:
+        import httplib2
+        http = httplib2.Http()
+        _THREAD_STATE.http = http
+    return http
+
+def discovery_document(http: Any) -> str:
+    """ Gets the gmail discovery document, from a local copy if it is recent
+        enough and from google otherwise.
+    """
+    with _SERVICE_LOCK:
+        document = _SERVICE_STATE.get("discovery")
+        if document is not None:
+            return cast(str, document)
+        path = os.path.join(credential_dir(), DISCOVERY_CACHE)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < DISCOVERY_MAX_AGE:
+            with open(path) as handle:
+                document = handle.read()
+        else:
+            response, content = http.request(DISCOVERY_URL)
+            if response.status >= 400:
+                raise IOError("Could not fetch the gmail discovery document: {}".format(
+                    response.status))
+            document = content.decode("utf-8")
+            with open(path + ".tmp", "w") as handle:
+                handle.write(document)
+            os.replace(path + ".tmp", path)
+        _SERVICE_STATE["discovery"] = document
+        return document
+
 def init_service() -> Any:
-    """ Builds the gmail service. """
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-    credentials = get_credentials(flags)
-    http = credentials.authorize(httplib2.Http())
-    return discovery.build('gmail', 'v1', http=http)
+    """ Gets the gmail service for this thread, building it the first time.
+
+        The credentials and discovery document are loaded once and shared. Each
+        thread builds its service once, on its own authorized http connection,
+        and later calls only refresh the credentials if they are about to expire.
+    """
+    credentials = _shared_credentials()
+    service = getattr(_THREAD_STATE, "service", None)
+    if service is None:
+        import httplib2
+        from apiclient import discovery
+        document = discovery_document(_thread_http())
+        service = discovery.build_from_document(document,
+                                                http=credentials.authorize(httplib2.Http()))
+        _THREAD_STATE.service = service
+    return service
+
+
+class ServicePool(object):
+    """ Gives each thread its own service, since a service must not be shared
+        between threads.
+    """
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        self._factory = factory
+        self._local = threading.local()
+
+    def get(self) -> Any:
+        """ Gets the service for the current thread, building it if needed. """
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._factory()
+            self._local.service = service
+        return service
+
 
-def get_message(service: Any, user_id: str, msg_id: str) -> Message:
+class TokenBucket(object):
+    """ A thread safe token bucket rate limiter.
+
+        Tokens are added at a steady rate up to a maximum burst, and each
+        request takes one token, waiting for it if none are available.
+    """
+    def __init__(self,
+                 rate: float,
+                 burst: int,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Takes a token, blocking until one is available. """
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            self._sleep(wait)
+
+
+def should_retry(exn: Exception) -> bool:
+    """ Checks if a failed request was rate limited or hit a server error. """
+    status = getattr(getattr(exn, "resp", None), "status", None)
+    return status is not None and (int(status) == 429 or int(status) >= 500)
+
+def send_with_retry(service: Any,
+                    user_id: str,
+                    msg: Outgoing,
+                    bucket: Optional[TokenBucket] = None,
+                    retries: int = RETRIES,
+                    sleep: Callable[[float], None] = time.sleep) -> Result[str, Dict[str, Any]]:
+    """ Sends a message, backing off exponentially if gmail is overloaded.
+
+        Args:
+            bucket: Limits the rate of send requests, including retries
+            retries: The number of times to retry a rate limited or server error
+            sleep: Waits for the given number of seconds between retries
+    """
+    delay = BACKOFF_START
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return Ok(send(service, user_id, msg))
+        except Exception as exn: # pylint: disable=broad-except
+            if attempt == retries or not should_retry(exn):
+                return Err(str(exn))
+        sleep(delay * random.uniform(1, 2))
+        delay *= 2
+    return Err("Out of retries")
+
+def get_message(service: Any, user_id: str, msg_id: str) -> LazyMessage:
     """ Gets a message using the given client. """
-    result = service.users().messages().get(userId=user_id,
-                                            id=msg_id,
-                                            format="raw").execute()
+    return decode_message(get_request(service, user_id, msg_id).execute())
+
+def get_request(service: Any, user_id: str, msg_id: str) -> Any:
+    """ Builds the request that gets a message in raw format. """
+    return service.users().messages().get(userId=user_id, id=msg_id, format="raw")
+
+def decode_message(result: Dict[str, Any]) -> LazyMessage:
+    """ Parses the headers of the message in the response to a raw get request. """
     msg_str = base64.urlsafe_b64decode(result["raw"].encode("ASCII"))
-    return email.message_from_bytes(msg_str)
+    return LazyMessage(msg_str)
 
 def send(service: Any,
          user_id: str,
-         msg: Union[MIMEText, Message],
+         msg: Outgoing,
          thread_id: Optional[str] = None) -> Dict[str, Any]:
     """ Sends the given message. """
+    result = send_request(service, user_id, msg, thread_id).execute() # type: Dict[str, Any]
+    return result
+
+def send_request(service: Any,
+                 user_id: str,
+                 msg: Outgoing,
+                 thread_id: Optional[str] = None) -> Any:
+    """ Builds the request that sends the given message. """
     as_bytes = {"raw": base64.urlsafe_b64encode(msg.as_bytes()).decode("ASCII")}
     if thread_id is not None:
         as_bytes["threadId"] = thread_id
-    # print("Sending {}".format(as_bytes))
-    result = service.users().messages().send(userId=user_id,
-                                             body=as_bytes).execute() # type: Dict[str, Any]
-    # print("Sent message with id: {}".format(result["id"]))
-    return result
+    return service.users().messages().send(userId=user_id, body=as_bytes)
 
 def trash(service: Any, user_id: str, msg_id: str) -> Any:
     """ Puts the given message in the trash. """
-    return service.users().messages().trash(userId=user_id, id=msg_id).execute()
+    return trash_request(service, user_id, msg_id).execute()
 
-def list_messages(service: Any, user_id: str, labels: str = "INBOX") -> Any:
-    """ Gets a messages for the given user.
-        By default gets messages in the inbox.
-    """
-    return service.users().messages().list(userId=user_id, labelIds=labels).execute()
+def trash_request(service: Any, user_id: str, msg_id: str) -> Any:
+    """ Builds the request that puts the given message in the trash. """
+    return service.users().messages().trash(userId=user_id, id=msg_id)
+
+def execute_batch(service: Any, requests: List[Any]) -> List[Result[str, Any]]:
+    """ Executes requests using as few http batch requests as possible.
 
+        Requests are split into batches of at most BATCH_LIMIT. A request that
+        fails does not affect the others in its batch.
 
-def get_address(msg: Message) -> Result[str, str]:
+        Returns:
+            The response to each request, in the same order as the requests
+    """
+    results = [Err("No response") for _ in requests] # type: List[Result[str, Any]]
+
+    def store(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+        """ Batch callback that records the result of one request. """
+        index = int(request_id)
+        if exception is None:
+            results[index] = Ok(response)
+        else:
+            results[index] = Err(str(exception))
+
+    for start in range(0, len(requests), BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=store)
+        for index in range(start, min(start + BATCH_LIMIT, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        batch.execute()
+    return results
+
+def get_messages(service: Any, user_id: str, msg_ids: List[str]) -> List[Result[str, LazyMessage]]:
+    """ Gets many messages using batch requests. """
+    responses = execute_batch(service, [get_request(service, user_id, msg_id)
+                                        for msg_id in msg_ids])
+    return [response.fmap(decode_message) for response in responses]
+
+def send_all(service: Any,
+             user_id: str,
+             messages: List[Tuple[Outgoing, Optional[str]]]
+            ) -> List[Result[str, Dict[str, Any]]]:
+    """ Sends many messages using batch requests.
+
+        Args:
+            messages: Each message to send paired with the thread it belongs to
+    """
+    return execute_batch(service, [send_request(service, user_id, msg, thread_id)
+                                   for (msg, thread_id) in messages])
+
+def trash_all(service: Any, user_id: str, msg_ids: List[str]) -> List[Result[str, Any]]:
+    """ Puts many messages in the trash using batch requests. """
+    return execute_batch(service, [trash_request(service, user_id, msg_id)
+                                   for msg_id in msg_ids])
+
+def list_messages(service: Any,
+                  user_id: str,
+                  labels: str = "INBOX",
+                  query: Optional[str] = None,
+                  max_results: Optional[int] = None,
+                  page_token: Optional[str] = None) -> Any:
+    """ Gets a page of messages for the given user.
+        By default gets messages in the inbox.
+    """
+    kwargs = {"userId": user_id, "labelIds": labels} # type: Dict[str, Any]
+    if query is not None:
+        kwargs["q"] = query
+    if max_results is not None:
+        kwargs["maxResults"] = max_results
+    if page_token is not None:
+        kwargs["pageToken"] = page_token
+    return service.users().messages().list(**kwargs).execute()
+
+def iter_messages(service: Any,
+                  user_id: str,
+                  labels: str = "INBOX",
+                  query: Optional[str] = None,
+                  max_results: Optional[int] = None) -> Iterator[Dict[str, str]]:
+    """ Lazily yields the id and thread id of every matching message.
+
+        Follows nextPageToken through all pages. The next page is fetched on a
+        background thread while the current one is being consumed, so only two
+        pages are held at a time.
+
+        Args:
+            labels: Only yield messages with these labels
+            query: A gmail search query to filter messages by
+            max_results: The number of messages to ask for in each page
+    """
+    def fetch(token: Optional[str]) -> Any:
+        """ Fetch the page with the given token. """
+        return list_messages(service, user_id, labels, query, max_results, token)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        page = fetch(None)
+        while True:
+            token = page.get("nextPageToken")
+            upcoming = prefetcher.submit(fetch, token) if token else None
+            yield from page.get("messages", [])
+            if upcoming is None:
+                return
+            page = upcoming.result()
+
+def get_address(msg: Incoming) -> Result[str, str]:
     """ Extracts the addr-spec part from a mailbox. See RFC-822 for details. """
     address = msg["From"]
     if address is None:
@@ -99,21 +461,22 @@ def get_address(msg: Message) -> Result[str, str]:
     else:
         return Ok(address)
 
-def get_text_content(msg: Union[Message, MIMEText]) -> Result[str, str]:
-    """ Gets the plain text content of a MIME message if it exists.
-        If there is no plain text content then the result is None.
-    """
-    if msg.get_content_type() == "text/plain":
-        payload = cast(bytes, msg.get_payload(decode=True))
-        return Ok(payload.decode(msg.get_content_charset()))
-    elif msg.get_content_type() == "multipart/alternative":
-        for part in cast(List[Message], msg.get_payload()):
-            content = get_text_content(part)
-            if content.is_ok:
-                return content
-        return Err("No text/plain alternative found")
-    else:
-        return Err("Unknown content type: {}".format(msg.get_content_type()))
+def get_text_content(msg: Incoming) -> Result[str, str]:
+    """ Gets the first plain text part of a MIME message if it has one.
+        Multipart messages are searched however deeply they are nested, skipping attachments.
+    """
+    if isinstance(msg, LazyMessage):
+        return msg.text_content()
+    return _text_content(msg)
+
+def _text_content(tree: Message) -> Result[str, str]:
+    """ Finds the first plain text part of a parsed message. """
+    for part in tree.walk():
+        if part.get_content_type() == "text/plain" and \
+                part.get("Content-Disposition", "").split(";")[0].strip().lower() != "attachment":
+            payload = cast(bytes, part.get_payload(decode=True))
+            return Ok(payload.decode(part.get_content_charset() or "utf-8", "replace"))
+    return Err("No text/plain content in a {} message".format(tree.get_content_type()))
 
 
 def make_message(body: str,
@@ -125,7 +488,7 @@ def make_message(body: str,
     message = MIMEText(body, subtype)
     message["Subject"] = subject
     message["To"] = recipient
-    message["From"] = "RoboTobo <tobin.spam@gmail.com>"
+    message["From"] = SENDER
     for key, value in other_headers.items():
         message[key] = value
     return message
@@ -143,32 +506,135 @@ def make_html_message(body: str,
     message = MIMEMultipart("alternative")
     message["Subject"] = subject
     message["To"] = recipient
-    message["From"] = "RoboTobo <tobin.spam@gmail.com>"
+    message["From"] = SENDER
     for key, value in other_headers.items():
         message[key] = value
     message.attach(MIMEText(clean(body), "plain"))
     message.attach(MIMEText(body, "html"))
     return message
 
-def quote(message: Message) -> Result[str, str]:
+class _SplicedBody(object):
+    """ A base64 encoded utf-8 body with a gap for some text, mostly encoded
+        ahead of time.
+
+        The text before the gap is encoded once up to a multiple of three bytes,
+        and the text after the gap is encoded once for each of the three ways
+        it can line up with base64 groups, so filling the gap only encodes the
+        gap itself and a few bytes around it.
+    """
+    def __init__(self, before: str, after: str) -> None:
+        before_bytes = before.encode("utf-8")
+        cut = len(before_bytes) - len(before_bytes) % 3
+        self._head = base64.b64encode(before_bytes[:cut])
+        self._carry = before_bytes[cut:]
+        self._after = after.encode("utf-8")
+        self._tails = [base64.b64encode(self._after[skip:]) for skip in range(3)]
+
+    def encode(self, fill: str) -> bytes:
+        """ Encode the body with the gap filled, split into 76 character lines. """
+        middle = self._carry + fill.encode("utf-8")
+        take = min(-len(middle) % 3, len(self._after))
+        encoded = self._head + base64.b64encode(middle + self._after[:take]) + self._tails[take]
+        return b"\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+class HtmlTemplate(object):
+    """ An html message, like the ones from make_html_message, with a gap in
+        its subject and body that is filled in for each recipient.
+
+        Everything that does not depend on the recipient or the gap is rendered
+        and encoded once, and render splices the rest into raw message bytes.
+    """
+    def __init__(self,
+                 subject_before: str,
+                 subject_after: str,
+                 body_before: str,
+                 body_after: str) -> None:
+        self._subject = (subject_before, subject_after)
+        self._html = _SplicedBody(body_before, body_after)
+        plain = (clean(body_before), clean(body_after))
+        self._plain = (self._html if plain == (body_before, body_after)
+                       else _SplicedBody(plain[0], plain[1]))
+        boundary = "===============" + str(random.randrange(sys.maxsize)) + "=="
+        self._top = ('Content-Type: multipart/alternative; boundary="{}"\n'
+                     'MIME-Version: 1.0\n').format(boundary).encode("ascii")
+        part = ('--{}\nContent-Type: text/{{}}; charset="utf-8"\nMIME-Version: 1.0\n'
+                'Content-Transfer-Encoding: base64\n\n').format(boundary)
+        self._plain_head = part.format("plain").encode("ascii")
+        self._html_head = part.format("html").encode("ascii")
+        self._end = "\n--{}--\n".format(boundary).encode("ascii")
+
+    def render(self, recipient: str, fill: str) -> RawMessage:
+        """ Builds the message for a recipient with the gap filled. """
+        subject = self._subject[0] + fill + self._subject[1]
+        # the recipient is not trusted to be ascii, so it is encoded like the subject
+        headers = "".join([_header("Subject", subject), _header("To", recipient),
+                           _header("From", SENDER), "\n"])
+        html = self._html.encode(fill)
+        plain = html if self._plain is self._html else self._plain.encode(fill)
+        return RawMessage(b"".join([self._top, headers.encode("ascii"),
+                                    self._plain_head, plain, b"\n",
+                                    self._html_head, html, self._end]))
+
+@lru_cache(maxsize=1024)
+def parse_date(header: str) -> Result[str, datetime.datetime]:
+    """ Parses an RFC 2822 date header, remembering recent headers. """
+    return _DATE_PARSER(header)
+
+def quoted_lines(content: str,
+                 max_lines: Optional[int] = QUOTE_LINES,
+                 max_chars: Optional[int] = QUOTE_CHARS) -> Iterator[str]:
+    """ Quotes text a line at a time, stopping after max_lines lines or
+        max_chars characters of content, even in the middle of a line. Text
+        past the limits is not read.
+    """
+    start = 0
+    count = 0
+    while start < len(content):
+        if (max_lines is not None and count >= max_lines or
+                max_chars is not None and start >= max_chars):
+            yield "> [...]"
+            return
+        # the search for the end of the line stops just past the character limit
+        limit = len(content) if max_chars is None else min(len(content), max_chars + 1)
+        end = content.find("\n", start, limit)
+        end = len(content) if end == -1 else end
+        if max_chars is not None and end > max_chars:
+            # a single long line is cut off at the limit too
+            yield "> " + content[start:max_chars]
+            yield "> [...]"
+            return
+        yield "> " + content[start:end].rstrip("\r")
+        start = end + 1
+        count += 1
+
+def quote(message: Incoming,
+          max_lines: Optional[int] = QUOTE_LINES,
+          max_chars: Optional[int] = QUOTE_CHARS) -> Result[str, str]:
     """ Quote the text from a message for a reply. """
     if message["Date"] is None:
         return Err("Message has no Date header")
 
-    date_parser = from_exception(datetime.datetime.strptime, ValueError, str)
-    date = date_parser(message["Date"], "%a, %d %b %Y %X %z")
-    date_str = date.fmap(lambda d: d.strftime("%a, %b %d, %Y at %I:%M %p"))
-
-    content = get_text_content(message)
+    date_str = parse_date(message["Date"]).fmap(
+        lambda d: d.strftime("%a, %b %d, %Y at %I:%M %p"))
 
     def from_content(content_str: str, date_prefix: str) -> str: # pylint: disable=C0111
-        quoted = "\r\n".join("> " + line for line in content_str.split("\r\n"))
+        quoted = "\r\n".join(quoted_lines(content_str, max_lines, max_chars))
         return "On {} {} wrote:\r\n\r\n{}\r\n".format(date_prefix, message["From"], quoted)
 
-    return date_str.bind(lambda d: content.fmap(lambda c: from_content(c, d))) # pylint: disable=E0602
+    return date_str.bind(lambda d: get_text_content(message).fmap(lambda c: from_content(c, d))) # pylint: disable=E0602
+
+def _unfold(header: str) -> str:
+    """ Joins a folded header back into one line. """
+    return "".join(header.splitlines()).strip()
 
-def make_reply(message: Message, body: str) -> Result[str, MIMEText]:
-    """ Create a message in reply to another message. """
+def _header(name: str, value: str) -> str:
+    """ Renders a header line, encoding the value if it is not ascii. """
+    if all(ord(char) < 128 for char in value):
+        return "{}: {}\n".format(name, value)
+    return "{}: {}\n".format(name, Header(value, "utf-8", header_name=name).encode())
+
+def make_reply(message: Incoming, body: str) -> Result[str, Outgoing]:
+    """ Create a message in reply to another message, rendered straight to bytes. """
     recipient = message.get("Reply-To", failobj=message["From"])
     message_id = message["Message-ID"]
     orig_subject = message["Subject"]
@@ -181,15 +647,24 @@ def make_reply(message: Message, body: str) -> Result[str, MIMEText]:
     if orig_subject is None:
         return Err("Message has no Subject header")
 
+    orig_subject = _unfold(orig_subject)
     subject = orig_subject if "Re: " in orig_subject else "Re: " + orig_subject
 
-    refs = message.get("References", failobj="") + " " + message_id
+    refs = _unfold(message.get("References", failobj="")) + " " + _unfold(message_id)
     refs = refs.strip() # remove the leading space if the get failed
 
     quoted = quote(message).extract(lambda _: "", lambda q: q)
-
-    return Ok(make_message(body="{}\r\n\r\n{}".format(body, quoted),
-                           subject=subject,
-                           recipient=recipient,
-                           **{"In-Reply-To": message_id,
-                              "References": refs}))
+    text = "{}\r\n\r\n{}".format(body, quoted).encode("utf-8")
+    encoded = base64.encodebytes(text)
+
+    headers = "".join([
+        'Content-Type: text/plain; charset="utf-8"\n'
+        "MIME-Version: 1.0\n"
+        "Content-Transfer-Encoding: base64\n",
+        _header("Subject", subject),
+        _header("To", _unfold(recipient)),
+        "From: {}\n".format(SENDER),
+        "In-Reply-To: {}\n".format(_unfold(message_id)),
+        _header("References", refs),
+        "\n"])
+    return Ok(RawMessage(headers.encode("ascii") + encoded))
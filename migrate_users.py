@@ -0,0 +1,38 @@
+"""Moves the user state from the json file into the sqlite user store"""
+
+import sys
+
+from mypy_extensions import NoReturn
+
+from user import load_users
+import userstore
+
+
+def throw(exn: BaseException) -> NoReturn:
+    """Turn raise into an expression"""
+    raise exn
+
+
+def main(json_path: str, db_path: str) -> None:
+    """Main function to run if this file is run as a script"""
+    users = load_users(json_path).extract(
+        err_func=lambda err: throw(RuntimeError("Could not parse users: {}".format(err))),
+        ok_func=lambda u: u
+    )
+    store = userstore.open_store(db_path, create=True).extract(
+        err_func=lambda err: throw(RuntimeError("Could not open store: {}".format(err))),
+        ok_func=lambda s: s
+    )
+    try:
+        store.update(users)
+        store.tally = userstore.rebuild_tally(users.values())
+        store.save()
+    finally:
+        store.close()
+    print("Moved {} users from {} to {}".format(len(users), json_path, db_path))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        main(sys.argv[1], sys.argv[2])
+    else:
+        main("users.json", userstore.PATH)
@@ -1,20 +1,29 @@
 """ A result type like in rust. """
 
-from typing import TypeVar, Generic, Callable, Union, Any, List, Iterable, cast
+from typing import TypeVar, Generic, Callable, Union, Any, List, Dict, Iterable, cast
 
 E = TypeVar("E")
 T = TypeVar("T")
 A = TypeVar("A")
+K = TypeVar("K")
 
 
 class Result(Generic[E, T]):
     """ Result super class. Do NOT construct an instance of this by hand.
         Instead use Ok, or Err.
+
+        Instances only hold a single slot for their value. Ok and Err
+        override the combinators with direct implementations, so no closures
+        are allocated when chaining results, but the general ones here still
+        work for any other subclass.
     """
-    def __init__(self, is_ok: bool, value: Union[E, T]) -> None:
+    __slots__ = ("_value",)
+
+    is_ok = False # type: bool
+    is_err = False # type: bool
+
+    def __init__(self, value: Union[E, T]) -> None:
         self._value = value
-        self.is_ok = is_ok
-        self.is_err = not is_ok
 
     def extract(self, err_func: Callable[[E], A], ok_func: Callable[[T], A]) -> A:
         """Map both values to a single type. """
@@ -71,17 +80,68 @@ def pure(value: T) -> Result[E, T]:
 def map_m(func: Callable[[A], Result[E, T]], items: Iterable[A]) -> Result[E, List[T]]:
     """ Iterate over some input, returning a list of good results, or the first
         failure.
+
+        Results are appended into a single buffer, and iteration stops at the
+        first failure, so this runs in linear time and constant stack depth.
     """
-    out = pure([]) # type: Result[E, List[T]]
+    out = [] # type: List[T]
+    append = out.append
     for item in items:
-        out = out.bind(lambda done: func(item).fmap(lambda mapped: done + [mapped])) # pylint: disable=undefined-variable,cell-var-from-loop
-    return out
+        mapped = func(item)
+        if mapped.is_err:
+            return cast(Result[E, List[T]], mapped)
+        append(cast(T, mapped._value)) # pylint: disable=protected-access
+    return Ok(out)
+
+
+def map_m_dict(func: Callable[[A], Result[E, T]], items: Dict[K, A]) -> Result[E, Dict[K, T]]:
+    """ Map over the values of a dictionary, returning a dictionary of good
+        results with the same keys, or the first failure.
+    """
+    out = dict() # type: Dict[K, T]
+    for key, value in items.items():
+        mapped = func(value)
+        if mapped.is_err:
+            return cast(Result[E, Dict[K, T]], mapped)
+        out[key] = cast(T, mapped._value) # pylint: disable=protected-access
+    return Ok(out)
+
+
+def sequence(results: Iterable[Result[E, T]]) -> Result[E, List[T]]:
+    """ Turn an iterable of results into a result of a list, failing with the
+        first error.
+    """
+    return map_m(_identity, results)
+
+
+def _identity(value: A) -> A:
+    """ The identity function. """
+    return value
 
 
 class Ok(Result[E, T]): # pylint: disable=R0903
-    """ A result representing success. """
-    def __init__(self, value: T) -> None:
-        super().__init__(True, value)
+    """ A result representing success. Ok(None) is a shared instance. """
+    __slots__ = ()
+
+    is_ok = True
+    is_err = False
+
+    def __new__(cls, value: T) -> "Ok[E, T]":
+        if value is None and cls is Ok and _OK_NONE is not None:
+            return cast("Ok[E, T]", _OK_NONE)
+        return super().__new__(cls)
+
+    def __init__(self, value: T) -> None: # pylint: disable=useless-super-delegation
+        super().__init__(value)
+
+    def fmap(self, func: Callable[[T], A]) -> Result[E, A]:
+        return Ok(func(cast(T, self._value)))
+
+    def bind(self, cont: Callable[[T], Result[E, A]]) -> Result[E, A]:
+        return cont(cast(T, self._value))
+
+    def map_err(self, func: Callable[[E], A]) -> Result[A, T]:
+        return cast(Result[A, T], self)
 
     def __repr__(self) -> str:
         return "Ok({})".format(repr(self._value))
@@ -89,8 +149,26 @@ class Ok(Result[E, T]): # pylint: disable=R0903
 
 class Err(Result[E, T]): # pylint: disable=R0903
     """ A result representing failure. """
-    def __init__(self, value: E) -> None:
-        super().__init__(False, value)
+    __slots__ = ()
+
+    is_ok = False
+    is_err = True
+
+    def __init__(self, value: E) -> None: # pylint: disable=useless-super-delegation
+        super().__init__(value)
+
+    def fmap(self, func: Callable[[T], A]) -> Result[E, A]:
+        return cast(Result[E, A], self)
+
+    def bind(self, cont: Callable[[T], Result[E, A]]) -> Result[E, A]:
+        return cast(Result[E, A], self)
+
+    def map_err(self, func: Callable[[E], A]) -> Result[A, T]:
+        return Err(func(cast(E, self._value)))
 
     def __repr__(self) -> str:
         return "Err({})".format(repr(self._value))
+
+
+_OK_NONE = None # type: Any # pylint: disable=invalid-name
+_OK_NONE = Ok(None) # pylint: disable=invalid-name
@@ -1,5 +1,5 @@
 #!/bin/bash
 
-source_files="interface.py jsonparse.py mail.py result.py scraper.py user.py weeklysend.py"
+source_files="catalog.py interface.py jsonparse.py mail.py result.py scraper.py user.py userstore.py weeklysend.py"
 
-mypy $source_files && pylint $source_files
+mypy $source_files && pylint $source_files && python -m unittest discover -s tests
@@ -1,13 +1,17 @@
 """ Gets the weekly challenge from reddit.com/r/dailyprogrammer """
 
 import sys
+import bisect
+import itertools
 import random
+import re
 import time
-from typing import List, Dict, Callable, Iterable, TypeVar
+from functools import lru_cache
+from typing import List, Dict, TypeVar, MutableMapping, NamedTuple, Optional
 
 import praw
 
-from result import Result, Err, Ok
+from result import Result
 from jsonparse import run_parser_file, dict_parser, str_parser
 from user import User
 
@@ -15,12 +19,29 @@ VERSION = "v0.1"
 ID = "dailyprogrammer-scraper"
 AUTHOR = "/u/ToboRoboLoco"
 
+# Spellings of each level used in post titles over the years
+_LEVELS = {"easy": "Easy", "intermediate": "Intermediate", "hard": "Hard", "difficult": "Hard"}
+
+# An optional [date], then Challenge #number, possibly bracketed, then the [level] and the name
+_TITLE = re.compile(r"\s*(?:\[[^\]]*\]\s*)?\[?challenge\s*#?\s*(\d+)\]?\s*"
+                    r"[\[(]\s*({})\s*[\])]\s*:?(.*)".format("|".join(_LEVELS)),
+                    re.IGNORECASE | re.DOTALL)
+
 # pylint: disable=C0103
 
 # Yag = yagmail.SMTP
 Reddit = praw.Reddit
 Post = praw.models.reddit.submission.Submission
-Users = Dict[str, User]
+Users = MutableMapping[str, User]
+# A challenge post, parsed once when it is fetched
+ChallengePost = NamedTuple("ChallengePost", [("id", str),
+                                             ("title", str),
+                                             ("number", int),
+                                             ("level", str),
+                                             ("permalink", str),
+                                             ("selftext_html", str)])
+# The parts of a challenge post's title
+ChallengeTitle = NamedTuple("ChallengeTitle", [("number", int), ("level", str), ("name", str)])
 A = TypeVar("A")
 B = TypeVar("B")
 C = TypeVar("C")
@@ -31,8 +52,9 @@ def user_agent() -> str:
     return "{}:{}:{} by {}".format(sys.platform, ID, VERSION, AUTHOR)
 
 
+@lru_cache(maxsize=1)
 def init_reddit() -> Result[str, Reddit]:
-    """ Gets a praw reddit instance """
+    """ Gets a praw reddit instance. The instance is built once and reused. """
     client = run_parser_file("client-info.json", dict_parser(str_parser))
     return client.fmap(lambda c: praw.Reddit(user_agent=user_agent(), **c))
 
@@ -42,58 +64,117 @@ def get_date() -> str:
     return time.strftime("%Y-%m-%d")
 
 
-def group_by(iterable: Iterable[A], key_func: Callable[[A], B]) -> Dict[B, List[A]]:
-    """ Groups an iterable by equality of keys. """
-    out = dict() # type: Dict[B, List[A]]
-    for item in iterable:
-        key = key_func(item)
-        if key in out:
-            out[key].append(item)
+@lru_cache(maxsize=4096)
+def parse_title(title: str) -> Optional[ChallengeTitle]:
+    """Parses the number, level and name out of the title of a challenge post.
+
+    Args:
+        title: The title of the post
+
+    Returns:
+        The parsed title, or None if the post is not a challenge
+    """
+    match = _TITLE.match(title)
+    if match is None:
+        return None
+    number, level, name = match.groups()
+    return ChallengeTitle(number=int(number), level=_LEVELS[level.lower()], name=name.strip())
+
+
+def parse_post(post: Post) -> Optional[ChallengePost]:
+    """ Parses the challenge number and level out of a post, or None if it is not a challenge. """
+    parsed = parse_title(post.title)
+    if parsed is None:
+        return None
+    return ChallengePost(id=post.id,
+                         title=post.title,
+                         number=parsed.number,
+                         level=parsed.level,
+                         permalink=post.permalink,
+                         selftext_html=post.selftext_html)
+
+
+class LevelSampler(object):
+    """Draws levels at random, weighted by a count for each level.
+
+    The running totals of the counts are kept so a draw is a binary search over them. Counts can be
+    adjusted as users change their languages, and the totals are rebuilt on the next draw.
+    """
+    def __init__(self, counts: Dict[str, int], rng: Optional[random.Random] = None) -> None:
+        """Builds a sampler from the weight of each level.
+
+        Args:
+            counts: The weight of each level
+            rng: The random number generator to draw with. Defaults to the one in the random module
+        """
+        self._counts = {level: count for (level, count) in counts.items() if count > 0}
+        self._levels = [] # type: List[str]
+        self._totals = [] # type: List[int]
+        self._stale = True
+        self._randrange = rng.randrange if rng is not None else random.randrange
+
+    @staticmethod
+    def from_users(users: Users) -> "LevelSampler":
+        """Weights each level by the number of languages all users have for it."""
+        counts = dict() # type: Dict[str, int]
+        for user in users.values():
+            for (level, languages) in user.langs.items():
+                counts[level] = counts.get(level, 0) + len(languages)
+        return LevelSampler(counts)
+
+    def adjust(self, level: str, delta: int) -> None:
+        """Changes the weight of a level by the given amount."""
+        count = self._counts.get(level, 0) + delta
+        if count > 0:
+            self._counts[level] = count
         else:
-            out[key] = [item]
-    return out
-
-
-def empty(xs: Iterable[A]) -> bool:
-    """ Tests if an iterable is empty. """
-    return not bool(xs)
-
-
-def latest(reddit: Reddit) -> Result[str, Dict[str, Post]]:
-    """ Get the latest posts """
-    def is_valid(post: Post) -> bool:
-        """ Checks that a post is a valid challenge post """
-        parts = post.title.split()
-        return len(parts) >= 5 and parts[1] == "Challenge"
-
-    def get_number(post: Post) -> int:
-        """ Gets the number of the challenge from the post """
-        return int(post.title.split()[2][1:])
-
-    def get_level(post: Post) -> str:
-        """ Gets the level of the post """
-        return post.title.split()[3][1:-1]
-
-    posts = filter(is_valid, list(reddit.subreddit('dailyprogrammer').new(limit=11)))
-    grouped = group_by(posts, get_level)
-    out = dict() # type: Dict[str, Post]
-
-    for level in grouped.keys():
-        if empty(grouped[level]):
-            titles = [post.title for post in posts]
-            return Err("No {} challenges in: {}".format(level, titles))
-        else:
-            out[level] = max(grouped[level], key=get_number)
-    return Ok(out)
-
-
-def choose_level(users: Users) -> str:
-    """Chooses the level for this week based on the number of languages specified by all users"""
-    all_levels = [level
-                  for user in users.values()
-                  for (level, languages) in user.langs.items()
-                  for _ in languages]
-    return choose(all_levels)
+            self._counts.pop(level, None)
+        self._stale = True
+
+    def _rebuild(self) -> None:
+        """Recomputes the running totals of the counts."""
+        self._levels = sorted(self._counts)
+        self._totals = list(itertools.accumulate(self._counts[level] for level in self._levels))
+        self._stale = False
+
+    def choose(self, exclude: Optional[str] = None) -> str:
+        """Draws a level with probability proportional to its weight.
+
+        Args:
+            exclude: A level not to draw, unless it is the only level with any weight
+
+        Returns:
+            The level drawn
+        """
+        if self._stale:
+            self._rebuild()
+        if not self._totals:
+            raise ValueError("There are no levels to choose from")
+        total = self._totals[-1]
+        if exclude is None or exclude not in self._counts:
+            return self._levels[bisect.bisect_right(self._totals, self._randrange(total))]
+        skipped = self._counts[exclude]
+        if skipped == total:
+            return exclude
+        # the excluded level's range is cut out by shifting draws past it
+        draw = self._randrange(total - skipped)
+        end = self._totals[bisect.bisect_left(self._levels, exclude)]
+        if draw >= end - skipped:
+            draw += skipped
+        return self._levels[bisect.bisect_right(self._totals, draw)]
+
+
+def choose_level(users: Users, exclude: Optional[str] = None) -> str:
+    """Chooses the level for this week based on the number of languages specified by all users
+
+    Args:
+        users: The users to weight the levels by
+        exclude: A level not to choose, unless no other level has any languages
+
+    Returns:
+        The level chosen
+    """
+    return LevelSampler.from_users(users).choose(exclude)
 
 
 def choose(elems: List[A]) -> A:
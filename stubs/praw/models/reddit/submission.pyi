@@ -3,6 +3,7 @@ class Submission:
     def shortlink(self) -> str: ...
 
     # These are added by calling setattr on everything in _data in RedditBase
+    id = ... # type: str
     title = ... # type: str
     selftext_html = ... # type: str
     permalink = ... # type: str
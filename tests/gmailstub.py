@@ -0,0 +1,138 @@
+""" A stub of the gmail service, for testing code that reads and sends mail. """
+
+import base64
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+# the stub service takes the same arguments as the gmail service, even those it ignores
+# pylint: disable=unused-argument
+
+
+class StubError(Exception):
+    """ A failed request, shaped like the errors the gmail client raises. """
+    def __init__(self, status: int) -> None:
+        super().__init__("HTTP {}".format(status))
+        self.resp = type("Response", (object,), {"status": status})()
+
+
+class StubRequest(object):
+    """ A request that is handled by the stub service when it is executed. """
+    def __init__(self, service: "StubService", method: str, key: str, **args: Any) -> None:
+        self.service = service
+        self.method = method
+        self.key = key
+        self.args = args
+
+    def execute(self) -> Dict[str, Any]:
+        """ Handles the request, raising if it is one of the failures. """
+        return self.service.handle(self)
+
+
+class StubBatch(object):
+    """ A batch that executes each of its requests in turn. """
+    def __init__(self, service: "StubService", callback: Callable[..., None]) -> None:
+        self.service = service
+        self.callback = callback
+        self.requests = [] # type: List[Any]
+
+    def add(self, request: StubRequest, request_id: str) -> None:
+        """ Queues a request. """
+        self.requests.append((request, request_id))
+
+    def execute(self) -> None:
+        """ Runs the queued requests, reporting each outcome to the callback. """
+        self.service.batch_sizes.append(len(self.requests))
+        for request, request_id in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except StubError as exn:
+                self.callback(request_id, None, exn)
+
+
+class StubService(object):
+    """ Enough of the gmail service to list, get, send, and trash messages.
+
+        Messages are identified by their id, or for sends by the raw message
+        decoded as latin-1. Requests for any key in failures fail with a 400.
+
+        Attributes:
+            inbox: The raw messages in the inbox by id, in the order they are listed
+            handled: The key of every request that was handled, in order
+            sent: The raw bytes of every message that was sent
+            trashed: The id of every message that was trashed
+            batch_sizes: The number of requests in each batch
+    """
+    def __init__(self,
+                 failures: Optional[Set[str]] = None,
+                 delays: Optional[Dict[str, float]] = None,
+                 inbox: Optional[Dict[str, bytes]] = None) -> None:
+        self.failures = failures if failures is not None else set()
+        self.delays = delays if delays is not None else dict()
+        self.inbox = inbox if inbox is not None else dict()
+        self.handled = [] # type: List[str]
+        self.sent = [] # type: List[bytes]
+        self.trashed = [] # type: List[str]
+        self.batch_sizes = [] # type: List[int]
+        self._lock = threading.Lock()
+
+    def users(self) -> "StubService":
+        """ The users resource. """
+        return self
+
+    def messages(self) -> "StubService":
+        """ The messages resource. """
+        return self
+
+    def list(self, # pylint: disable=too-many-arguments
+             userId: str, # pylint: disable=C0103
+             labelIds: Optional[str] = None, # pylint: disable=C0103
+             q: Optional[str] = None, # pylint: disable=C0103
+             maxResults: int = 100, # pylint: disable=C0103
+             pageToken: Optional[str] = None) -> StubRequest: # pylint: disable=C0103
+        """ Lists a page of the inbox. """
+        return StubRequest(self, "list", pageToken or "0", size=maxResults)
+
+    def get(self, userId: str, id: str, format: str) -> StubRequest: # pylint: disable=C0103,W0622
+        """ Gets a message. """
+        return StubRequest(self, "get", id)
+
+    def trash(self, userId: str, id: str) -> StubRequest: # pylint: disable=C0103,W0622
+        """ Trashes a message. """
+        return StubRequest(self, "trash", id)
+
+    def send(self, userId: str, body: Dict[str, str]) -> StubRequest: # pylint: disable=C0103
+        """ Sends a message. """
+        return StubRequest(self, "send", base64.urlsafe_b64decode(body["raw"]).decode("latin-1"))
+
+    def new_batch_http_request(self, callback: Callable[..., None]) -> StubBatch:
+        """ Starts a batch of requests. """
+        return StubBatch(self, callback)
+
+    def handle(self, request: StubRequest) -> Dict[str, Any]:
+        """ Records a request and responds to it. """
+        if request.method == "list":
+            return self._page(int(request.key), request.args["size"])
+        time.sleep(self.delays.get(request.key, 0))
+        with self._lock:
+            self.handled.append(request.key)
+        if request.key in self.failures:
+            raise StubError(400)
+        if request.method == "send":
+            with self._lock:
+                self.sent.append(request.key.encode("latin-1"))
+        elif request.method == "trash":
+            with self._lock:
+                self.trashed.append(request.key)
+        raw = self.inbox.get(request.key,
+                             "Subject: {}\n\nbody".format(request.key).encode("latin-1"))
+        return {"id": request.key, "raw": base64.urlsafe_b64encode(raw).decode("ASCII")}
+
+    def _page(self, start: int, size: int) -> Dict[str, Any]:
+        """ Lists the messages in the inbox from start onwards. """
+        ids = list(self.inbox)
+        page = {"messages": [{"id": msg_id, "threadId": "thread-" + msg_id}
+                             for msg_id in ids[start:start + size]]} # type: Dict[str, Any]
+        if start + size < len(ids):
+            page["nextPageToken"] = str(start + size)
+        return page
@@ -0,0 +1,162 @@
+""" Tests for ingesting challenges from reddit into the catalog. """
+
+import sqlite3
+import time
+import unittest
+from typing import Iterator, List, Optional, cast
+from unittest import mock
+
+from catalog import Catalog, ingest, refresh
+from result import Result, Err, Ok
+from scraper import Reddit
+
+
+class FakePost(object): # pylint: disable=too-few-public-methods
+    """ Enough of a praw submission to parse. """
+    def __init__(self, post_id: str, title: str) -> None:
+        self.id = post_id # pylint: disable=invalid-name
+        self.title = title
+        self.permalink = "/r/dailyprogrammer/comments/" + post_id
+        self.selftext_html = "<p>{}</p>".format(title)
+
+
+def challenge(number: int, level: str) -> FakePost:
+    """ A challenge post. """
+    return FakePost("p{}{}".format(number, level[0]),
+                    "[2017-01-02] Challenge #{0} [{1}] Thing {0}".format(number, level))
+
+
+class FakeReddit(object):
+    """ A reddit whose dailyprogrammer listing is a fixed list of posts, newest first.
+
+        Attributes:
+            read: The number of posts taken from the listing
+    """
+    def __init__(self, posts: List[FakePost], fail_after: Optional[int] = None) -> None:
+        self.posts = posts
+        self.fail_after = fail_after
+        self.read = 0
+
+    def subreddit(self, name: str) -> "FakeReddit":
+        """ The subreddit, which is always dailyprogrammer. """
+        assert name == "dailyprogrammer"
+        return self
+
+    def new(self, limit: Optional[int]) -> Iterator[FakePost]:
+        """ Lists the posts, failing part way through if asked to. """
+        assert limit is None
+        for post in self.posts:
+            if self.read == self.fail_after:
+                raise ConnectionError("reddit went away")
+            self.read += 1
+            yield post
+
+
+class CatalogTest(unittest.TestCase):
+    """ Tests for adding challenges to the catalog and finding them again. """
+    def setUp(self) -> None:
+        """ Opens an empty catalog in memory. """
+        self.catalog = Catalog(sqlite3.connect(":memory:"))
+        self.posts = [challenge(number, level) for number in range(10, 0, -1)
+                      for level in ["Hard", "Intermediate", "Easy"]]
+
+    def tearDown(self) -> None:
+        """ Closes the catalog. """
+        self.catalog.close()
+
+    def ingest_from(self, reddit: FakeReddit) -> Result[str, int]:
+        """ Ingests the posts listed by a fake reddit. """
+        return ingest(self.catalog, cast(Reddit, reddit))
+
+    def test_first_ingest_reads_everything(self) -> None:
+        """ The first ingest reads the whole listing, skipping posts that are not challenges. """
+        reddit = FakeReddit(self.posts[:3] + [FakePost("meta", "[Meta] Hello")] + self.posts[3:])
+        self.assertEqual(self.ingest_from(reddit).extract(self.fail, lambda added: added),
+                         30)
+        self.assertEqual(reddit.read, 31)
+        self.assertEqual(len(self.catalog), 30)
+        self.assertNotIn("meta", self.catalog)
+        self.assertGreater(self.catalog.ingested_at(), 0)
+
+    def test_stops_at_first_known_post(self) -> None:
+        """ Later ingests stop reading at the first post that is already in the catalog. """
+        self.ingest_from(FakeReddit(self.posts))
+        newer = [challenge(11, "Easy"), challenge(11, "Hard")]
+        reddit = FakeReddit(newer + self.posts)
+        self.assertEqual(self.ingest_from(reddit).extract(self.fail, lambda added: added), 2)
+        self.assertEqual(reddit.read, 3)
+        self.assertEqual(len(self.catalog), 32)
+
+    def test_failed_ingest_is_redone_in_full(self) -> None:
+        """ A failed ingest keeps what it read, and makes the next ingest read past any gap. """
+        self.ingest_from(FakeReddit(self.posts))
+        newer = [challenge(number, "Easy") for number in range(20, 10, -1)]
+        failed = self.ingest_from(FakeReddit(newer + self.posts, fail_after=4))
+        self.assertTrue(failed.is_err)
+        self.assertIn("reddit went away", failed.extract(str, str))
+        self.assertEqual(self.catalog.ingested_at(), 0)
+        self.assertEqual(len(self.catalog), 34)
+
+        # the newest posts are now known, but the ones below them are not
+        reddit = FakeReddit(newer + self.posts)
+        self.assertEqual(self.ingest_from(reddit).extract(self.fail, lambda added: added), 6)
+        self.assertEqual(reddit.read, 40)
+        self.assertGreater(self.catalog.ingested_at(), 0)
+
+    def test_newest_unsent(self) -> None:
+        """ Sent challenges are skipped when looking for the newest unsent one. """
+        self.ingest_from(FakeReddit(self.posts))
+        newest = self.catalog.newest("Easy")
+        assert newest is not None
+        self.assertEqual(newest.number, 10)
+        self.catalog.mark_sent(newest.id, "2017-W01")
+        self.assertEqual(self.catalog.newest("Easy"), newest)
+        unsent = self.catalog.newest("Easy", unsent=True)
+        assert unsent is not None
+        self.assertEqual((unsent.number, unsent.level), (9, "Easy"))
+        self.assertEqual([post.number for post in self.catalog.unsent("Easy")][:2], [9, 8])
+        self.assertIsNone(self.catalog.newest("Bonus"))
+
+
+class RefreshTest(unittest.TestCase):
+    """ Tests for deciding when to go back to reddit. """
+    def setUp(self) -> None:
+        """ Opens an empty catalog in memory, and a reddit with a few posts. """
+        self.catalog = Catalog(sqlite3.connect(":memory:"))
+        self.reddit = FakeReddit([challenge(2, "Easy"), challenge(1, "Easy")])
+
+    def tearDown(self) -> None:
+        """ Closes the catalog. """
+        self.catalog.close()
+
+    def test_stale_catalog_is_refreshed(self) -> None:
+        """ A catalog older than max_age is ingested into. """
+        with mock.patch("catalog.init_reddit", return_value=Ok(self.reddit)) as init:
+            self.assertTrue(refresh(self.catalog, max_age=60).is_ok)
+        init.assert_called_once_with()
+        self.assertEqual(len(self.catalog), 2)
+
+    def test_fresh_catalog_is_not_refreshed(self) -> None:
+        """ A catalog ingested within max_age is used as it is. """
+        self.catalog.set_ingested_at(time.time() - 30)
+        with mock.patch("catalog.init_reddit", return_value=Ok(self.reddit)) as init:
+            self.assertTrue(refresh(self.catalog, max_age=60).is_ok)
+            self.assertTrue(refresh(self.catalog, max_age=10).is_ok)
+        self.assertEqual(init.call_count, 1)
+
+    def test_offline(self) -> None:
+        """ An offline refresh never goes to reddit, however old the catalog is. """
+        with mock.patch("catalog.init_reddit", return_value=Ok(self.reddit)) as init:
+            self.assertTrue(refresh(self.catalog, max_age=0, offline=True).is_ok)
+        init.assert_not_called()
+        self.assertEqual(len(self.catalog), 0)
+
+    def test_reddit_unavailable(self) -> None:
+        """ A stale catalog that cannot be refreshed is an error. """
+        with mock.patch("catalog.init_reddit", return_value=Err("no client info")):
+            found = refresh(self.catalog, max_age=60)
+        self.assertEqual(found.extract(str, lambda _: ""), "no client info")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+""" Tests for reading commands out of messages and answering them. """
+
+import email
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any, Dict, List, cast
+from unittest import mock
+
+import interface
+import mail
+import userstore
+import weeklysend
+from gmailstub import StubError, StubRequest, StubService
+from interface import COMMANDS, CommandTable, Users
+from result import Result
+from user import User
+
+
+def message(subject: str) -> mail.LazyMessage:
+    """ A message from a user with the given subject. """
+    return mail.LazyMessage("From: someone@example.com\nSubject: {}\n"
+                            "Message-ID: <1@example.com>\n\nhi\n".format(subject).encode("utf-8"))
+
+
+def reply_text(reply: mail.Outgoing) -> str:
+    """ The text of a reply, whatever its transfer encoding. """
+    parsed = email.message_from_bytes(reply.as_bytes())
+    return cast(bytes, parsed.get_payload(decode=True)).decode("utf-8")
+
+
+def inbox_message(msg_id: str, sender: str, subject: str, body: str = "") -> bytes:
+    """ A raw message in the inbox. """
+    return ("From: {}\nSubject: {}\nMessage-ID: <{}@example.com>\n"
+            "Content-Type: text/plain; charset=utf-8\n\n{}\n").format(
+                sender, subject, msg_id, body).encode("utf-8")
+
+
+class RefusingService(StubService):
+    """ A service that refuses to send replies to one address. """
+    def __init__(self, inbox: Dict[str, bytes], delays: Dict[str, float],
+                 failures: List[str], refused: str) -> None:
+        super().__init__(failures=set(failures), delays=delays, inbox=inbox)
+        self.refused = refused
+
+    def handle(self, request: StubRequest) -> Dict[str, Any]:
+        """ Fails replies to the refused address, and handles other requests. """
+        if request.method == "send" and "To: {}\n".format(self.refused) in request.key:
+            raise StubError(400)
+        return super().handle(request)
+
+
+def first(_: Users, msg: mail.Incoming) -> Result[str, mail.Outgoing]:
+    """ A reaction that is only compared by identity. """
+    return mail.make_reply(msg, "first")
+
+
+def second(_: Users, msg: mail.Incoming) -> Result[str, mail.Outgoing]:
+    """ Another reaction that is only compared by identity. """
+    return mail.make_reply(msg, "second")
+
+
+class CommandTableTest(unittest.TestCase):
+    """ Tests for finding the command a subject names in a table of a few commands. """
+    def setUp(self) -> None:
+        """ Builds a table with two fuzzy commands that share a start and a typo. """
+        self.table = CommandTable()
+        self.table.add(["start", "go"], first)
+        self.table.add(["stop", "card"], second)
+
+    def test_exact_names_and_aliases(self) -> None:
+        """ Every name of a command finds it, whatever its case and spacing. """
+        self.assertIs(self.table.lookup("start"), first)
+        self.assertIs(self.table.lookup("  GO "), first)
+        self.assertIs(self.table.lookup("Stop!"), second)
+        self.assertIs(self.table.lookup("card"), second)
+
+    def test_prefixes(self) -> None:
+        """ The start of only one command's name finds it, and a shared start finds nothing. """
+        self.assertIs(self.table.lookup("sta"), first)
+        self.assertIs(self.table.lookup("sto"), second)
+        self.assertIsNone(self.table.lookup("st"))
+        self.assertIsNone(self.table.lookup("s"))
+
+    def test_typos(self) -> None:
+        """ A name one letter away from only one command's name finds it. """
+        self.assertIs(self.table.lookup("strat"), first)
+        self.assertIs(self.table.lookup("sttop"), second)
+        self.assertIs(self.table.lookup("cadr"), second)
+        self.assertIsNone(self.table.lookup("sxxp"))
+
+    def test_typo_of_two_commands(self) -> None:
+        """ A name one letter away from two commands' names finds neither. """
+        self.table.add(["cart"], first)
+        self.assertIsNone(self.table.lookup("carx"))
+        self.assertIs(self.table.lookup("cart"), first)
+
+    def test_exact_only_command(self) -> None:
+        """ A command added without fuzzy matching also stops its keys finding other commands. """
+        self.table.add(["stopping"], first, fuzzy=False)
+        self.assertIs(self.table.lookup("stopping"), first)
+        self.assertIs(self.table.lookup("stop"), second)
+        self.assertIsNone(self.table.lookup("stoppin"))
+        self.assertIsNone(self.table.lookup("stoping"))
+
+
+class CommandsTest(unittest.TestCase):
+    """ Tests for the subjects the mailer understands. """
+    def test_exact_names_and_aliases(self) -> None:
+        """ Each command is found by each of its names. """
+        self.assertIs(COMMANDS.lookup("help"), interface.help_msg)
+        self.assertIs(COMMANDS.lookup("?"), interface.help_msg)
+        self.assertIs(COMMANDS.lookup("subscribe"), interface.sub)
+        for name in ["unsubscribe", "get", "set", "add", "remove", "veto"]:
+            self.assertIsNotNone(COMMANDS.lookup(name), name)
+        self.assertIs(COMMANDS.lookup("fuck this"), COMMANDS.lookup("veto"))
+        self.assertEqual(len({COMMANDS.lookup(name) for name in
+                              ["unsubscribe", "get", "set", "add", "remove", "veto"]}), 6)
+
+    def test_reply_and_forward_markers(self) -> None:
+        """ Reply and forward markers are stripped before looking a subject up. """
+        self.assertIs(COMMANDS.lookup("Re: subscribe"), interface.sub)
+        self.assertIs(COMMANDS.lookup("RE: Fwd: re:SUBSCRIBE"), interface.sub)
+        self.assertIs(COMMANDS.lookup("Fw: help!"), interface.help_msg)
+        self.assertIs(COMMANDS.lookup("Re: Fwd:  Fuck   This"), COMMANDS.lookup("veto"))
+
+    def test_fuzzy_commands(self) -> None:
+        """ Commands that are easy to undo accept a shortened or misspelled name. """
+        self.assertIs(COMMANDS.lookup("sub"), interface.sub)
+        self.assertIs(COMMANDS.lookup("subscirbe"), interface.sub)
+        self.assertIs(COMMANDS.lookup("hepl"), interface.help_msg)
+
+    def test_unclear_subjects_get_help(self) -> None:
+        """ Subjects that are only close to a command that is hard to undo fall through to help. """
+        for subject in ["un", "vet", "fuck", "Re", "unsub", "usubscribe", "remov", "vetoo"]:
+            self.assertIsNone(COMMANDS.lookup(subject), subject)
+            reply = interface.react(cast(Users, None), message(subject))
+            self.assertIn("Available commands", reply.extract(str, reply_text), subject)
+
+    def test_insult(self) -> None:
+        """ An insult gets an insult back rather than help. """
+        reply = interface.react(cast(Users, None), message("fuck you"))
+        self.assertIn("call the cops", reply.extract(str, reply_text))
+
+
+class RespondToAllTest(unittest.TestCase):
+    """ Tests for answering every message in an inbox spread over several pages. """
+    def setUp(self) -> None:
+        """ Uses small batches so the inbox spans several pages and chunks, and opens a store. """
+        self.batch_limit = mail.BATCH_LIMIT
+        mail.BATCH_LIMIT = 3
+        self.directory = tempfile.mkdtemp()
+        self.veto_journal = weeklysend.VETO_JOURNAL
+        weeklysend.VETO_JOURNAL = os.path.join(self.directory, "veto-journal.json")
+        self.users = userstore.open_store(os.path.join(self.directory, "users.db"),
+                                          create=True).extract(self.fail, lambda s: s)
+
+    def tearDown(self) -> None:
+        """ Closes the store and restores the batch size and journal. """
+        self.users.close()
+        shutil.rmtree(self.directory)
+        mail.BATCH_LIMIT = self.batch_limit
+        weeklysend.VETO_JOURNAL = self.veto_journal
+
+    def test_answers_in_order_and_trashes_answered(self) -> None:
+        """ Messages are reacted to in inbox order, and only answered messages are trashed. """
+        inbox = {
+            "m0": inbox_message("m0", "a@example.com", "subscribe", '{"easy": ["py"]}'),
+            "m1": inbox_message("m1", "b@example.com", "subscribe"),
+            "m2": inbox_message("m2", "c@example.com", "help"),
+            "m3": inbox_message("m3", "a@example.com", "set", '{"hard": ["go"]}'),
+            "m4": inbox_message("m4", "refused@example.com", "subscribe"),
+            "m5": inbox_message("m5", "d@example.com", "subscribe"),
+            "m6": inbox_message("m6", "b@example.com", "Re: add", '{"easy": ["c"]}'),
+            "m7": inbox_message("m7", "e@example.com", "?"),
+        }
+        # the first chunk is the slowest to fetch, so later chunks are fetched before it
+        service = RefusingService(inbox, delays={"m0": 0.05, "m1": 0.05},
+                                  failures=["m5"], refused="refused@example.com")
+        interface.respond_to_all(service, self.users, concurrency=4)
+
+        self.assertEqual(self.users["a@example.com"].langs,
+                         {"Easy": [], "Intermediate": [], "Hard": ["go"]})
+        self.assertEqual(self.users["b@example.com"].langs["Easy"], ["c"])
+        self.assertIn("refused@example.com", self.users)
+        self.assertNotIn("d@example.com", self.users)
+        self.assertEqual(sorted(service.trashed), ["m0", "m1", "m2", "m3", "m6", "m7"])
+
+        replies = [email.message_from_bytes(raw) for raw in service.sent]
+        self.assertEqual(sorted(reply["To"] for reply in replies),
+                         ["a@example.com", "a@example.com", "b@example.com", "b@example.com",
+                          "c@example.com", "e@example.com", "tobinyehle@gmail.com"])
+        failure = [reply for reply in replies if reply["Subject"] == "FAILURE"]
+        self.assertEqual(len(failure), 1)
+        self.assertIn("HTTP 400", cast(str, failure[0].get_payload()))
+
+    def vote(self, week: str) -> mock.MagicMock:
+        """ Has both users veto the challenge sent in a week, and checks the inbox. """
+        self.users.update({"a@example.com": User({}, True, None, "Easy"),
+                           "b@example.com": User({}, True, None, "Easy")})
+        self.users.tally = userstore.VetoTally(week, "Easy", 2)
+        with mock.patch("weeklysend.resend_cause_veto") as resend:
+            interface.respond_to_all(StubService(), self.users)
+        return resend
+
+    def test_votes_this_week_veto(self) -> None:
+        """ Enough votes for this week's challenge send a new one. """
+        self.vote(weeklysend.this_week()).assert_called_once_with(mock.ANY, mock.ANY, None)
+
+    def test_votes_from_earlier_week_do_not_veto(self) -> None:
+        """ Votes left over from an earlier week's challenge do not send a new one. """
+        self.vote("2000-W01").assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
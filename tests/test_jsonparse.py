@@ -0,0 +1,110 @@
+""" Tests for streaming the entries of a json object out of a file. """
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any, List
+
+from jsonparse import dict_parser, leaf_parser, list_parser, run_dict_parser_file, run_parser
+from result import Ok
+
+# Chunk sizes to stream with, from a character at a time to more than any of the files
+CHUNK_SIZES = [1, 2, 3, 7, 64, 4096]
+
+VALID = [
+    '{}',
+    '  \n{ }\n\n',
+    '{"a": [1, 2], "b": []}',
+    '{"a": [1], "a": [2, 3]}',
+    '{\n  "caf\\u00e9": [1],\n  "naïve": [\n    2, 3\n  ]\n}\n',
+    '{' + ", ".join('"key{}": [{}, {}]'.format(i, i, i * i) for i in range(200)) + '}',
+]
+
+MALFORMED = [
+    '',
+    '   \n',
+    '[1, 2]',
+    '{"a": [1]',
+    '{"a": [1], }',
+    '{"a": [1],\n\n}',
+    '{"a": [1] "b": [2]}',
+    '{"a" [1]}',
+    '{a: [1]}',
+    '{"a": [1, 2,, 3]}',
+    '{"a": "unterminated',
+    '{"a": [1]}\n  x',
+    '{"a": [1]}{}',
+    '{"a":\n[1],\n  "b": [1 2]\n}',
+    '{\n' + ",\n".join('  "key{}": [{}]'.format(i, i) for i in range(100)) + ',\n  "bad": [1,]\n}',
+    '{\n' + ",\n".join('  "key{}": [{}]'.format(i, i) for i in range(100)) + '\n  "key": [1]}',
+    '{"a": [1], "b": "x"}',
+    '{"a": [1], "b": [1, "x"]}',
+]
+
+
+class RunDictParserFileTest(unittest.TestCase):
+    """ Tests that streaming a file gives the same outcome as parsing all of it at once. """
+    def setUp(self) -> None:
+        """ Makes a directory for the files. """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        """ Removes the files. """
+        shutil.rmtree(self.directory)
+
+    def write(self, raw: str, name: str = "test.json") -> str:
+        """ Writes a file, compressing it if its name ends in .gz. """
+        path = os.path.join(self.directory, name)
+        if name.endswith(".gz"):
+            with gzip.open(path, "wt", encoding="utf-8") as handle:
+                handle.write(raw)
+        else:
+            with open(path, "w", encoding="utf-8") as handle:
+                handle.write(raw)
+        return path
+
+    def assert_same(self, raw: str, name: str = "test.json") -> List[Any]:
+        """ Checks each chunk size streams to the same outcome as run_parser, returning it. """
+        parser = dict_parser(list_parser(leaf_parser(int)))
+        expected = run_parser(raw, parser)
+        path = self.write(raw, name)
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(raw=raw[:40], chunk_size=chunk_size):
+                found = run_dict_parser_file(path, list_parser(leaf_parser(int)), chunk_size)
+                self.assertEqual(found.is_ok, expected.is_ok)
+                self.assertEqual(found.extract(str, repr), expected.extract(str, repr))
+        return [expected.is_ok, expected.extract(str, repr)]
+
+    def test_valid_files(self) -> None:
+        """ Valid files parse to the same dictionary. """
+        for raw in VALID:
+            self.assertTrue(self.assert_same(raw)[0])
+
+    def test_malformed_files(self) -> None:
+        """ Malformed files fail with the same message, giving the line and column in the file. """
+        for raw in MALFORMED:
+            self.assertFalse(self.assert_same(raw)[0])
+
+    def test_message_has_file_position(self) -> None:
+        """ Positions in the message count from the start of the file, not of a chunk. """
+        entries = ",\n".join('  "key{}": [{}]'.format(i, i) for i in range(100))
+        raw = '{\n' + entries + '\n  "x": [1]}'
+        message = self.assert_same(raw)[1]
+        self.assertEqual(message, "Expecting ',' delimiter: line 102 column 3 (char {})".format(
+            raw.index('"x"')))
+
+    def test_compressed_file(self) -> None:
+        """ Compressed files stream in the same way. """
+        self.assert_same(VALID[-1], "test.json.gz")
+        self.assert_same(MALFORMED[-3], "test.json.gz")
+
+    def test_missing_file(self) -> None:
+        """ A file that cannot be opened is a failure. """
+        found = run_dict_parser_file(os.path.join(self.directory, "missing.json"), Ok)
+        self.assertTrue(found.is_err)
+
+
+if __name__ == "__main__":
+    unittest.main()
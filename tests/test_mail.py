@@ -0,0 +1,435 @@
+""" Tests for sending through gmail, using a stub in place of the gmail service. """
+
+import email
+import threading
+import unittest
+from email.header import decode_header, make_header
+from email.message import Message
+from typing import Any, Dict, List, Optional, cast
+
+import mail
+import weeklysend
+from result import Result
+from gmailstub import StubError, StubRequest, StubService
+
+
+class FlakyService(StubService):
+    """ A service whose first few requests fail with the given status. """
+    def __init__(self, failures: int, status: int) -> None:
+        super().__init__()
+        self.remaining = failures
+        self.status = status
+
+    def handle(self, request: StubRequest) -> Dict[str, Any]:
+        """ Fails the request if there are failures left, and handles it otherwise. """
+        if self.remaining > 0:
+            self.remaining -= 1
+            self.handled.append(request.key)
+            raise StubError(self.status)
+        return super().handle(request)
+
+
+class FakeClock(object):
+    """ A clock that only moves when something sleeps. """
+    def __init__(self) -> None:
+        self.now = 100.0
+        self.sleeps = [] # type: List[float]
+
+    def time(self) -> float:
+        """ The current time. """
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        """ Records the sleep and moves the clock past it. """
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def outcomes(results: List[Result[str, Any]]) -> List[Optional[str]]:
+    """ The id in each successful response, or None for each failure. """
+    return [result.extract(lambda err: None, lambda ok: ok["id"]) for result in results]
+
+
+class ExecuteBatchTest(unittest.TestCase):
+    """ Tests for running requests in http batches. """
+    def setUp(self) -> None:
+        """ Uses small batches so a few requests span several of them. """
+        self.batch_limit = mail.BATCH_LIMIT
+        mail.BATCH_LIMIT = 3
+
+    def tearDown(self) -> None:
+        """ Restores the batch size. """
+        mail.BATCH_LIMIT = self.batch_limit
+
+    def test_results_are_in_request_order(self) -> None:
+        """ Requests are split into batches, and their results kept in order. """
+        service = StubService()
+        ids = [str(i) for i in range(8)]
+        self.assertEqual(outcomes(mail.trash_all(service, "me", ids)), ids)
+        self.assertEqual(service.batch_sizes, [3, 3, 2])
+
+    def test_failure_does_not_affect_batch(self) -> None:
+        """ A failed request only fails its own result. """
+        service = StubService(failures={"1", "4"})
+        ids = [str(i) for i in range(6)]
+        results = mail.trash_all(service, "me", ids)
+        self.assertEqual(outcomes(results), ["0", None, "2", "3", None, "5"])
+        self.assertEqual(results[1].extract(lambda err: err, lambda ok: ""), "HTTP 400")
+        self.assertEqual(service.handled, ids)
+
+    def test_get_messages_decodes_each_message(self) -> None:
+        """ Each message that was fetched is decoded. """
+        service = StubService(failures={"b"})
+        results = mail.get_messages(service, "me", ["a", "b", "c"])
+        subjects = [result.extract(lambda err: None, lambda msg: msg["Subject"])
+                    for result in results]
+        self.assertEqual(subjects, ["a", None, "c"])
+
+
+class ServicePoolTest(unittest.TestCase):
+    """ Tests for giving each thread its own service. """
+    def test_one_service_per_thread(self) -> None:
+        """ Each thread builds a service once and then reuses it. """
+        built = [] # type: List[StubService]
+        lock = threading.Lock()
+
+        def factory() -> StubService:
+            """ Builds and remembers a service. """
+            with lock:
+                built.append(StubService())
+                return built[-1]
+
+        pool = mail.ServicePool(factory)
+        seen = dict() # type: Dict[str, List[Any]]
+
+        def use() -> None:
+            """ Gets the service for this thread twice. """
+            seen[threading.current_thread().name] = [pool.get(), pool.get()]
+
+        threads = [threading.Thread(target=use, name=str(i)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(built), 4)
+        for first, second in seen.values():
+            self.assertIs(first, second)
+        self.assertEqual({id(services[0]) for services in seen.values()},
+                         {id(service) for service in built})
+
+
+class TokenBucketTest(unittest.TestCase):
+    """ Tests for rate limiting requests. """
+    def test_waits_once_burst_is_used(self) -> None:
+        """ A full bucket lets a burst through, and then waits for each token to refill. """
+        clock = FakeClock()
+        bucket = mail.TokenBucket(2.0, 3, clock.time, clock.sleep)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(clock.sleeps, [])
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(clock.sleeps, [0.5, 0.5])
+
+    def test_refill_is_capped_at_burst(self) -> None:
+        """ Tokens do not build up past the burst however long the bucket is idle. """
+        clock = FakeClock()
+        bucket = mail.TokenBucket(2.0, 3, clock.time, clock.sleep)
+        bucket.acquire()
+        clock.now += 1000
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(clock.sleeps, [0.5])
+
+
+class SendWithRetryTest(unittest.TestCase):
+    """ Tests for retrying sends that gmail rejected. """
+    def setUp(self) -> None:
+        """ Records the time spent backing off instead of waiting. """
+        self.clock = FakeClock()
+
+    def send(self, service: FlakyService, retries: int = 3) -> Result[str, Dict[str, Any]]:
+        """ Sends a message. """
+        return mail.send_with_retry(service, "me", mail.RawMessage(b"hello"),
+                                    retries=retries, sleep=self.clock.sleep)
+
+    def test_retries_server_errors(self) -> None:
+        """ Server errors are retried with an exponentially growing, jittered delay. """
+        service = FlakyService(2, 503)
+        self.assertTrue(self.send(service).is_ok)
+        self.assertEqual(service.handled, ["hello"] * 3)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(1.0 <= self.clock.sleeps[0] <= 2.0)
+        self.assertTrue(2.0 <= self.clock.sleeps[1] <= 4.0)
+
+    def test_retries_rate_limits(self) -> None:
+        """ Rate limited sends are retried. """
+        service = FlakyService(1, 429)
+        self.assertTrue(self.send(service).is_ok)
+        self.assertEqual(len(service.handled), 2)
+
+    def test_does_not_retry_client_errors(self) -> None:
+        """ A request that gmail refused is not sent again. """
+        service = FlakyService(1, 400)
+        self.assertEqual(self.send(service).extract(lambda err: err, lambda ok: ""), "HTTP 400")
+        self.assertEqual(len(service.handled), 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_gives_up_after_retries(self) -> None:
+        """ The last failure is returned once the retries are used up. """
+        service = FlakyService(10, 500)
+        self.assertEqual(self.send(service, retries=3).extract(lambda err: err, lambda ok: ""),
+                         "HTTP 500")
+        self.assertEqual(len(service.handled), 4)
+        self.assertEqual(len(self.clock.sleeps), 3)
+
+
+class QuotedLinesTest(unittest.TestCase):
+    """ Tests for quoting the message being replied to. """
+    def test_quotes_each_line(self) -> None:
+        """ Every line is quoted when the text is within the limits. """
+        self.assertEqual(list(mail.quoted_lines("one\r\ntwo\n", 5, 100)), ["> one", "> two"])
+
+    def test_stops_after_max_lines(self) -> None:
+        """ Lines past the limit are replaced with a marker. """
+        self.assertEqual(list(mail.quoted_lines("a\nb\nc\nd", 2, 100)), ["> a", "> b", "> [...]"])
+
+    def test_cuts_long_line_at_max_chars(self) -> None:
+        """ A line longer than the character limit is cut off at the limit. """
+        self.assertEqual(list(mail.quoted_lines("a\n" + "b" * 5000000, 5, 10)),
+                         ["> a", "> bbbbbbbb", "> [...]"])
+
+
+class HtmlTemplateTest(unittest.TestCase):
+    """ Tests for rendering the weekly message for each recipient. """
+    def test_non_ascii_recipient(self) -> None:
+        """ A recipient that is not ascii is encoded rather than failing the render. """
+        template = mail.HtmlTemplate("Your ", " challenge", "<p>", "</p>")
+        raw = template.render("jos\u00e9@example.com", "Easy").as_bytes()
+        self.assertIn(b"To: =?utf-8?", raw)
+        self.assertIn(b"Subject: Your Easy challenge\n", raw)
+
+
+def decoded_parts(message: Message) -> List[Any]:
+    """ The subject, recipient, and the type and decoded text of each part of a message. """
+    parts = [str(make_header(decode_header(message[name])))
+             for name in ["Subject", "To", "From"]] # type: List[Any]
+    for part in message.walk():
+        if part.get_content_maintype() != "multipart":
+            payload = cast(bytes, part.get_payload(decode=True))
+            parts.append((part.get_content_type(),
+                          payload.decode(part.get_content_charset() or "ascii")))
+    return parts
+
+
+class HtmlTemplateMatchTest(unittest.TestCase):
+    """ Tests that a rendered template holds the same message as make_html_message. """
+    def test_matches_make_html_message(self) -> None:
+        """ Gaps of one, two and three bytes are spliced in whatever the length around them. """
+        fills = ["a", "ab", "abc", "\u00e9", "\u20ac", "\u00e9a"]
+        for before in ["", "x", "xy", "<p>caf\u00e9 ", "<p>" + "y" * 100]:
+            for after in ["", "z", "zw", "</p>\n" * 40]:
+                template = mail.HtmlTemplate("Your ", " problem", before, after)
+                for fill in fills:
+                    with self.subTest(before=before[:10], after=after[:10], fill=fill):
+                        rendered = email.message_from_bytes(
+                            template.render("you@example.com", fill).as_bytes())
+                        expected = mail.make_html_message(before + fill + after,
+                                                          "Your " + fill + " problem",
+                                                          "you@example.com")
+                        self.assertEqual(decoded_parts(rendered), decoded_parts(expected))
+
+
+# Messages shaped like those mail clients send, and the text that should be found in each
+TEXT_FIXTURES = [
+    (b"""From: a@example.com
+Subject: set
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+--outer
+Content-Type: text/plain; charset="utf-8"
+Content-Disposition: attachment; filename="langs.txt"
+
+not this
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset="utf-8"
+
+{"easy": ["py"]}
+--inner
+Content-Type: text/html; charset="utf-8"
+
+<div>{"easy": ["py"]}</div>
+--inner--
+--outer--
+""", '{"easy": ["py"]}'),
+    (b"""From: a@example.com
+Subject: set
+Content-Type: text/plain
+Content-Transfer-Encoding: 8bit
+
+caf\xc3\xa9
+""", "caf\u00e9\n"),
+    (b"""From: a@example.com
+Subject: set
+Content-Type: text/plain; charset="utf-8"
+Content-Transfer-Encoding: quoted-printable
+
+{"easy": ["caf=C3=A9", =
+"go"]}
+""", '{"easy": ["caf\u00e9", "go"]}\n'),
+    (b"""From: a@example.com
+Subject: set
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="b"
+
+--b
+Content-Type: text/plain; charset="iso-8859-1"
+Content-Transfer-Encoding: base64
+
+eyJoYXJkIjogWyJj6SJdfQo=
+--b
+Content-Type: text/html; charset="utf-8"
+
+<p>ignored</p>
+--b--
+""", '{"hard": ["c\u00e9"]}\n'),
+]
+
+HTML_ONLY = b"""From: a@example.com
+Subject: set
+Content-Type: text/html; charset="utf-8"
+
+<p>{"easy": ["py"]}</p>
+"""
+
+
+def parsed_both_ways(raw: bytes) -> List[mail.Incoming]:
+    """ A received message parsed lazily, and parsed in full. """
+    return [mail.LazyMessage(raw), email.message_from_bytes(raw)]
+
+
+class TextContentTest(unittest.TestCase):
+    """ Tests for finding the text of a received message. """
+    def test_fixtures(self) -> None:
+        """ The text is found and decoded whether or not the message was parsed lazily. """
+        for raw, text in TEXT_FIXTURES:
+            for message in parsed_both_ways(raw):
+                with self.subTest(raw=raw[40:80], message=type(message).__name__):
+                    self.assertEqual(mail.get_text_content(message).extract(self.fail, str), text)
+
+    def test_html_only(self) -> None:
+        """ A message without any plain text has no text content. """
+        for message in parsed_both_ways(HTML_ONLY):
+            found = mail.get_text_content(message)
+            self.assertEqual(found.extract(str, lambda _: ""),
+                             "No text/plain content in a text/html message")
+
+    def test_lazy_message_decodes_once(self) -> None:
+        """ A lazily parsed message keeps the text it found. """
+        message = mail.LazyMessage(TEXT_FIXTURES[0][0])
+        self.assertIs(message.text_content(), message.text_content())
+
+
+def header(message: Message, name: str) -> str:
+    """ A header of a parsed message, with any encoded words decoded. """
+    return str(make_header(decode_header(message[name])))
+
+
+class MakeReplyTest(unittest.TestCase):
+    """ Tests for the replies built from received messages. """
+    def reply(self, raw: bytes, body: str = "Done.") -> Message:
+        """ Builds a reply to a raw message, and parses the reply back. """
+        rendered = mail.make_reply(mail.LazyMessage(raw), body).extract(self.fail, lambda r: r)
+        return email.message_from_bytes(rendered.as_bytes())
+
+    def test_threading_headers(self) -> None:
+        """ The reply goes to the sender, in the same thread, with the body and quote in it. """
+        reply = self.reply(b"From: Someone <someone@example.com>\n"
+                           b"Subject: subscribe\n"
+                           b"Message-ID: <2@example.com>\n"
+                           b"References: <0@example.com> <1@example.com>\n"
+                           b"Date: Mon, 02 Jan 2017 10:00:00 -0000\n\n"
+                           b"{}\n")
+        self.assertEqual(reply["Subject"], "Re: subscribe")
+        self.assertEqual(reply["To"], "Someone <someone@example.com>")
+        self.assertEqual(reply["From"], mail.SENDER)
+        self.assertEqual(reply["In-Reply-To"], "<2@example.com>")
+        self.assertEqual(reply["References"], "<0@example.com> <1@example.com> <2@example.com>")
+        text = cast(bytes, reply.get_payload(decode=True)).decode("utf-8")
+        self.assertTrue(text.startswith("Done.\r\n\r\nOn Mon, Jan 02, 2017"))
+        self.assertIn("> {}", text)
+
+    def test_reply_to_and_existing_re(self) -> None:
+        """ Reply-To is preferred to From, and a subject is only marked as a reply once. """
+        reply = self.reply(b"From: someone@example.com\n"
+                           b"Reply-To: list@example.com\n"
+                           b"Subject: Re: set\n"
+                           b"Message-ID: <3@example.com>\n\nhi\n")
+        self.assertEqual(reply["Subject"], "Re: set")
+        self.assertEqual(reply["To"], "list@example.com")
+        self.assertEqual(reply["References"], "<3@example.com>")
+
+    def test_folded_headers_are_unfolded(self) -> None:
+        """ Headers that were folded over several lines are joined back into one. """
+        reply = self.reply(b"From: someone@example.com\n"
+                           b"Subject: add\n languages\n"
+                           b"Message-ID:\n <4@example.com>\n"
+                           b"References: <0@example.com>\n\t<1@example.com>\n\nhi\n")
+        self.assertEqual(reply["Subject"], "Re: add languages")
+        self.assertEqual(reply["In-Reply-To"], "<4@example.com>")
+        self.assertEqual(reply["References"], "<0@example.com>\t<1@example.com> <4@example.com>")
+
+    def test_non_ascii_headers_are_encoded(self) -> None:
+        """ Headers that are not ascii are sent as encoded words and decode back. """
+        raw = ("From: Jos\u00e9 <jos\u00e9@example.com>\n"
+               "Subject: =?utf-8?q?S=C3=BCbscribe?=\n"
+               "Message-ID: <5@example.com>\n\nhi\n").encode("utf-8")
+        rendered = mail.make_reply(mail.LazyMessage(raw), "Done.").extract(self.fail, lambda r: r)
+        head = rendered.as_bytes().split(b"\n\n")[0]
+        self.assertTrue(all(byte < 128 for byte in head))
+        reply = email.message_from_bytes(rendered.as_bytes())
+        self.assertEqual(header(reply, "To"), "Jos\u00e9 <jos\u00e9@example.com>")
+        self.assertEqual(header(reply, "Subject"), "Re: S\u00fcbscribe")
+
+        raw = raw.replace(b"=?utf-8?q?S=C3=BCbscribe?=", "S\u00fcbscribe".encode("utf-8"))
+        rendered = mail.make_reply(mail.LazyMessage(raw), "Done.").extract(self.fail, lambda r: r)
+        self.assertIn(b"Subject: =?utf-8?", rendered.as_bytes())
+        reply = email.message_from_bytes(rendered.as_bytes())
+        self.assertEqual(header(reply, "Subject"), "Re: S\u00fcbscribe")
+
+    def test_missing_headers(self) -> None:
+        """ A message without a sender, id or subject cannot be replied to. """
+        for raw, missing in [(b"Subject: a\nMessage-ID: <6@x>\n\nhi\n", "From"),
+                             (b"From: a@x\nSubject: a\n\nhi\n", "Message-ID"),
+                             (b"From: a@x\nMessage-ID: <6@x>\n\nhi\n", "Subject")]:
+            found = mail.make_reply(mail.LazyMessage(raw), "Done.")
+            self.assertIn(missing, found.extract(str, lambda _: ""))
+
+
+class FanOutTest(unittest.TestCase):
+    """ Tests for sending messages on worker threads. """
+    def test_outcomes_are_in_order_and_isolated(self) -> None:
+        """ Outcomes are reported in the order messages were given, and failures do not spread. """
+        count = 20
+        bodies = ["message {}".format(i) for i in range(count)]
+        # later messages finish first, so results arrive out of order
+        service = StubService(failures={bodies[3], bodies[11]},
+                              delays={body: (count - i) * 0.002 for i, body in enumerate(bodies)})
+        done = [] # type: List[Any]
+        weeklysend.fan_out(weeklysend.workers(service, None),
+                           ((i, mail.RawMessage(body.encode("ASCII")))
+                            for i, body in enumerate(bodies)),
+                           lambda key, outcome: done.append((key, outcome.is_ok)),
+                           concurrency=4,
+                           bucket=mail.TokenBucket(1000.0, count))
+        self.assertEqual([key for key, _ in done], list(range(count)))
+        self.assertEqual([key for key, ok in done if not ok], [3, 11])
+        self.assertEqual(sorted(service.handled), sorted(bodies))
+
+
+if __name__ == "__main__":
+    unittest.main()
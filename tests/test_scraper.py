@@ -0,0 +1,138 @@
+""" Tests for parsing challenge posts and choosing the level of the week. """
+
+import random
+import unittest
+from collections import Counter
+from typing import Dict, Optional
+
+from scraper import ChallengeTitle, LevelSampler, parse_title
+
+# Number of levels drawn when checking how often each level comes up
+DRAWS = 20000
+
+
+def frequencies(sampler: LevelSampler, exclude: Optional[str] = None) -> Dict[str, float]:
+    """ The fraction of draws that came up as each level. """
+    counts = Counter(sampler.choose(exclude) for _ in range(DRAWS))
+    return {level: count / DRAWS for (level, count) in counts.items()}
+
+
+class ParseTitleTest(unittest.TestCase):
+    """ Tests for reading the number, level and name out of the titles used over the years. """
+    def assert_parses(self, title: str, number: int, level: str, name: str) -> None:
+        """ Checks that a title parses to the given parts. """
+        self.assertEqual(parse_title(title), ChallengeTitle(number, level, name), title)
+
+    def test_current_titles(self) -> None:
+        """ Titles with an ISO date, as posted since 2013. """
+        self.assert_parses("[2017-01-02] Challenge #298 [Easy] Too many Parentheses",
+                           298, "Easy", "Too many Parentheses")
+        self.assert_parses("[2014-07-09] Challenge #170 [Intermediate] Rummy Checker",
+                           170, "Intermediate", "Rummy Checker")
+        self.assert_parses("[2013-05-10] Challenge #123 [Hard]: Snake Game",
+                           123, "Hard", "Snake Game")
+        self.assert_parses("[2016-02-03]Challenge#252 [Hard] Spelling with Chemistry",
+                           252, "Hard", "Spelling with Chemistry")
+        self.assert_parses("[2015-10-05] Challenge #235 [Easy] Ruthless Bowling Scores ",
+                           235, "Easy", "Ruthless Bowling Scores")
+
+    def test_early_titles(self) -> None:
+        """ Titles from 2012, with other date formats, spellings and brackets. """
+        self.assert_parses("[8/13/2012] Challenge #88 [easy] (Vigen\u00e8re cipher)",
+                           88, "Easy", "(Vigen\u00e8re cipher)")
+        self.assert_parses("[02/13/12] Challenge #5 [difficult]", 5, "Hard", "")
+        self.assert_parses("Challenge #35 [INTERMEDIATE] Word Ladders",
+                           35, "Intermediate", "Word Ladders")
+        self.assert_parses("[2012-09-26] [Challenge #101] [Difficult] Boolean Functions",
+                           101, "Hard", "Boolean Functions")
+        self.assert_parses("[4/16/2012] Challenge #40 [difficult]", 40, "Hard", "")
+        self.assert_parses("[3/8/2012] Challenge #20 (easy)", 20, "Easy", "")
+        self.assert_parses("[2/18/2012] challenge #11 [intermediate]", 11, "Intermediate", "")
+        self.assert_parses("[5/3/2012] Challenge #47 [easy] ", 47, "Easy", "")
+        self.assert_parses("[7/4/2012] Challenge #72 [hard]\n", 72, "Hard", "")
+
+    def test_rejected_titles(self) -> None:
+        """ Posts that are not challenges, or do not say their level, are not parsed. """
+        for title in ["[Weekly #20] Paradigms",
+                      "[Meta] Challenge #300 is coming",
+                      "[Monthly Challenge #1 - Jan, 2013] Procedural World Generation",
+                      "[2017-01-02] Challenge #298 [Bonus] Parentheses",
+                      "[2014-01-20] Challenge #149 Disemvoweler",
+                      "[Easy] Challenge #42",
+                      "Challenge # [Easy] Nothing",
+                      "Moderator Challenge #5 [Easy]",
+                      ""]:
+            self.assertIsNone(parse_title(title), title)
+
+
+class LevelSamplerTest(unittest.TestCase):
+    """ Tests for drawing levels weighted by the number of languages for them. """
+    def setUp(self) -> None:
+        """ Weights the levels one, three and six to one another. """
+        self.counts = {"Easy": 1, "Intermediate": 3, "Hard": 6, "Bonus": 0}
+
+    def assert_frequencies(self, found: Dict[str, float], expected: Dict[str, float]) -> None:
+        """ Checks that each level came up about as often as expected. """
+        self.assertEqual(set(found), set(expected))
+        for level, fraction in expected.items():
+            self.assertAlmostEqual(found[level], fraction, delta=0.02, msg=level)
+
+    def test_draws_in_proportion_to_weight(self) -> None:
+        """ Levels come up in proportion to their weight, and never without any. """
+        sampler = LevelSampler(self.counts, random.Random(1234))
+        self.assert_frequencies(frequencies(sampler),
+                                {"Easy": 0.1, "Intermediate": 0.3, "Hard": 0.6})
+
+    def test_exclude_spreads_over_the_others(self) -> None:
+        """ An excluded level is never drawn, and the others keep their relative weights. """
+        sampler = LevelSampler(self.counts, random.Random(1234))
+        self.assert_frequencies(frequencies(sampler, exclude="Intermediate"),
+                                {"Easy": 1 / 7, "Hard": 6 / 7})
+        self.assert_frequencies(frequencies(sampler, exclude="Hard"),
+                                {"Easy": 0.25, "Intermediate": 0.75})
+
+    def test_exclude_only_level(self) -> None:
+        """ The excluded level is drawn if it is the only one. """
+        sampler = LevelSampler({"Hard": 2, "Easy": 0}, random.Random(1234))
+        self.assertEqual(sampler.choose(exclude="Hard"), "Hard")
+
+    def test_same_seed_same_draws(self) -> None:
+        """ Draws only depend on the random number generator. """
+        first = LevelSampler(self.counts, random.Random(99))
+        second = LevelSampler(self.counts, random.Random(99))
+        self.assertEqual([first.choose() for _ in range(50)], [second.choose() for _ in range(50)])
+
+    def test_adjust_changes_weights(self) -> None:
+        """ Adjusted weights are used from the next draw on. """
+        sampler = LevelSampler(self.counts, random.Random(1234))
+        self.assert_frequencies(frequencies(sampler),
+                                {"Easy": 0.1, "Intermediate": 0.3, "Hard": 0.6})
+        sampler.adjust("Easy", 3)
+        sampler.adjust("Hard", -2)
+        self.assert_frequencies(frequencies(sampler),
+                                {"Easy": 4 / 11, "Intermediate": 3 / 11, "Hard": 4 / 11})
+        sampler.adjust("Bonus", 1)
+        self.assert_frequencies(frequencies(sampler, exclude="Hard"),
+                                {"Easy": 0.5, "Intermediate": 0.375, "Bonus": 0.125})
+
+    def test_adjust_to_nothing_removes_level(self) -> None:
+        """ A level whose weight is adjusted to zero or below is never drawn again. """
+        sampler = LevelSampler(self.counts, random.Random(1234))
+        sampler.adjust("Hard", -10)
+        self.assert_frequencies(frequencies(sampler), {"Easy": 0.25, "Intermediate": 0.75})
+        sampler.adjust("Hard", 2)
+        self.assert_frequencies(frequencies(sampler),
+                                {"Easy": 1 / 6, "Intermediate": 0.5, "Hard": 1 / 3})
+        for level in ["Easy", "Intermediate", "Hard"]:
+            sampler.adjust(level, -5)
+        with self.assertRaises(ValueError):
+            sampler.choose()
+
+    def test_no_levels(self) -> None:
+        """ There is nothing to draw without any weight. """
+        with self.assertRaises(ValueError):
+            LevelSampler({"Easy": 0}).choose()
+
+
+if __name__ == "__main__":
+    unittest.main()
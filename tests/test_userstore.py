@@ -0,0 +1,263 @@
+""" Tests for saving and loading users in each kind of store. """
+
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from typing import Any, Dict, Iterator, List, Tuple
+from unittest import mock
+
+import userstore
+from user import User, load_users, save_users, to_json
+
+
+def make_users(count: int) -> Dict[str, User]:
+    """ Builds a few users with different languages. """
+    return {"user{}@example.com".format(i): User({"Easy": ["py", "lang{}".format(i)]}, i == 0,
+                                                 "py", "Easy", ["py"])
+            for i in range(count)}
+
+
+def as_json(users: Dict[str, User]) -> Dict[str, Dict[str, Any]]:
+    """ The stored form of some users, to compare them by value. """
+    return {address: to_json(user) for address, user in users.items()}
+
+
+class StoreTest(unittest.TestCase):
+    """ Base for tests of stores kept in a temporary directory. """
+    def setUp(self) -> None:
+        """ Makes the directory. """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        """ Removes the directory. """
+        shutil.rmtree(self.directory)
+
+    def open(self, name: str, create: bool = False) -> userstore.UserStore:
+        """ Opens a store in the directory, failing the test if it cannot be opened. """
+        return userstore.open_store(os.path.join(self.directory, name), create).extract(
+            self.fail, lambda store: store)
+
+    def contents(self, name: str) -> Dict[str, Dict[str, Any]]:
+        """ Reopens a store and reads every user out of it. """
+        store = self.open(name)
+        try:
+            return {address: to_json(user) for address, user in store.items()}
+        finally:
+            store.close()
+
+    def assert_round_trip(self, name: str) -> None:
+        """ Checks that adding, changing and removing users survives reopening the store. """
+        users = make_users(3)
+        store = self.open(name)
+        store.update(users)
+        store.save()
+        store.close()
+        self.assertEqual(self.contents(name), as_json(users))
+
+        store = self.open(name)
+        store["user1@example.com"].langs = {"Hard": ["go"]}
+        store["user1@example.com"].vetoed = True
+        store.tally.vote()
+        del store["user2@example.com"]
+        store["new@example.com"] = User({}, False, None, None)
+        store.save()
+        store.close()
+
+        expected = as_json(users)
+        expected["user1@example.com"] = to_json(User({"Hard": ["go"]}, True, "py", "Easy", ["py"]))
+        del expected["user2@example.com"]
+        expected["new@example.com"] = to_json(User({}, False, None, None))
+        self.assertEqual(self.contents(name), expected)
+        store = self.open(name)
+        self.assertEqual(store.tally.votes, 1)
+        store.close()
+
+    def assert_change_in_loop_is_saved(self, name: str) -> None:
+        """ Checks that a user changed inside a loop over items is saved after breaking out. """
+        store = self.open(name)
+        store.update(make_users(3))
+        store.save()
+        store.close()
+
+        store = self.open(name)
+        for address, user in store.items():
+            user.last_lang = "changed"
+            changed = address
+            break
+        store.save()
+        store.close()
+        found = self.contents(name)
+        self.assertEqual(found[changed]["last_lang"], "changed")
+        self.assertEqual(sorted(user["last_lang"] for user in found.values()),
+                         ["changed", "py", "py"])
+
+
+class JsonStoreTest(StoreTest):
+    """ Tests for keeping users in a json file with a journal of changes. """
+    def setUp(self) -> None:
+        """ Starts with an empty user file. """
+        super().setUp()
+        self.path = os.path.join(self.directory, "users.json")
+        self.journal = self.path + userstore.JOURNAL_SUFFIX
+        save_users({}, self.path)
+
+    def journal_lines(self) -> int:
+        """ The number of entries in the journal. """
+        if not os.path.exists(self.journal):
+            return 0
+        with open(self.journal, "rb") as handle:
+            return sum(1 for _ in handle)
+
+    def test_round_trip(self) -> None:
+        """ Changes are saved to the journal and read back. """
+        self.assert_round_trip("users.json")
+
+    def test_change_in_loop_is_saved(self) -> None:
+        """ A change made while iterating is saved when the loop is left early. """
+        self.assert_change_in_loop_is_saved("users.json")
+
+    def test_cut_off_journal_line_is_dropped(self) -> None:
+        """ A journal entry cut off by a crash is ignored and removed before new entries. """
+        store = self.open("users.json")
+        store.update(make_users(2))
+        store.save()
+        store.close()
+        with open(self.journal, "a") as handle:
+            handle.write('{"address": "user0@example.com", "user": {"lan')
+
+        store = self.open("users.json")
+        self.assertEqual(as_json(dict(store.items())), as_json(make_users(2)))
+        with open(self.journal, "rb") as handle:
+            self.assertTrue(handle.read().endswith(b"\n"))
+        store["user0@example.com"].last_lang = "go"
+        store.save()
+        store.close()
+        self.assertEqual(self.contents("users.json")["user0@example.com"]["last_lang"], "go")
+
+    def test_compacts_at_compact_min(self) -> None:
+        """ A small store's journal is folded into the json file once it passes COMPACT_MIN. """
+        store = self.open("users.json")
+        store.update(make_users(5))
+        store.save()
+        assert isinstance(store, userstore.JsonStore)
+        store.compact()
+        self.assertEqual(self.journal_lines(), 0)
+        for i in range(userstore.COMPACT_MIN):
+            store["user{}@example.com".format(i % 5)].last_lang = "lang{}".format(i)
+            store.save()
+        self.assertEqual(self.journal_lines(), userstore.COMPACT_MIN)
+
+        store["user0@example.com"].last_lang = "compacted"
+        store.save()
+        store.close()
+        self.assertEqual(self.journal_lines(), 0)
+        users = load_users(self.path).extract(self.fail, lambda users: users)
+        self.assertEqual(users["user0@example.com"].last_lang, "compacted")
+        self.assertEqual(len(users), 5)
+
+
+class SqliteStoreTest(StoreTest):
+    """ Tests for keeping users in a sqlite database. """
+    def test_round_trip(self) -> None:
+        """ Changes are committed on save and read back. """
+        self.assert_round_trip("users.db")
+
+    def test_change_in_loop_is_saved(self) -> None:
+        """ A change made while iterating is saved when the loop is left early. """
+        self.assert_change_in_loop_is_saved("users.db")
+
+    def test_refuses_to_hide_json_users(self) -> None:
+        """ A missing database is not created next to a json user file unless asked to. """
+        save_users(make_users(1), os.path.join(self.directory, "users.json"))
+        path = os.path.join(self.directory, "users.db")
+        self.assertTrue(userstore.open_store(path).is_err)
+        self.assertFalse(os.path.exists(path))
+        self.open("users.db", create=True).close()
+        self.assertTrue(os.path.exists(path))
+        self.open("users.db").close()
+
+
+class VetoTallyTest(unittest.TestCase):
+    """ Tests for counting the votes to veto a week's challenge. """
+    def test_votes_only_count_for_their_week(self) -> None:
+        """ Votes for the challenge of an earlier week do not count this week. """
+        tally = userstore.VetoTally("2017-W01", "Easy", 3)
+        self.assertEqual(tally.votes_for("2017-W01"), 3)
+        self.assertEqual(tally.votes_for("2017-W02"), 0)
+        tally.start_week("2017-W02", "Hard")
+        self.assertEqual(tally.votes_for("2017-W02"), 3)
+
+    def test_unknown_week_counts_every_vote(self) -> None:
+        """ A tally counted from the users, which does not know its week, counts every vote. """
+        tally = userstore.rebuild_tally(make_users(3).values())
+        self.assertEqual(tally.votes_for("2017-W02"), 1)
+
+
+class FailingUsers(Dict[str, User]):
+    """ Users that fail to be written part way through. """
+    def items(self) -> Iterator[Tuple[str, User]]: # type: ignore
+        yield from list(super().items())[:1]
+        raise OSError("disk full")
+
+
+class SaveUsersTest(StoreTest):
+    """ Tests for writing the json user file. """
+    def test_gzip_round_trip(self) -> None:
+        """ A path ending in .gz is written compressed and read back. """
+        path = os.path.join(self.directory, "users.json.gz")
+        save_users(make_users(3), path)
+        with gzip.open(path, "rt") as handle:
+            self.assertTrue(handle.read().startswith("{"))
+        self.assertEqual(as_json(load_users(path).extract(self.fail, lambda users: users)),
+                         as_json(make_users(3)))
+
+    def test_failed_save_keeps_old_file(self) -> None:
+        """ A save that fails leaves the old file and no temporary file behind. """
+        path = os.path.join(self.directory, "users.json")
+        save_users(make_users(2), path)
+        with self.assertRaises(OSError):
+            save_users(FailingUsers(make_users(3)), path)
+        self.assertEqual(os.listdir(self.directory), ["users.json"])
+        self.assertEqual(as_json(load_users(path).extract(self.fail, lambda users: users)),
+                         as_json(make_users(2)))
+
+    def test_syncs_directory(self) -> None:
+        """ The directory is synced after the new file is moved into it. """
+        path = os.path.join(self.directory, "users.json")
+        synced = [] # type: List[bool]
+        real_fsync = os.fsync
+
+        def fsync(handle: int) -> None:
+            """ Records whether a directory or a file was synced. """
+            synced.append(stat.S_ISDIR(os.fstat(handle).st_mode))
+            real_fsync(handle)
+
+        with mock.patch("os.fsync", fsync):
+            save_users(make_users(2), path)
+        self.assertEqual(synced, [False, True])
+
+    def test_failed_copymode_closes_file(self) -> None:
+        """ The temporary file is closed and removed if its mode cannot be set. """
+        path = os.path.join(self.directory, "users.json")
+        save_users(make_users(2), path)
+        before = len(os.listdir("/proc/self/fd"))
+        with mock.patch("shutil.copymode", side_effect=PermissionError("not allowed")):
+            with self.assertRaises(PermissionError):
+                save_users(make_users(3), path)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), before)
+        self.assertEqual(os.listdir(self.directory), ["users.json"])
+
+    def test_keeps_mode(self) -> None:
+        """ The new file has the same permissions as the one it replaces. """
+        path = os.path.join(self.directory, "users.json")
+        save_users(make_users(1), path)
+        os.chmod(path, 0o640)
+        save_users(make_users(2), path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+
+
+if __name__ == "__main__":
+    unittest.main()
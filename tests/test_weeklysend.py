@@ -0,0 +1,325 @@
+""" Tests for the weekly send. """
+
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import mail
+import userstore
+import weeklysend
+from catalog import Catalog
+from gmailstub import StubError, StubRequest, StubService
+from scraper import ChallengePost
+from user import HISTORY_LENGTH, User
+
+# Number of languages drawn when checking how often each language comes up
+DRAWS = 12000
+
+POST = ChallengePost("p1", "[2017-01-02] Challenge #300 [Easy] Thing", 300, "Easy",
+                     "/r/dailyprogrammer/p1", "<p>Do the thing</p>")
+
+
+def make_users(count: int) -> Dict[str, User]:
+    """ Builds users with a few languages, the first third of whom have vetoed. """
+    return {"user{:04}@example.com".format(i): User({"Easy": ["py", "go"]}, i < count // 3,
+                                                    "py", "Hard")
+            for i in range(count)}
+
+
+class RefusingService(StubService):
+    """ A service that refuses to send to some addresses. """
+    def __init__(self, refused: Set[str]) -> None:
+        super().__init__()
+        self.refused = refused
+
+    def handle(self, request: StubRequest) -> Dict[str, Any]:
+        """ Fails sends to the refused addresses, and handles other requests. """
+        if request.method == "send" and any("To: {}\n".format(address) in request.key
+                                             for address in self.refused):
+            raise StubError(400)
+        return super().handle(request)
+
+
+def recipients(service: StubService) -> Set[str]:
+    """ The addresses a service sent messages to. """
+    return {line[len(b"To: "):].decode("ASCII") for raw in service.sent
+            for line in raw.split(b"\n") if line.startswith(b"To: ")}
+
+
+def frequencies(draw: Callable[[], Optional[str]]) -> Dict[Optional[str], float]:
+    """ The fraction of draws that came up as each language. """
+    counts = Counter(draw() for _ in range(DRAWS))
+    return {lang: count / DRAWS for (lang, count) in counts.items()}
+
+
+class StoreTest(unittest.TestCase):
+    """ Base for tests that keep users in a sqlite store in a temporary directory. """
+    def setUp(self) -> None:
+        """ Makes the directory the store is kept in, and lifts the limit on the send rate. """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "users.db")
+        self.send_rate = mail.SEND_RATE, mail.SEND_BURST
+        mail.SEND_RATE, mail.SEND_BURST = 1e6, 10000
+
+    def tearDown(self) -> None:
+        """ Removes the directory and restores the send rate. """
+        shutil.rmtree(self.directory)
+        mail.SEND_RATE, mail.SEND_BURST = self.send_rate
+
+    def fill(self, users: Dict[str, User]) -> None:
+        """ Stores users in the database. """
+        store = userstore.open_store(self.path).extract(self.fail, lambda s: s)
+        store.update(users)
+        store.tally = userstore.rebuild_tally(users.values())
+        store.save()
+        store.close()
+
+    def reopen(self) -> userstore.UserStore:
+        """ Opens the store without any users loaded. """
+        return userstore.open_store(self.path).extract(self.fail, lambda s: s)
+
+
+class SendMessagesTest(StoreTest):
+    """ Tests for sending this week's challenge to every user. """
+    def test_users_are_streamed(self) -> None:
+        """ Recipients are written back as they are sent to rather than kept in memory. """
+        self.fill(make_users(1200))
+        store = self.reopen()
+        outcomes = weeklysend.send_messages(store, StubService(), "Easy", POST,
+                                            weeklysend.different_lang)
+        self.assertEqual(len(outcomes), 1200)
+        self.assertTrue(all(outcome.is_ok for outcome in outcomes.values()))
+        self.assertEqual(len(store._loaded), 0) # type: ignore # pylint: disable=protected-access
+        self.assertEqual(store.tally.votes, 0)
+        store.save()
+        store.close()
+
+        store = self.reopen()
+        self.assertEqual({(user.last_level, user.last_lang, user.vetoed)
+                          for user in store.values()}, {("Easy", "go", False)})
+        store.close()
+
+
+class SendJournalTest(unittest.TestCase):
+    """ Tests for recording the progress of a send. """
+    def setUp(self) -> None:
+        """ Picks a path for the journal. """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "journal.json")
+
+    def tearDown(self) -> None:
+        """ Removes the journal. """
+        shutil.rmtree(self.directory)
+
+    def test_resume_reads_progress(self) -> None:
+        """ A resumed journal knows who was reached and who failed. """
+        journal = weeklysend.SendJournal.start(self.path, "2017-W01", "Easy", "p1")
+        journal.record("a@x", "py")
+        journal.record("b@x", None)
+        journal.record_failure("c@x", "HTTP 400")
+        journal.record_failure("c@x", "HTTP 400")
+        resumed = weeklysend.SendJournal.resume(self.path, "2017-W01")
+        assert resumed is not None
+        self.assertEqual((resumed.week, resumed.level, resumed.post_id),
+                         ("2017-W01", "Easy", "p1"))
+        self.assertEqual(resumed.done, {"a@x": "py", "b@x": None})
+        self.assertEqual(resumed.failures, {"c@x": 2})
+
+    def test_resume_drops_cut_off_line(self) -> None:
+        """ A line that was cut off by a crash is ignored. """
+        journal = weeklysend.SendJournal.start(self.path, "2017-W01", "Easy", "p1")
+        journal.record("a@x", "py")
+        with open(self.path, "a") as handle:
+            handle.write('{"address": "b@x", "la')
+        resumed = weeklysend.SendJournal.resume(self.path, "2017-W01")
+        assert resumed is not None
+        self.assertEqual(resumed.done, {"a@x": "py"})
+
+    def test_resume_other_week(self) -> None:
+        """ A journal from another week, or no journal at all, is not resumed. """
+        self.assertIsNone(weeklysend.SendJournal.resume(self.path, "2017-W01"))
+        weeklysend.SendJournal.start(self.path, "2017-W01", "Easy", "p1")
+        self.assertIsNone(weeklysend.SendJournal.resume(self.path, "2017-W02"))
+
+    def test_gives_up_after_max_attempts(self) -> None:
+        """ A recipient is given up on after MAX_SEND_ATTEMPTS failures. """
+        journal = weeklysend.SendJournal.start(self.path, "2017-W01", "Easy", "p1")
+        for _ in range(weeklysend.MAX_SEND_ATTEMPTS - 1):
+            journal.record_failure("c@x", "HTTP 400")
+        self.assertFalse(journal.gave_up("c@x"))
+        journal.record_failure("c@x", "HTTP 400")
+        self.assertTrue(journal.gave_up("c@x"))
+
+
+class SendJournaledTest(StoreTest):
+    """ Tests for sending, and resuming, the send recorded in a journal. """
+    def setUp(self) -> None:
+        """ Adds a catalog holding the post and a journal for sending it. """
+        super().setUp()
+        self.catalog = Catalog(sqlite3.connect(":memory:"))
+        self.catalog.add([POST])
+        self.journal_path = os.path.join(self.directory, "journal.json")
+        self.fill(make_users(6))
+
+    def tearDown(self) -> None:
+        """ Closes the catalog. """
+        self.catalog.close()
+        super().tearDown()
+
+    def send(self, service: StubService) -> bool:
+        """ Resumes or starts the send in the journal, returning whether every send worked. """
+        journal = weeklysend.SendJournal.resume(self.journal_path, weeklysend.this_week())
+        if journal is None:
+            journal = weeklysend.SendJournal.start(self.journal_path, weeklysend.this_week(),
+                                                   "Easy", POST.id)
+        store = self.reopen()
+        try:
+            result = weeklysend.send_journaled(store, service, self.catalog, journal,
+                                               weeklysend.different_lang, None)
+            store.save()
+        finally:
+            store.close()
+        return result.is_ok
+
+    def test_resume_skips_reached_recipients(self) -> None:
+        """ Recipients the journal lists as reached are given their language but not mailed. """
+        journal = weeklysend.SendJournal.start(self.journal_path, weeklysend.this_week(),
+                                               "Easy", POST.id)
+        journal.record("user0000@example.com", "py")
+        journal.record("user0001@example.com", "go")
+        service = StubService()
+        self.assertTrue(self.send(service))
+        self.assertEqual(recipients(service), {"user{:04}@example.com".format(i)
+                                               for i in range(2, 6)})
+        self.assertFalse(os.path.exists(self.journal_path))
+        store = self.reopen()
+        self.assertEqual(store["user0000@example.com"].last_lang, "py")
+        self.assertEqual(store["user0001@example.com"].last_lang, "go")
+        self.assertEqual({user.last_level for user in store.values()}, {"Easy"})
+        store.close()
+
+    def test_journal_outlives_failed_send(self) -> None:
+        """ A failed send leaves the journal, and resuming it only retries the failure. """
+        refused = "user0003@example.com"
+        service = RefusingService({refused})
+        self.assertFalse(self.send(service))
+        self.assertEqual(len(recipients(service)), 5)
+        journal = weeklysend.SendJournal.resume(self.journal_path, weeklysend.this_week())
+        assert journal is not None
+        self.assertEqual(len(journal.done), 5)
+        self.assertEqual(journal.failures, {refused: 1})
+        store = self.reopen()
+        self.assertEqual(store[refused].last_level, "Hard")
+        store.close()
+
+        retry = StubService()
+        self.assertTrue(self.send(retry))
+        self.assertEqual(recipients(retry), {refused})
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_permanent_failure_is_given_up(self) -> None:
+        """ A recipient that always fails stops the journal being resumed after a few tries. """
+        refused = "user0003@example.com"
+        for attempt in range(weeklysend.MAX_SEND_ATTEMPTS):
+            self.assertTrue(os.path.exists(self.journal_path) or attempt == 0)
+            self.assertFalse(self.send(RefusingService({refused})))
+        self.assertFalse(os.path.exists(self.journal_path))
+
+
+class LangPolicyTest(unittest.TestCase):
+    """ Tests for choosing the language each user is sent, with the random module seeded. """
+    def setUp(self) -> None:
+        """ Seeds the random module, saving its state. """
+        self.state = random.getstate()
+        random.seed(1234)
+
+    def tearDown(self) -> None:
+        """ Restores the random module. """
+        random.setstate(self.state)
+
+    def assert_uniform(self, found: Dict[Optional[str], float], langs: Set[str]) -> None:
+        """ Checks that each language came up about as often as the others, and no others did. """
+        self.assertEqual(set(found), langs)
+        for lang in langs:
+            self.assertAlmostEqual(found[lang], 1 / len(langs), delta=0.02, msg=lang)
+
+    def test_pick_other(self) -> None:
+        """ The excluded language is never picked, and the rest are picked evenly. """
+        langs = ["a", "b", "c", "d"]
+        self.assert_uniform(frequencies(lambda: weeklysend.pick_other(langs, "b")),
+                            {"a", "c", "d"})
+        self.assert_uniform(frequencies(lambda: weeklysend.pick_other(langs, "a")),
+                            {"b", "c", "d"})
+        self.assert_uniform(frequencies(lambda: weeklysend.pick_other(langs, "d")),
+                            {"a", "b", "c"})
+        self.assert_uniform(frequencies(lambda: weeklysend.pick_other(langs, None)), set(langs))
+        self.assertEqual(weeklysend.pick_other(["a"], "a"), "a")
+        self.assertIsNone(weeklysend.pick_other([], "a"))
+
+    def test_different_lang(self) -> None:
+        """ The language the user was sent last is avoided. """
+        user = User({"Easy": ["py", "go", "c"]}, False, "go", "Easy")
+        self.assert_uniform(frequencies(lambda: weeklysend.different_lang(user, "Easy")),
+                            {"py", "c"})
+
+    def test_round_robin_lang(self) -> None:
+        """ Languages are sent in the order the user listed them, wrapping around. """
+        user = User({"Easy": ["py", "go", "c"]}, False, "go", "Easy", ["go"])
+        sent = [] # type: List[Optional[str]]
+        for _ in range(7):
+            lang = weeklysend.round_robin_lang(user, "Easy")
+            user.assign(lang)
+            sent.append(lang)
+        self.assertEqual(sent, ["c", "py", "go", "c", "py", "go", "c"])
+
+    def test_round_robin_after_removed_lang(self) -> None:
+        """ A last language the user no longer has falls back to the least recently sent one. """
+        user = User({"Easy": ["py", "go", "c"]}, False, "rust", "Easy", ["go", "py", "rust"])
+        self.assertEqual(weeklysend.round_robin_lang(user, "Easy"), "c")
+        user.history = ["c", "go", "py", "rust"]
+        self.assertEqual(weeklysend.round_robin_lang(user, "Easy"), "c")
+
+    def test_least_recent_lang(self) -> None:
+        """ Languages never sent come first, then the one sent longest ago. """
+        user = User({"Easy": ["py", "go", "c", "js"]}, False, "go", "Easy", ["py", "go"])
+        self.assert_uniform(frequencies(lambda: weeklysend.least_recent_lang(user, "Easy")),
+                            {"c", "js"})
+        user.history = ["js", "c", "py", "c", "go"]
+        self.assertEqual(weeklysend.least_recent_lang(user, "Easy"), "js")
+        user.history = ["js", "c", "py", "js", "go"]
+        self.assertEqual(weeklysend.least_recent_lang(user, "Easy"), "c")
+        self.assertIsNone(weeklysend.least_recent_lang(User({"Easy": []}, False, None, None),
+                                                       "Easy"))
+
+    def test_avoid_recent_lang(self) -> None:
+        """ The last few languages sent are avoided, unless every language was sent recently. """
+        policy = weeklysend.avoid_recent_lang(2)
+        user = User({"Easy": ["py", "go", "c", "js"]}, False, "go", "Easy", ["js", "py", "go"])
+        self.assert_uniform(frequencies(lambda: policy(user, "Easy")), {"c", "js"})
+        user.history = ["c", "js", "py", "go"]
+        self.assert_uniform(frequencies(lambda: policy(user, "Easy")), {"c", "js"})
+        user.langs = {"Easy": ["py", "go"]}
+        self.assertEqual(policy(user, "Easy"), "py")
+
+    def test_history_is_capped(self) -> None:
+        """ Only the last HISTORY_LENGTH languages are kept, and repeats are recorded once. """
+        user = User({}, False, None, None)
+        for i in range(HISTORY_LENGTH + 4):
+            user.assign("lang{}".format(i))
+        self.assertEqual(user.history,
+                         ["lang{}".format(i) for i in range(4, HISTORY_LENGTH + 4)])
+        last = user.history[-1]
+        user.assign(last)
+        user.assign(None)
+        self.assertEqual(len(user.history), HISTORY_LENGTH)
+        self.assertEqual(user.history[-1], last)
+        self.assertIsNone(user.last_lang)
+
+
+if __name__ == "__main__":
+    unittest.main()
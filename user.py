@@ -3,18 +3,23 @@ Module containing data structures for internal state as well as functions for
 reading and writing the state.
 """
 
-from typing import Dict, List, Optional
+from typing import Any, Dict, IO, List, Mapping, Optional, cast
+import gzip
 import json
+import os
+import shutil
+import sys
+import tempfile
 
 from jsonparse import (
-    run_parser_file,
-    field,
-    done,
+    run_dict_parser_file,
+    record_parser,
     str_parser,
     dict_parser,
     list_parser,
     bool_parser,
-    optional_parser
+    optional_parser,
+    Parser
 )
 from result import Result
 
@@ -22,6 +27,15 @@ from result import Result
 # Path to the file where user data is stored
 PATH = "users.json"
 
+# Size of the buffer used when writing the user file
+WRITE_BUFFER = 1024 * 1024
+
+# Number of recently assigned languages remembered for each user
+HISTORY_LENGTH = 8
+
+# Encodes json without any extra whitespace
+_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
 
 class User(object): # pylint: disable=too-few-public-methods
     """A user in the system.
@@ -31,12 +45,20 @@ class User(object): # pylint: disable=too-few-public-methods
         vetoed: If the user has vetoed this week's challenge
         last_lang: The last language the user was assigned
         last_level: The last level that was mailed out
+        history: The most recently assigned languages, oldest first
+        changed: If the user has been modified since it was loaded or saved
+
+    Users are stored in slots rather than a __dict__, and the level and language names they hold
+    are interned, so the many users sharing a language also share one copy of its name.
     """
+    __slots__ = ("langs", "vetoed", "last_lang", "last_level", "history", "changed")
+
     def __init__(self,
                  langs: Dict[str, List[str]],
                  vetoed: bool,
                  last_lang: Optional[str],
-                 last_level: Optional[str]
+                 last_level: Optional[str],
+                 history: Optional[List[str]] = None
                 ) -> None:
         """Populates all the fields of a new user.
 
@@ -45,11 +67,43 @@ class User(object): # pylint: disable=too-few-public-methods
             vetoed: If the user has vetoed this week's challenge
             last_lang: The last language the user was assigned
             last_level: The last level that was mailed out
+            history: The most recently assigned languages, oldest first
         """
         self.langs = langs
         self.vetoed = vetoed
         self.last_lang = last_lang
         self.last_level = last_level
+        self.history = history if history is not None else []
+        self.changed = True
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Sets an attribute, remembering that the user has changed."""
+        if name == "langs":
+            value = intern_langs(value)
+        elif name == "history":
+            value = [sys.intern(lang) for lang in value[-HISTORY_LENGTH:]]
+        elif isinstance(value, str):
+            value = sys.intern(value)
+        object.__setattr__(self, name, value)
+        if name != "changed":
+            object.__setattr__(self, "changed", True)
+
+    def touch(self) -> None:
+        """Marks the user as changed after langs has been modified in place."""
+        self.changed = True
+
+    def assign(self, lang: Optional[str]) -> None:
+        """Records the language the user was sent.
+
+        A language the user was also sent last time is not added to the history again, so resending
+        a challenge does not count twice.
+
+        Args:
+            lang: The language, or None if the user could pick any language
+        """
+        self.last_lang = lang
+        if lang is not None and self.history[-1:] != [lang]:
+            self.history = self.history + [lang]
 
     def __repr__(self) -> str:
         """String representation of the user."""
@@ -61,27 +115,123 @@ class User(object): # pylint: disable=too-few-public-methods
         )
 
 
-def load_users() -> Result[str, Dict[str, User]]:
+def intern_langs(langs: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Interns the level and language names in a map from levels to languages.
+
+    Args:
+        langs: The languages to intern
+
+    Returns:
+        A copy of langs that shares its strings with every other interned copy
+    """
+    return {sys.intern(level): [sys.intern(lang) for lang in languages]
+            for level, languages in langs.items()}
+
+
+def _stored_user(langs: Dict[str, List[str]],
+                 vetoed: bool,
+                 last_lang: Optional[str],
+                 last_level: Optional[str],
+                 history: List[str]
+                ) -> User:
+    """Builds a user that was read from disk, and so has not changed."""
+    user = User(langs, vetoed, last_lang, last_level, history)
+    user.changed = False
+    return user
+
+
+# Parses a single user record
+USER_PARSER = record_parser({"langs": dict_parser(list_parser(str_parser)),
+                             "vetoed": bool_parser,
+                             "last_lang": optional_parser(str_parser),
+                             "last_level": optional_parser(str_parser),
+                             "history": list_parser(str_parser)},
+                            _stored_user,
+                            # users saved before languages were tracked have no history
+                            {"history": []}) # type: Parser[User]
+
+
+def to_json(user: User) -> Dict[str, Any]:
+    """Converts a user to the json object it is stored as.
+
+    Args:
+        user: The user to convert
+
+    Returns:
+        A dictionary that can be passed to json.dump
+    """
+    return {"langs": user.langs,
+            "vetoed": user.vetoed,
+            "last_lang": user.last_lang,
+            "last_level": user.last_level,
+            "history": user.history}
+
+
+def load_users(path: str = PATH) -> Result[str, Dict[str, User]]:
     """Load the users from disk.
 
+    Args:
+        path: The json file to read
+
     Returns:
         A map from email address to the user, or an Err if there was a problem during loading.
     """
-    # pylint: disable=bad-continuation
-    user_parser = field("langs", dict_parser(list_parser(str_parser)), lambda langs:
-                  field("vetoed", bool_parser, lambda vetoed:
-                  field("last_lang", optional_parser(str_parser), lambda last_lang:
-                  field("last_level", optional_parser(str_parser), lambda last_level:
-                  done(User(langs, vetoed, last_lang, last_level)))))) # pylint: disable=undefined-variable
-    # pylint: enable=bad-continuation
-    return run_parser_file(PATH, dict_parser(user_parser))
+    return run_dict_parser_file(path, USER_PARSER)
 
 
-def save_users(users: Dict[str, User]) -> None:
+def save_users(users: Mapping[str, User], path: str = PATH) -> None:
     """Saves a map of addresses to users to disk, overwriting any data currently stored.
 
+    The users are written compactly to a temporary file next to path, which is synced to disk once
+    and then moved over path, so a crash never leaves a partially written file behind. The
+    directory is synced after the move so the new file survives a crash as well. If path ends in
+    .gz the file is gzip compressed.
+
     Args:
         users: The map of users to write
+        path: The json file to write
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".")
+    try:
+        # the file object owns the descriptor from here on, and closes it even if writing fails
+        with open(handle, "wb", buffering=WRITE_BUFFER) as raw:
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+            if path.endswith(".gz"):
+                with gzip.GzipFile(fileobj=raw, mode="wb") as compressed:
+                    _write_users(cast(IO[bytes], compressed), users)
+            else:
+                _write_users(raw, users)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    sync_directory(directory)
+
+
+def sync_directory(directory: str) -> None:
+    """Syncs a directory to disk, so that a file just moved into it is still there after a crash.
+
+    Args:
+        directory: The directory to sync
     """
-    raw = {address: user.__dict__ for (address, user) in users.items()}
-    json.dump(raw, open(PATH, "w"), indent=2)
+    handle = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def _write_users(handle: IO[bytes], users: Mapping[str, User]) -> None:
+    """Writes users as a json object one entry at a time."""
+    separator = b"{"
+    for address, user in users.items():
+        handle.write(separator)
+        handle.write(_ENCODER.encode(address).encode("utf-8"))
+        handle.write(b":")
+        handle.write(_ENCODER.encode(to_json(user)).encode("utf-8"))
+        separator = b","
+    handle.write(b"}\n" if separator == b"," else b"{}\n")
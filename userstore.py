@@ -0,0 +1,523 @@
+"""
+Storage backends for the user state.
+
+A store behaves like a mutable map from email address to user. Changes made through the map, or to
+the users read from it, are written to disk when the store is saved.
+"""
+
+from collections import Counter
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, MutableMapping, Optional, Set, Tuple, cast
+
+from jsonparse import record_parser, optional_parser, str_parser, int_parser, run_parser_file
+from result import Result, Ok, Err
+from user import (
+    User,
+    USER_PARSER,
+    load_users,
+    save_users,
+    sync_directory,
+    to_json,
+    PATH as JSON_PATH
+)
+
+
+# Path to the database where user data is stored
+PATH = "users.db"
+
+# Number of records read from the database at a time when iterating
+PAGE_SIZE = 500
+
+# Suffix of the journal kept next to a json user file
+JOURNAL_SUFFIX = ".journal"
+
+# Suffix of the file the veto tally is kept in next to a json user file
+TALLY_SUFFIX = ".tally"
+
+# Smallest number of journal entries that will cause the journal to be compacted
+COMPACT_MIN = 100
+
+# Parses an entry in the journal. A missing user means the user was deleted
+_ENTRY_PARSER = record_parser({"address": str_parser, "user": optional_parser(USER_PARSER)},
+                              lambda address, user: (address, user))
+
+
+class VetoTally(object):
+    """The votes to veto this week's challenge.
+
+    The tally is kept up to date as users veto and are sent challenges, so checking whether a
+    challenge has been vetoed does not need to look at every user.
+
+    Attributes:
+        week: The week the current challenge was sent, if known
+        level: The level of the current challenge, if known
+        votes: The number of users who have vetoed the current challenge
+        changed: If the tally has been modified since it was loaded or saved
+    """
+    def __init__(self, week: Optional[str], level: Optional[str], votes: int) -> None:
+        """Populates all the fields of a tally.
+
+        Args:
+            week: The week the current challenge was sent, if known
+            level: The level of the current challenge, if known
+            votes: The number of users who have vetoed the current challenge
+        """
+        self.week = week
+        self.level = level
+        self.votes = votes
+        self.changed = True
+
+    def vote(self) -> None:
+        """Counts a veto."""
+        self.votes += 1
+        self.changed = True
+
+    def unvote(self) -> None:
+        """Removes a veto, when a user who vetoed is sent a new challenge or unsubscribes."""
+        self.votes = max(0, self.votes - 1)
+        self.changed = True
+
+    def votes_for(self, week: str) -> int:
+        """Counts the votes to veto the challenge sent in the given week.
+
+        Votes left over from a challenge sent in an earlier week do not count. If the week of the
+        current challenge is not known every vote counts.
+
+        Args:
+            week: The week to count votes for, as returned by weeklysend.this_week
+
+        Returns:
+            The number of votes
+        """
+        return self.votes if self.week is None or self.week == week else 0
+
+    def start_week(self, week: str, level: str) -> None:
+        """Records that a challenge at the given level is being sent for a week."""
+        self.week = week
+        self.level = level
+        self.changed = True
+
+    def __repr__(self) -> str:
+        """String representation of the tally."""
+        return "VetoTally(week={}, level={}, votes={})".format(
+            repr(self.week), repr(self.level), repr(self.votes))
+
+
+def _stored_tally(week: Optional[str], level: Optional[str], votes: int) -> VetoTally:
+    """Builds a tally that was read from disk, and so has not changed."""
+    tally = VetoTally(week, level, votes)
+    tally.changed = False
+    return tally
+
+
+# Parses a stored tally
+TALLY_PARSER = record_parser({"week": optional_parser(str_parser),
+                              "level": optional_parser(str_parser),
+                              "votes": int_parser},
+                             _stored_tally)
+
+
+def tally_json(tally: VetoTally) -> Dict[str, Any]:
+    """Converts a tally to the json object it is stored as."""
+    return {"week": tally.week, "level": tally.level, "votes": tally.votes}
+
+
+def rebuild_tally(users: Iterable[User]) -> VetoTally:
+    """Counts the vetoes of every user, for stores that do not have a tally yet.
+
+    Args:
+        users: Every user
+
+    Returns:
+        The tally. The level is the one most users were last sent, and the week is not known
+    """
+    votes = 0
+    levels = Counter() # type: Counter[Optional[str]]
+    for user in users:
+        votes += 1 if user.vetoed else 0
+        levels[user.last_level] += 1
+    common = levels.most_common(1)
+    return VetoTally(None, common[0][0] if common else None, votes)
+
+
+class UserStore(MutableMapping[str, User]): # pylint: disable=abstract-method
+    """A map from email address to user that can be saved to disk.
+
+    Attributes:
+        tally: The votes to veto this week's challenge, saved along with the users
+    """
+    def __init__(self, tally: VetoTally) -> None:
+        """Sets up the parts common to every store.
+
+        Args:
+            tally: The votes to veto this week's challenge
+        """
+        self.tally = tally
+
+    def write(self, address: str, user: User) -> None:
+        """Stores a user without keeping it in memory any longer than the store already does.
+
+        Use this rather than assignment to write back users while iterating over every user.
+
+        Args:
+            address: The address of the user
+            user: The user to store
+        """
+        self[address] = user
+
+    def save(self) -> None:
+        """Writes any changes to disk."""
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """Releases any resources held by the store without saving."""
+        pass
+
+
+class JsonStore(UserStore):
+    """Keeps every user in memory, stored in a json file and a journal of changes next to it.
+
+    Saving appends the users that changed since the last save to the journal, along with the tally
+    if it changed. Only the users that have been looked up or stored are checked for changes, and
+    users changed while iterating over items or values are noted as the iteration moves past them.
+    Once the journal has as many entries as there are users it is folded back into the json file,
+    and the tally is written to its own file.
+
+    Attributes:
+        path: The json file the users are stored in
+        journal_path: The journal of changes since the json file was last written
+        tally_path: The file the tally is written to when the journal is folded
+    """
+    def __init__(self,
+                 path: str,
+                 users: Dict[str, User],
+                 journal_entries: int = 0,
+                 tally: Optional[VetoTally] = None
+                ) -> None:
+        """Wraps a map of users that was loaded from the given path.
+
+        Args:
+            path: The json file the users are stored in
+            users: The users currently stored in the file and its journal
+            journal_entries: The number of entries currently in the journal
+            tally: The stored tally, or None to count the vetoes of the users
+        """
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.tally_path = path + TALLY_SUFFIX
+        super().__init__(tally if tally is not None else rebuild_tally(users.values()))
+        self._users = users
+        self._deleted = set() # type: Set[str]
+        # users that were looked up or stored, and so may have changed. Like the loaded users of a
+        # SqliteStore these are kept across saves, because callers may still hold on to them
+        self._dirty = {address for address, user in users.items() if user.changed}
+        self._journal_entries = journal_entries
+
+    def __getitem__(self, address: str) -> User:
+        user = self._users[address]
+        self._dirty.add(address)
+        return user
+
+    def __setitem__(self, address: str, user: User) -> None:
+        self._users[address] = user
+        self._dirty.add(address)
+        self._deleted.discard(address)
+
+    def __delitem__(self, address: str) -> None:
+        del self._users[address]
+        self._dirty.discard(address)
+        self._deleted.add(address)
+
+    def __contains__(self, address: object) -> bool:
+        return address in self._users
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._users)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def items(self) -> Iterator[Tuple[str, User]]: # type: ignore
+        for address, user in self._users.items():
+            try:
+                yield address, user
+            finally:
+                if user.changed:
+                    self._dirty.add(address)
+
+    def values(self) -> Iterator[User]: # type: ignore
+        return (user for (_, user) in self.items())
+
+    def save(self) -> None:
+        entries = [{"address": address, "user": None}
+                   for address in self._deleted] # type: List[Dict[str, Any]]
+        entries.extend({"address": address, "user": to_json(self._users[address])}
+                       for address in self._dirty if self._users[address].changed)
+        if self.tally.changed:
+            entries.append({"tally": tally_json(self.tally)})
+        if not entries:
+            return
+        if self._journal_entries + len(entries) > max(COMPACT_MIN, len(self._users)):
+            self.compact()
+            return
+        with open(self.journal_path, "a") as handle:
+            handle.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            handle.flush()
+            os.fsync(handle.fileno())
+        self._journal_entries += len(entries)
+        self._mark_saved()
+
+    def compact(self) -> None:
+        """Rewrites the json file with every user and empties the journal."""
+        _write_json(self.tally_path, tally_json(self.tally))
+        save_users(self._users, self.path)
+        # replaying the journal onto the new file is harmless if we die before truncating it
+        open(self.journal_path, "w").close()
+        self._journal_entries = 0
+        self._mark_saved()
+
+    def _mark_saved(self) -> None:
+        """Forgets all changes, because they are on disk."""
+        self._deleted.clear()
+        self.tally.changed = False
+        for address in self._dirty:
+            self._users[address].changed = False
+
+
+def _write_json(path: str, obj: Any) -> None:
+    """Replaces a small json file, so that a crash leaves either the old or the new contents."""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as handle:
+        json.dump(obj, handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temp_path, path)
+    sync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def replay_journal(path: str,
+                   users: Dict[str, User]) -> Result[str, Tuple[int, Optional[VetoTally]]]:
+    """Applies the changes recorded in a journal to a map of users.
+
+    A final line without a newline was cut off while being written, and is removed.
+
+    Args:
+        path: The journal to read. A journal that does not exist is empty
+        users: The users to update
+
+    Returns:
+        The number of entries in the journal and the last tally recorded in it, or an Err if it
+        could not be read
+    """
+    tally = None # type: Optional[VetoTally]
+    if not os.path.exists(path):
+        return Ok((0, tally))
+    count = 0
+    complete = 0
+    try:
+        with open(path, "rb") as handle:
+            for line in handle:
+                if not line.endswith(b"\n"):
+                    # drop the partial entry so new entries are not appended onto it
+                    os.truncate(path, complete)
+                    break
+                complete += len(line)
+                count += 1
+                raw = json.loads(line)
+                if isinstance(raw, dict) and "tally" in raw:
+                    parsed = TALLY_PARSER(raw["tally"])
+                    if parsed.is_err:
+                        return Err("Bad tally in {}: {}".format(path, parsed._value)) # pylint: disable=protected-access
+                    tally = cast(VetoTally, parsed._value) # pylint: disable=protected-access
+                    continue
+                entry = _ENTRY_PARSER(raw)
+                if entry.is_err:
+                    return Err("Bad entry in {}: {}".format(path, entry._value)) # pylint: disable=protected-access
+                address, user = cast(Tuple[str, Optional[User]], entry._value) # pylint: disable=protected-access
+                if user is None:
+                    users.pop(address, None)
+                else:
+                    users[address] = user
+    except (OSError, ValueError) as exn:
+        return Err(str(exn))
+    return Ok((count, tally))
+
+
+def _load_json_store(path: str) -> Result[str, UserStore]:
+    """Loads a json user file and its tally, and replays its journal."""
+    tally_path = path + TALLY_SUFFIX
+    stored = Ok(None) # type: Result[str, Optional[VetoTally]]
+    if os.path.exists(tally_path):
+        stored = run_parser_file(tally_path, optional_parser(TALLY_PARSER))
+
+    def with_users(users: Dict[str, User], tally: Optional[VetoTally]) -> Result[str, UserStore]:
+        """Replays the journal onto the loaded users"""
+        return replay_journal(path + JOURNAL_SUFFIX, users).fmap(
+            lambda replayed: cast(UserStore, JsonStore(path, users, replayed[0],
+                                                       replayed[1] or tally)))
+
+    return stored.bind(lambda tally: load_users(path).bind(lambda users: with_users(users, tally)))
+
+
+class SqliteStore(UserStore):
+    """Keeps users in a sqlite database keyed by address.
+
+    Users are only read from the database when they are looked up, and only the users that have
+    changed are written back on save. Iterating over items or values streams users from
+    the database. Users changed during that iteration are written back as the iteration moves past
+    them rather than being kept in memory, so they should only be modified inside the loop.
+
+    The tally is kept in a meta table and written in the same transaction as the users.
+    """
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        """Wraps an open database connection.
+
+        Args:
+            connection: The connection to the database
+        """
+        self._connection = connection
+        self._connection.execute("CREATE TABLE IF NOT EXISTS users "
+                                 "(address TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                                 "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._loaded = dict() # type: Dict[str, User]
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'tally'").fetchone()
+        if row is None:
+            # stores from before the tally was kept have it counted once
+            tally = rebuild_tally(self._parse(address, data) for (address, data) in self._rows())
+        else:
+            stored = TALLY_PARSER(json.loads(row[0]))
+            if stored.is_err:
+                raise ValueError("Bad tally: {}".format(stored._value)) # pylint: disable=protected-access
+            tally = cast(VetoTally, stored._value) # pylint: disable=protected-access
+        super().__init__(tally)
+
+    def _parse(self, address: str, data: str) -> User:
+        """Parses a stored user, raising ValueError if the record is corrupt."""
+        return USER_PARSER(json.loads(data)).extract(
+            err_func=lambda err: _throw(ValueError("Bad record for {}: {}".format(address, err))),
+            ok_func=lambda user: user
+        )
+
+    def _write(self, address: str, user: User) -> None:
+        """Writes a user to the database. The change is not committed until save."""
+        self._connection.execute("INSERT OR REPLACE INTO users (address, data) VALUES (?, ?)",
+                                 (address, json.dumps(to_json(user))))
+        user.changed = False
+
+    def _rows(self) -> Iterator[Tuple[str, str]]:
+        """Streams the raw records of all users.
+
+        Records are fetched a page at a time, so the table can be written to between pages.
+        """
+        last = ""
+        while True:
+            page = self._connection.execute("SELECT address, data FROM users WHERE address > ? "
+                                            "ORDER BY address LIMIT ?",
+                                            (last, PAGE_SIZE)).fetchall()
+            yield from page
+            if len(page) < PAGE_SIZE:
+                return
+            last = page[-1][0]
+
+    def __getitem__(self, address: str) -> User:
+        if address in self._loaded:
+            return self._loaded[address]
+        row = self._connection.execute("SELECT data FROM users WHERE address = ?",
+                                       (address,)).fetchone()
+        if row is None:
+            raise KeyError(address)
+        user = self._parse(address, row[0])
+        self._loaded[address] = user
+        return user
+
+    def __setitem__(self, address: str, user: User) -> None:
+        self._write(address, user)
+        self._loaded[address] = user
+
+    def write(self, address: str, user: User) -> None:
+        self._write(address, user)
+        if address in self._loaded:
+            self._loaded[address] = user
+
+    def __delitem__(self, address: str) -> None:
+        cursor = self._connection.execute("DELETE FROM users WHERE address = ?", (address,))
+        self._loaded.pop(address, None)
+        if cursor.rowcount == 0:
+            raise KeyError(address)
+
+    def __contains__(self, address: object) -> bool:
+        if address in self._loaded:
+            return True
+        row = self._connection.execute("SELECT 1 FROM users WHERE address = ?",
+                                       (address,)).fetchone()
+        return row is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for address, _ in self._rows():
+            yield address
+
+    def __len__(self) -> int:
+        return cast(int, self._connection.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+
+    def items(self) -> Iterator[Tuple[str, User]]: # type: ignore
+        for address, data in self._rows():
+            if address in self._loaded:
+                yield address, self._loaded[address]
+            else:
+                user = self._parse(address, data)
+                try:
+                    yield address, user
+                finally:
+                    # also write the change if the caller stops iterating here
+                    if user.changed:
+                        self._write(address, user)
+
+    def values(self) -> Iterator[User]: # type: ignore
+        return (user for (_, user) in self.items())
+
+    def save(self) -> None:
+        for address, user in self._loaded.items():
+            if user.changed:
+                self._write(address, user)
+        if self.tally.changed:
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('tally', ?)",
+                                     (json.dumps(tally_json(self.tally)),))
+            self.tally.changed = False
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def _throw(exn: BaseException) -> User:
+    """Turn raise into an expression"""
+    raise exn
+
+
+def open_store(path: str = PATH, create: bool = False) -> Result[str, UserStore]:
+    """Opens the user store at the given path.
+
+    Files ending in .json or .json.gz are loaded whole into a JsonStore. Anything else is opened as
+    a sqlite database. A missing database is only created when there is no json user file next to
+    it, so that users who have not been migrated are not replaced with an empty store.
+
+    Args:
+        path: The file the users are stored in
+        create: Create a missing database even if a json user file exists
+
+    Returns:
+        The store, or an Err if it could not be opened
+    """
+    if path.endswith(".json") or path.endswith(".json.gz"):
+        return _load_json_store(path)
+    legacy_path = os.path.join(os.path.dirname(path), JSON_PATH)
+    if not create and not os.path.exists(path) and os.path.exists(legacy_path):
+        return Err("{} does not exist, but {} does. Run migrate_users.py to move the users "
+                   "into it".format(path, legacy_path))
+    try:
+        return Ok(SqliteStore(sqlite3.connect(path)))
+    except (sqlite3.Error, ValueError) as exn:
+        return Err(str(exn))
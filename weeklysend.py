@@ -1,26 +1,68 @@
 """ The script that sends an email out once a week to everybody on the list. """
 
-from typing import Dict, Iterable, Any, TypeVar, Callable, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (Dict, Deque, Iterable, Iterator, Any, TypeVar, Callable, List, Optional,
+                    Tuple)
 import datetime
-import praw
+import json
+import os
+import random
+import sys
 
-from result import Result # pylint: disable=W0611
+from result import Result, Ok, Err
 import scraper
 import mail
-from user import User, load_users, save_users
+from jsonparse import record_parser, optional_parser, str_parser
+from user import User
+from userstore import UserStore, open_store
+from catalog import Catalog, open_catalog, refresh
 
 # pylint: disable=C0103
 
-Users = Dict[str, User]
-Post = praw.models.reddit.submission.Submission
+Users = UserStore
+Post = scraper.ChallengePost
 A = TypeVar("A")
 
+# Number of weekly messages being sent at once
+CONCURRENCY = 8
+
+# Files recording the progress of the weekly send and of a send caused by a veto
+WEEKLY_JOURNAL = "send-journal.json"
+VETO_JOURNAL = "veto-journal.json"
+
+# Number of sends in a row that can fail for a recipient before a resumed send stops trying them
+MAX_SEND_ATTEMPTS = 3
+
+# A veto resend uses the catalog without refreshing it if it is less than this many seconds old
+VETO_CATALOG_MAX_AGE = 7 * 24 * 60 * 60
+
 
 def empty(xs: Iterable[A]) -> bool:
     """ Tests if an iterable is empty. """
     return not bool(xs)
 
 
+def pick_other(langs: List[str], exclude: Optional[str]) -> Optional[str]:
+    """Picks a language at random, avoiding one language unless it is the only choice.
+
+    The excluded language is skipped over rather than redrawn, so this takes one draw.
+
+    Args:
+        langs: The languages to pick from
+        exclude: The language to avoid
+
+    Returns:
+        The language, or None if there are no languages
+    """
+    if empty(langs):
+        return None
+    if exclude not in langs or len(langs) == 1:
+        return scraper.choose(langs)
+    index = random.randrange(len(langs) - 1)
+    return langs[index + 1] if index >= langs.index(exclude) else langs[index]
+
+
 def different_lang(user: User, level: str) -> Optional[str]:
     """Tries to choose a language different than what the user had the previous week.
 
@@ -31,14 +73,7 @@ def different_lang(user: User, level: str) -> Optional[str]:
     Returns:
         The language, or None if the user has no languages for the given level
     """
-    if empty(user.langs[level]):
-        return None
-    else:
-        for _ in range(1000):
-            lang = scraper.choose(user.langs[level])
-            if lang != user.last_lang:
-                return lang
-        return scraper.choose(user.langs[level])
+    return pick_other(user.langs[level], user.last_lang)
 
 
 def same_lang(user: User, level: str) -> Optional[str]:
@@ -60,54 +95,407 @@ def same_lang(user: User, level: str) -> Optional[str]:
         return scraper.choose(langs)
 
 
+def least_recent_lang(user: User, level: str) -> Optional[str]:
+    """Chooses the language the user was sent longest ago, or one they have never been sent.
+
+    Args:
+        user: The user to choose the language for
+        level: The level of challenge to choose a language for
+
+    Returns:
+        The language, or None if the user has no languages for the given level
+    """
+    langs = user.langs[level]
+    if empty(langs):
+        return None
+    last_sent = {lang: when for (when, lang) in enumerate(user.history)}
+    oldest = min(last_sent.get(lang, -1) for lang in langs)
+    return scraper.choose([lang for lang in langs if last_sent.get(lang, -1) == oldest])
+
+
+def round_robin_lang(user: User, level: str) -> Optional[str]:
+    """Chooses the language after the user's last one in the order they listed their languages.
+
+    Args:
+        user: The user to choose the language for
+        level: The level of challenge to choose a language for
+
+    Returns:
+        The language, or None if the user has no languages for the given level
+    """
+    langs = user.langs[level]
+    if user.last_lang not in langs:
+        return least_recent_lang(user, level)
+    return langs[(langs.index(user.last_lang) + 1) % len(langs)]
+
+
+def avoid_recent_lang(count: int) -> Callable[[User, str], Optional[str]]:
+    """Builds a policy that avoids the languages a user was sent in their last few challenges.
+
+    Args:
+        count: The number of recent languages to avoid. At most user.HISTORY_LENGTH are known
+
+    Returns:
+        A policy choosing at random from the languages not sent recently. If every language was
+        sent recently, the least recently sent one is chosen
+    """
+    def choose_lang(user: User, level: str) -> Optional[str]:
+        """The policy to return"""
+        recent = set(user.history[-count:])
+        fresh = [lang for lang in user.langs[level] if lang not in recent]
+        if empty(fresh):
+            return least_recent_lang(user, level)
+        return scraper.choose(fresh)
+
+    return choose_lang
+
+
+# Language policies that can be picked for the weekly send with --policy=<name>
+LANG_POLICIES = {
+    "different": different_lang,
+    "avoid-recent": avoid_recent_lang(3),
+    "round-robin": round_robin_lang,
+    "least-recent": least_recent_lang,
+} # type: Dict[str, Callable[[User, str], Optional[str]]]
+
+
+class SendJournal(object):
+    """A record of the recipients a send has reached, so a crashed send can be resumed.
+
+    The journal is a file of json lines. The first line records the week, level and post of the
+    send. Each line after that records either a recipient and the language they were sent, or a
+    recipient and the error their send failed with. A recipient whose send has failed
+    MAX_SEND_ATTEMPTS times is given up on, so one bad address cannot keep the send unfinished.
+
+    Attributes:
+        path: The file the journal is kept in
+        week: The ISO week of the send
+        level: The level that was chosen for the send
+        post_id: The id of the post being sent
+        done: The language sent to each recipient that has been reached
+        failures: The number of failed sends to each recipient that has not been reached
+    """
+    def __init__(self, # pylint: disable=too-many-arguments
+                 path: str,
+                 week: str,
+                 level: str,
+                 post_id: str,
+                 done: Dict[str, Optional[str]],
+                 failures: Optional[Dict[str, int]] = None
+                ) -> None:
+        self.path = path
+        self.week = week
+        self.level = level
+        self.post_id = post_id
+        self.done = done
+        self.failures = failures if failures is not None else dict()
+
+    @staticmethod
+    def start(path: str, week: str, level: str, post_id: str) -> "SendJournal":
+        """Starts a new journal, replacing any old one.
+
+        Args:
+            path: The file to keep the journal in
+            week: The ISO week of the send
+            level: The level chosen for the send
+            post_id: The id of the post being sent
+
+        Returns:
+            An empty journal
+        """
+        with open(path, "w") as handle:
+            handle.write(json.dumps({"week": week, "level": level, "post": post_id}) + "\n")
+        return SendJournal(path, week, level, post_id, dict())
+
+    @staticmethod
+    def resume(path: str, week: str) -> Optional["SendJournal"]:
+        """Loads the journal of an unfinished send from this week.
+
+        Args:
+            path: The file the journal is kept in
+            week: The current ISO week
+
+        Returns:
+            The journal, or None if there is no usable journal for this week
+        """
+        header_parser = record_parser({"week": str_parser, "level": str_parser,
+                                       "post": str_parser},
+                                      lambda week, level, post: (week, level, post))
+        entry_parser = record_parser({"address": str_parser,
+                                      "lang": optional_parser(str_parser)},
+                                     lambda address, lang: (address, lang))
+        failure_parser = record_parser({"address": str_parser, "error": str_parser},
+                                       lambda address, error: address)
+        try:
+            with open(path, "r") as handle:
+                lines = [line for line in handle if line.endswith("\n")]
+            if not lines:
+                return None
+            started, level, post_id = header_parser(json.loads(lines[0])).extract(
+                err_func=lambda _: ("", "", ""),
+                ok_func=lambda header: header
+            )
+            if started != week:
+                return None
+            done = dict() # type: Dict[str, Optional[str]]
+            failures = dict() # type: Dict[str, int]
+            for line in lines[1:]:
+                raw = json.loads(line)
+                failed = failure_parser(raw)
+                if failed.is_ok:
+                    address = failed.extract(lambda _: "", lambda a: a)
+                    failures[address] = failures.get(address, 0) + 1
+                    continue
+                entry = entry_parser(raw)
+                if entry.is_ok:
+                    address, lang = entry.extract(lambda _: ("", None), lambda e: e)
+                    done[address] = lang
+            return SendJournal(path, week, level, post_id, done, failures)
+        except (OSError, ValueError):
+            return None
+
+    def record(self, address: str, lang: Optional[str]) -> None:
+        """Records that a recipient has been sent their message.
+
+        Args:
+            address: The recipient
+            lang: The language they were sent
+        """
+        self.done[address] = lang
+        with open(self.path, "a") as handle:
+            handle.write(json.dumps({"address": address, "lang": lang}) + "\n")
+
+    def record_failure(self, address: str, error: str) -> None:
+        """Records that the send to a recipient failed.
+
+        Args:
+            address: The recipient
+            error: Why the send failed
+        """
+        self.failures[address] = self.failures.get(address, 0) + 1
+        with open(self.path, "a") as handle:
+            handle.write(json.dumps({"address": address, "error": error}) + "\n")
+
+    def gave_up(self, address: str) -> bool:
+        """Checks if sending to a recipient has failed too many times to try again."""
+        return self.failures.get(address, 0) >= MAX_SEND_ATTEMPTS
+
+    def finish(self) -> None:
+        """Removes the journal once the send has completed."""
+        os.remove(self.path)
+
+
+def this_week() -> str:
+    """ Gets the current ISO week, the unit sends are resumed within. """
+    return datetime.datetime.now().strftime("%G-W%V")
+
+
+def fan_out(workers: mail.ServicePool,
+            messages: Iterable[Tuple[A, mail.Outgoing]],
+            on_done: Callable[[A, Result[str, Any]], None],
+            concurrency: int = CONCURRENCY,
+            bucket: Optional[mail.TokenBucket] = None) -> None:
+    """Sends messages on a pool of worker threads.
+
+    Messages are pulled from the iterable as workers free up, so only a few of them are built
+    ahead of time. Sends are rate limited and retried with exponential backoff.
+
+    Args:
+        workers: Gives each worker thread its mail service
+        messages: Each message to send paired with a key identifying it
+        on_done: Called on this thread with the key and outcome of each send
+        concurrency: The number of sends in flight at once
+        bucket: Limits the rate of sends. Defaults to gmail's sending quota
+    """
+    limiter = bucket if bucket is not None else mail.TokenBucket(mail.SEND_RATE, mail.SEND_BURST)
+
+    def send(msg: mail.Outgoing) -> Result[str, Any]:
+        """ Send a message on a worker thread. """
+        return mail.send_with_retry(workers.get(), "me", msg, limiter)
+
+    in_flight = deque() # type: Deque[Tuple[A, Future]]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for key, msg in messages:
+            in_flight.append((key, pool.submit(send, msg)))
+            if len(in_flight) > 2 * concurrency:
+                done_key, outcome = in_flight.popleft()
+                on_done(done_key, outcome.result())
+        while in_flight:
+            done_key, outcome = in_flight.popleft()
+            on_done(done_key, outcome.result())
+
+
+def workers(service: Any, service_factory: Optional[Callable[[], Any]]) -> mail.ServicePool:
+    """ Build the services for worker threads, sharing service if there is no factory. """
+    return mail.ServicePool(service_factory if service_factory is not None else lambda: service)
+
+
 def send_messages(users: Users,
                   service: Any,
                   level: str,
                   post: Post,
-                  choose_lang: Callable[[User, str], Optional[str]]
-                 ) -> None:
-    """ Send out messages to all the users. """
-    for (address, user) in users.items():
-        lang = choose_lang(user, level)
-        lang_str = "a language of your choice" if lang is None else lang
-        user.last_lang = lang
+                  choose_lang: Callable[[User, str], Optional[str]],
+                  service_factory: Optional[Callable[[], Any]] = None,
+                  journal: Optional[SendJournal] = None
+                 ) -> Dict[str, Result[str, Any]]:
+    """Send out messages to all the users.
+
+    A user's last language, level and veto are only updated once their message has been sent. If a
+    journal is given each send is recorded in it. Recipients it already lists as reached are not
+    sent to again but are given the language the journal says they were sent, and recipients it has
+    given up on are skipped.
+
+    Args:
+        users: The users to send to
+        service: The mail service to use
+        level: The level of this week's challenge
+        post: The challenge post
+        choose_lang: Chooses the language for each user
+        service_factory: Builds a mail service for each worker thread. If this is not given the
+            workers share service
+        journal: The journal of a send to resume or record into
+
+    Returns:
+        The outcome of the send to each address sent to in this call
+    """
+    outcomes = dict() # type: Dict[str, Result[str, Any]]
+    done = journal.done if journal is not None else dict() # type: Dict[str, Optional[str]]
+
+    def commit(address: str, user: User, lang: Optional[str]) -> None:
+        """ Update the state of a user who has been sent their message. """
+        user.assign(lang)
+        if user.vetoed:
+            users.tally.unvote()
         user.vetoed = False
         user.last_level = level
-        send_message(address, service, level, lang_str, post)
+        users.write(address, user)
+
+    template = compile_message(level, post)
+
+    def messages() -> Iterator[Tuple[Tuple[str, User, Optional[str]], mail.Outgoing]]:
+        """ Build the message for each user who has not been sent one. """
+        for (address, user) in users.items():
+            if address in done:
+                commit(address, user, done[address])
+                continue
+            if journal is not None and journal.gave_up(address):
+                continue
+            lang = choose_lang(user, level)
+            lang_str = "a language of your choice" if lang is None else lang
+            yield (address, user, lang), template.render(address, lang_str)
+
+    def record(key: Tuple[str, User, Optional[str]], outcome: Result[str, Any]) -> None:
+        """ Remember the outcome, and commit the user's new state if the send worked. """
+        address, user, lang = key
+        outcomes[address] = outcome
+        if outcome.is_ok:
+            commit(address, user, lang)
+            if journal is not None:
+                journal.record(address, lang)
+        elif journal is not None:
+            journal.record_failure(address, outcome.extract(lambda err: err, lambda _: ""))
+
+    fan_out(workers(service, service_factory), messages(), record)
+    return outcomes
+
+
+def start_send(path: str, catalog: Catalog, level: str) -> Result[str, SendJournal]:
+    """Picks the newest challenge at a level that has not been sent yet and starts a journal for it.
+
+    Args:
+        path: The file to keep the journal in
+        catalog: The catalog to pick the challenge from
+        level: The level of the challenge
 
+    Returns:
+        The journal, or an Err if every challenge at the level has been sent
+    """
+    post = catalog.newest(level, unsent=True)
+    if post is None:
+        return Err("There are no {} challenges left to send".format(level))
+    journal = SendJournal.start(path, this_week(), level, post.id)
+    catalog.mark_sent(post.id, this_week())
+    return Ok(journal)
+
+
+def closing_catalog(catalog: Catalog, action: Callable[[], A]) -> A:
+    """ Runs an action, closing the catalog afterwards. """
+    try:
+        return action()
+    finally:
+        catalog.close()
+
+
+def send_journaled(users: Users,
+                   service: Any,
+                   catalog: Catalog,
+                   journal: SendJournal,
+                   choose_lang: Callable[[User, str], Optional[str]],
+                   service_factory: Optional[Callable[[], Any]]
+                  ) -> Result[str, None]:
+    """Sends or resumes the send recorded in a journal.
+
+    The journal is removed once every recipient has been reached or given up on, so a failure that
+    keeps happening stops being retried after MAX_SEND_ATTEMPTS sends.
 
-def send_message(address: str, service: Any, level: str, language: str, post: Post) -> None:
-    """ Sends the user a message containing the problem in the given post. """
-    title = post.title.split(']')[-1].strip()
-    date = datetime.datetime.now().strftime("%G-W%V")
-    subject = "[Weekly Programming Problem] {} in {}".format(title, language)
+    Args:
+        users: The users to send to
+        service: The mail service to use
+        catalog: The catalog holding the post being sent
+        journal: The journal of the send
+        choose_lang: Chooses the language for each user
+        service_factory: Builds a mail service for each worker thread
+
+    Returns:
+        An Err describing any sends that failed
+    """
+    post = catalog.get(journal.post_id)
+    if post is None:
+        return Err("The post {} for this week's send is not in the catalog".format(
+            journal.post_id))
+    users.tally.start_week(journal.week, journal.level)
+    outcomes = send_messages(users, service, journal.level, post, choose_lang,
+                             service_factory, journal)
+    result = report_failures(outcomes)
+    if all(journal.gave_up(address) for (address, outcome) in outcomes.items() if outcome.is_err):
+        journal.finish()
+    return result
+
+
+def report_failures(outcomes: Dict[str, Result[str, Any]]) -> Result[str, None]:
+    """ Summarizes the sends that failed as an error. """
+    failures = ["{}: {}".format(address, outcome.extract(lambda err: err, lambda _: ""))
+                for (address, outcome) in outcomes.items() if outcome.is_err]
+    if failures:
+        return Err("Could not send to {} of {} users:\n{}".format(
+            len(failures), len(outcomes), "\n".join(failures)))
+    return Ok(None)
+
+
+def compile_message(level: str, post: Post) -> mail.HtmlTemplate:
+    """ Renders the parts of the message for a post that are the same for every recipient. """
+    parsed = scraper.parse_title(post.title)
+    title = parsed.name if parsed is not None else post.title
+    date = this_week()
     repo_url = "https://github.com/tyehle/programming-studio"
     push_instructions = ("To push your code to the <a href={url}>studio repo</a> put "
                          "it in this week's folder in a folder with your name "
                          "(ie: {date}/tobin/*.py), or as a single file with "
                          "your name in it (ie: {date}/tobin_code.py)."
                         ).format(date=date, url=repo_url)
-    message = """This week you will be doing the {level}
+    before = """This week you will be doing the {level}
                  <a href=https://www.reddit.com{link}>{title}</a> problem in
-                 {language}!<br><br>
+                 """.format(level=level, title=title, link=post.permalink)
+    after = """!<br><br>
 
                  {repo}<br><br>
 
                  {spec}
-                 """.format(level=level,
-                            title=title,
-                            language=language,
-                            repo=push_instructions,
-                            link=post.permalink,
-                            spec=post.selftext_html)
-    # print("Sending ({}, {}) to {}".format(level, language, address))
-    # if address == "tobinyehle@gmail.com":
-    #     print(subject)
-    #     without_newlines = message.replace("\n", "")
-    #     print(without_newlines)
-    mail.send(service, "me", mail.make_html_message(body=message,
-                                                    subject=subject,
-                                                    recipient=address))
+                 """.format(repo=push_instructions, spec=post.selftext_html)
+    return mail.HtmlTemplate(subject_before="[Weekly Programming Problem] {} in ".format(title),
+                             subject_after="",
+                             body_before=before,
+                             body_after=after)
 
 
 def mail_error(service: Any) -> Callable[[str], None]:
@@ -129,36 +517,73 @@ def mail_error(service: Any) -> Callable[[str], None]:
     return send_mail
 
 
-def resend_cause_veto(users: Users, service: Any) -> None:
+def resume_veto(users: Users,
+                service: Any,
+                service_factory: Optional[Callable[[], Any]] = None) -> bool:
+    """Finishes a send caused by a veto earlier this week that did not reach every user.
+
+    The tally is not checked, because the users who were reached have already had their votes
+    cleared, so it may no longer show enough votes.
+
+    Args:
+        users: The user list
+        service: The mail service to use
+        service_factory: Builds a mail service for each worker thread
+
+    Returns:
+        True if a send caused by a veto this week has still not reached every user
+    """
+    def with_catalog(catalog: Catalog, journal: SendJournal) -> Result[str, None]:
+        """Resumes the send once the catalog is open"""
+        return closing_catalog(catalog, lambda: send_journaled(users, service, catalog, journal,
+                                                               same_lang, service_factory))
+
+    journal = SendJournal.resume(VETO_JOURNAL, this_week())
+    if journal is None:
+        return False
+    result = open_catalog().bind(lambda catalog: with_catalog(catalog, journal))
+    result.extract(
+        err_func=mail_error(service),
+        ok_func=lambda _: None
+    )
+    return result.is_err
+
+
+def resend_cause_veto(users: Users,
+                      service: Any,
+                      service_factory: Optional[Callable[[], Any]] = None) -> None:
     """Send out a new challenge because the last one was vetoed.
 
+    This always starts a new send, replacing the journal of any earlier veto. Use resume_veto to
+    finish an earlier one.
+
     Args:
         users: The user list
         service: The mail service to use
+        service_factory: Builds a mail service for each worker thread
     """
-    def with_posts(posts: Dict[str, Post]) -> None:
-        """Code to execute given we can get a list of new posts"""
-        # try to get a new level
-        last_level = list(users.values())[0].last_level # any last level will do
-        level = "Easy" # Default to easy. This should always be changed
-        for _ in range(1000):
-            level = scraper.choose_level(users)
-            if level != last_level:
-                break
+    def with_catalog(catalog: Catalog) -> Result[str, None]:
+        """Code to execute given we have an up to date catalog of posts"""
+        # get a new level
+        level = scraper.choose_level(users, exclude=users.tally.level)
+        started = start_send(VETO_JOURNAL, catalog, level)
 
         # notify all users of what happened
-        for address in users.keys():
-            mail.send(service, "me", mail.make_message(
-                recipient=address,
-                subject="[Weekly Programming Problem] Veto!",
-                body="The people have spoken! This week's problem sucks! "
-                     "Look for a new problem in your inbox."
-            ))
+        notices = ((address, mail.make_message(
+            recipient=address,
+            subject="[Weekly Programming Problem] Veto!",
+            body="The people have spoken! This week's problem sucks! "
+                 "Look for a new problem in your inbox."
+        )) for address in users.keys())
+        if started.is_ok:
+            fan_out(workers(service, service_factory), notices, lambda _, __: None)
 
         # send the new challenge
-        return send_messages(users, service, level, posts[level], same_lang)
+        return started.bind(lambda j: send_journaled(users, service, catalog, j, same_lang,
+                                                     service_factory))
 
-    result = scraper.init_reddit().bind(scraper.latest).fmap(with_posts)
+    result = open_catalog().bind(lambda catalog: closing_catalog(
+        catalog, lambda: refresh(catalog, max_age=VETO_CATALOG_MAX_AGE).bind(with_catalog)))
     result.extract(
         err_func=mail_error(service),
         ok_func=lambda _: None
@@ -167,16 +592,32 @@ def resend_cause_veto(users: Users, service: Any) -> None:
 
 def main() -> int:
     """ The main function to run when this file is called as a script. """
-    def with_users_posts(users: Users, posts: Dict[str, Post]) -> None:
+    def with_users_catalog(users: UserStore, catalog: Catalog) -> Result[str, None]:
         """Does all the things that need the user list"""
-        level = scraper.choose_level(users)
-        send_messages(users, service, level, posts[level], different_lang)
-        save_users(users)
-
+        try:
+            journal = SendJournal.resume(WEEKLY_JOURNAL, this_week())
+            started = Ok(journal) if journal is not None else \
+                start_send(WEEKLY_JOURNAL, catalog, scraper.choose_level(users))
+            result = started.bind(lambda j: send_journaled(users, service, catalog, j,
+                                                           choose_lang, mail.init_service))
+            users.save()
+        finally:
+            users.close()
+        return result
+
+    # --offline sends from the catalog without going to reddit for new posts
+    offline = "--offline" in sys.argv[1:]
+    policies = [arg[len("--policy="):] for arg in sys.argv[1:] if arg.startswith("--policy=")]
+    if policies and policies[-1] not in LANG_POLICIES:
+        print("Unknown language policy {}, expected one of {}".format(
+            policies[-1], ", ".join(sorted(LANG_POLICIES))))
+        return 2
+    choose_lang = LANG_POLICIES[policies[-1]] if policies else different_lang
     service = mail.init_service()
-    result = load_users().bind(
-        lambda u: scraper.init_reddit().bind(scraper.latest).fmap(
-            lambda ps: with_users_posts(u, ps))) # type: Result[str, None] # pylint: disable=undefined-variable
+    result = open_store().bind(
+        lambda u: open_catalog().bind(
+            lambda c: closing_catalog(c, lambda: refresh(c, offline=offline).bind(
+                lambda _: with_users_catalog(u, c))))) # type: Result[str, None] # pylint: disable=undefined-variable
 
     return result.map_err(mail_error(service)).extract(
         err_func=lambda _: 1,